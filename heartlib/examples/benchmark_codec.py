@@ -0,0 +1,181 @@
+"""Cost and accuracy of the HeartCodec flow-matching ODE solvers.
+
+Every solver / schedule / step count / guidance / feature cache setting renders
+the same codes from the same noise and is compared with a many-step, fully guided Euler
+reference: estimator calls, estimator passes (a guided call runs both CFG
+branches and counts twice), seconds and the log-spectral distance in dB.
+
+Guidance intervals are given as ``start:end`` in ODE time (0 is noise) or
+``all``, e.g. ``--guidance_intervals all 0:0.5 --uncond_every 1 2``. Feature
+caching (see ``FeatureCache``) is swept with e.g. ``--cache_intervals 1 2 3
+--cache_depths 0 4``; an interval of 1 disables it.
+
+With ``--model_path`` the released codec is loaded and ``--codes_path`` can
+point to codes saved by ``run_music_generation.py``. Otherwise a randomly
+initialised codec renders random codes, which only makes the timings and the
+relative solver error meaningful.
+"""
+
+from heartlib.heartcodec.configuration_heartcodec import HeartCodecConfig
+from heartlib.heartcodec.modeling_heartcodec import HeartCodec
+import argparse
+import itertools
+import os
+import time
+import torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default=None)
+    parser.add_argument("--codes_path", type=str, default=None)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--seed", type=int, default=0)
+    # random codes: 12.5 frames per second
+    parser.add_argument("--num_frames", type=int, default=750)
+    parser.add_argument("--guidance_scale", type=float, default=1.25)
+    parser.add_argument("--reference_steps", type=int, default=64)
+    parser.add_argument(
+        "--solvers", type=str, nargs="+", default=["euler", "heun", "midpoint", "ab2"]
+    )
+    parser.add_argument("--schedules", type=str, nargs="+", default=["uniform"])
+    parser.add_argument("--shifts", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--steps", type=int, nargs="+", default=[3, 4, 5, 6, 8, 10])
+    parser.add_argument("--guidance_intervals", type=str, nargs="+", default=["all"])
+    parser.add_argument("--uncond_every", type=int, nargs="+", default=[1])
+    parser.add_argument("--uncond_extrapolate", action="store_true")
+    parser.add_argument("--cache_intervals", type=int, nargs="+", default=[1])
+    parser.add_argument("--cache_depths", type=int, nargs="+", default=[0])
+    return parser.parse_args()
+
+
+def load_codec(args):
+    device = torch.device(args.device)
+    if args.model_path is not None:
+        return HeartCodec.from_pretrained(
+            os.path.join(args.model_path, "HeartCodec-oss"), device_map=device
+        ).eval()
+    codec = HeartCodec(
+        HeartCodecConfig(
+            dim=32,
+            codebook_dim=8,
+            attention_head_dim=16,
+            num_attention_heads=2,
+            num_layers=4,
+            num_layers_2=1,
+            in_channels=544,
+            init_channel=4,
+        )
+    )
+    return codec.to(device).eval()
+
+
+def load_codes(codec, args):
+    if args.codes_path is not None:
+        return HeartCodec.load_codes(args.codes_path)
+    generator = torch.Generator().manual_seed(args.seed)
+    return torch.randint(
+        codec.config.codebook_size,
+        (codec.config.num_quantizers, args.num_frames),
+        generator=generator,
+    )
+
+
+def _interval(value):
+    if value == "all":
+        return None
+    start, end = value.split(":")
+    return float(start), float(end)
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _log_spectrum(wav):
+    spec = torch.stft(
+        wav.float().mean(dim=0),
+        n_fft=2048,
+        hop_length=512,
+        window=torch.hann_window(2048, device=wav.device),
+        return_complex=True,
+    )
+    return 20 * torch.log10(spec.abs().clamp_min(1e-5))
+
+
+def render(codec, codes, args, **kwargs):
+    """(wav, estimator calls, passes, seconds) of one seeded ``detokenize``"""
+    rows = []
+    hook = codec.flow_matching.estimator.register_forward_hook(
+        lambda module, inputs, output: rows.append(inputs[0].shape[0])
+    )
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    _sync(device)
+    start = time.perf_counter()
+    wav = codec.detokenize(
+        codes,
+        guidance_scale=args.guidance_scale,
+        device=device,
+        disable_progress=True,
+        **kwargs,
+    )
+    _sync(device)
+    elapsed = time.perf_counter() - start
+    hook.remove()
+    return wav, len(rows), sum(rows), elapsed
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    codec = load_codec(args)
+    codes = load_codes(codec, args)
+    reference, _, _, _ = render(codec, codes, args, num_steps=args.reference_steps)
+    reference = _log_spectrum(reference)
+
+    print(
+        "solver    schedule  shift  steps  guidance  uncond  cache  depth"
+        "  calls  passes  seconds  LSD dB"
+    )
+    grid = itertools.product(
+        args.solvers,
+        args.schedules,
+        args.shifts,
+        args.steps,
+        args.guidance_intervals,
+        args.uncond_every,
+        args.cache_intervals,
+        args.cache_depths,
+    )
+    for (
+        solver,
+        schedule,
+        shift,
+        num_steps,
+        interval,
+        uncond_every,
+        cache_interval,
+        cache_depth,
+    ) in grid:
+        wav, calls, passes, elapsed = render(
+            codec,
+            codes,
+            args,
+            num_steps=num_steps,
+            solver=solver,
+            schedule=schedule,
+            shift=shift,
+            guidance_interval=_interval(interval),
+            uncond_every=uncond_every,
+            uncond_extrapolate=args.uncond_extrapolate,
+            cache_interval=cache_interval,
+            cache_depth=cache_depth,
+        )
+        lsd = (_log_spectrum(wav) - reference).pow(2).mean(dim=0).sqrt().mean()
+        print(
+            f"{solver:<8}  {schedule:<8}  {shift:>5.2f}  {num_steps:>5}"
+            f"  {interval:<8}  {uncond_every:>6}  {cache_interval:>5}  {cache_depth:>5}"
+            f"  {calls:>5}  {passes:>6}"
+            f"  {elapsed:>7.2f}  {lsd:>6.2f}"
+        )
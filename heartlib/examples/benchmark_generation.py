@@ -0,0 +1,563 @@
+"""Throughput benchmarks for the HeartMuLa decode loop.
+
+With ``--model_path`` the released checkpoints are loaded, otherwise a randomly
+initialised model of ``--flavor`` is built so the script also runs on a laptop
+CPU (``--flavor llama-tiny --device cpu --dtype float32``).
+"""
+
+from heartlib import HeartMuLaGenPipeline
+from heartlib.heartcodec.configuration_heartcodec import HeartCodecConfig
+from heartlib.heartcodec.modeling_heartcodec import HeartCodec
+from heartlib.heartmula.configuration_heartmula import HeartMuLaConfig
+from heartlib.heartmula.modeling_heartmula import (
+    FLAVORS,
+    DepthDecoderEngine,
+    HeartMuLa,
+    _guide_logits,
+    _is_cfg_batch,
+)
+from heartlib.heartmula.sampling import SamplingParams, sample
+from heartlib.pipelines.music_generation import HeartMuLaGenConfig
+from tokenizers import Tokenizer, models, pre_tokenizers
+from torchtune.models import llama3_2
+from unittest import mock
+import argparse
+import time
+import torch
+
+
+def llama3_2_tiny():
+    return llama3_2.llama3_2(
+        vocab_size=128_256,
+        num_layers=2,
+        num_heads=4,
+        num_kv_heads=2,
+        embed_dim=256,
+        max_seq_len=8192,
+        intermediate_dim=512,
+        attn_dropout=0.0,
+        norm_eps=1e-5,
+        rope_base=500_000,
+        scale_factor=32,
+    )
+
+
+# randomly initialised runs only, no checkpoint of this size exists
+BENCH_FLAVORS = {"llama-tiny": llama3_2_tiny}
+
+
+def _multinomial_sample_one_no_sync(
+    probs,
+):  # Does multinomial sampling without a cuda synchronization
+    q = torch.empty_like(probs).exponential_(1)
+    return torch.argmax(probs / q, dim=-1, keepdim=True).to(dtype=torch.int)
+
+
+def sample_topk(logits: torch.Tensor, topk: int, temperature: float):
+    """the former ``sample_topk`` of the model, the reference of ``--bench sampler``"""
+    logits = logits / temperature
+
+    filter_value: float = -float("Inf")
+    indices_to_remove = logits < torch.topk(logits, topk)[0][..., -1, None]
+    scores_processed = logits.masked_fill(indices_to_remove, filter_value)
+    scores_processed = torch.nn.functional.log_softmax(scores_processed, dim=-1)
+    probs = torch.nn.functional.softmax(scores_processed, dim=-1)
+
+    sample_token = _multinomial_sample_one_no_sync(probs)
+    return sample_token
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default=None)
+    parser.add_argument("--version", type=str, default="3B")
+    parser.add_argument("--flavor", type=str, default="llama-tiny")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_audio_length_ms", type=int, default=30_000)
+    parser.add_argument("--topk", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--cfg_scale", type=float, default=1.5)
+    parser.add_argument("--ignore_eos", action="store_true")
+    parser.add_argument("--repeats", type=int, default=3)
+
+    parser.add_argument(
+        "--bench",
+        type=str,
+        default="eos_check",
+        choices=[
+            "eos_check",
+            "speculative",
+            "depth_decoder",
+            "compile",
+            "sampler",
+            "kv_quant",
+            "cfg_schedule",
+            "codec_overlap",
+        ],
+    )
+    parser.add_argument(
+        "--eos_check_intervals", type=int, nargs="+", default=[1, 8, 32]
+    )
+    # speculative decoding: --draft_version with --model_path, else --draft_flavor
+    parser.add_argument("--draft_version", type=str, default="300M")
+    parser.add_argument("--draft_flavor", type=str, default="llama-tiny")
+    parser.add_argument("--num_draft_frames", type=int, nargs="+", default=[2, 4, 8])
+    # sampler: calls per configuration
+    parser.add_argument("--sampler_iters", type=int, default=200)
+    # cfg_schedule: guided frames of the "first K frames" schedules
+    parser.add_argument("--cfg_frames", type=int, default=250)
+    return parser.parse_args()
+
+
+def build_random_model(flavor, device, dtype):
+    # the library table only resolves while the model is built
+    with mock.patch.dict(FLAVORS, BENCH_FLAVORS):
+        model = HeartMuLa(
+            HeartMuLaConfig(backbone_flavor=flavor, decoder_flavor=flavor, muq_dim=64)
+        )
+    return model.to(device=device, dtype=dtype).eval()
+
+
+def build_random_pipeline(flavor, device, dtype):
+    model = build_random_model(flavor, device, dtype)
+    # only the code matrix is benchmarked, the codec just has to exist
+    codec = HeartCodec(
+        HeartCodecConfig(
+            dim=32,
+            codebook_dim=8,
+            attention_head_dim=16,
+            num_attention_heads=2,
+            num_layers=1,
+            num_layers_2=1,
+            in_channels=544,
+            init_channel=4,
+        )
+    )
+    tokenizer = Tokenizer(models.WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return HeartMuLaGenPipeline(
+        model,
+        codec.to(device).eval(),
+        None,
+        tokenizer,
+        HeartMuLaGenConfig(),
+        device,
+        dtype,
+    )
+
+
+def load_pipeline(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    if args.model_path is not None:
+        return HeartMuLaGenPipeline.from_pretrained(
+            args.model_path, device=device, dtype=dtype, version=args.version
+        )
+    return build_random_pipeline(args.flavor, device, dtype)
+
+
+def make_prompts(args):
+    return [
+        {
+            "tags": "piano,happy,wedding",
+            "lyrics": "[verse]\n" + " ".join(["la"] * (16 + 8 * i)),
+        }
+        for i in range(args.batch_size)
+    ]
+
+
+def make_inputs(pipe, args):
+    model_inputs = pipe.preprocess(make_prompts(args), cfg_scale=args.cfg_scale)
+    return pipe._ensure_tensor_on_device(model_inputs, device=pipe.device)
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def time_frames(pipe, model_inputs, args, repeats=None, **kwargs):
+    """frames/s of ``_generate_frames`` summed over songs, best of ``repeats``"""
+    best = 0.0
+    for _ in range(args.repeats if repeats is None else repeats):
+        torch.manual_seed(args.seed)
+        _sync(pipe.device)
+        start = time.perf_counter()
+        alive = [
+            frame_alive
+            for _, frame_alive in pipe._generate_frames(
+                model_inputs,
+                max_audio_length_ms=args.max_audio_length_ms,
+                temperature=args.temperature,
+                topk=args.topk,
+                cfg_scale=args.cfg_scale,
+                **kwargs,
+            )
+        ]
+        num_frames = int(torch.stack(alive).sum())
+        _sync(pipe.device)
+        best = max(best, num_frames / (time.perf_counter() - start))
+    return best, num_frames
+
+
+def bench_eos_check(pipe, model_inputs, args):
+    # interval 1 syncs after every frame like the old per-frame ``.item()`` loop
+    print("eos_check_interval  frames  frames/s")
+    for interval in args.eos_check_intervals:
+        fps, num_frames = time_frames(
+            pipe, model_inputs, args, eos_check_interval=interval
+        )
+        print(f"{interval:>18}  {num_frames:>6}  {fps:>8.1f}")
+
+
+def load_draft(pipe, args):
+    if args.model_path is not None:
+        draft = HeartMuLa.from_pretrained(
+            f"{args.model_path}/HeartMuLa-oss-{args.draft_version}", dtype=pipe.dtype
+        )
+        return draft.to(pipe.device).eval()
+    # random weights: only the cost of drafting is meaningful, not acceptance
+    return build_random_model(args.draft_flavor, pipe.device, pipe.dtype)
+
+
+def bench_speculative(pipe, model_inputs, args):
+    assert args.batch_size == 1, "speculative decoding only supports a single song"
+    base, _ = time_frames(pipe, model_inputs, args)
+    print(f"baseline: {base:.1f} frames/s")
+
+    draft = load_draft(pipe, args)
+    print("draft_frames  frames/s  speedup  acceptance  frames/forward")
+    for num_draft_frames in args.num_draft_frames:
+        pipe.enable_speculative_decoding(draft, num_draft_frames)
+        fps, _ = time_frames(pipe, model_inputs, args)
+        stats = pipe.speculative_stats
+        print(
+            f"{num_draft_frames:>12}  {fps:>8.1f}  {fps / base:>6.2f}x"
+            f"  {stats.acceptance_rate:>10.3f}  {stats.frames_per_forward:>14.2f}"
+        )
+    pipe.enable_speculative_decoding(None)
+
+
+def bench_depth_decoder(pipe, model_inputs, args):
+    model = pipe.model
+    print("depth decoder      frames/s")
+    # decode sessions follow ``model.depth_engine``: with None every frame
+    # runs the per-codebook loop of ``sample_frame``
+    for name, engine in (
+        ("generic loop", None),
+        ("engine", DepthDecoderEngine(model)),
+        ("engine+compile", DepthDecoderEngine(model).compile()),
+    ):
+        model.depth_engine = engine
+        if engine is not None and name.endswith("compile"):
+            time_frames(pipe, model_inputs, args)  # warmup / compilation
+        fps, _ = time_frames(pipe, model_inputs, args)
+        print(f"{name:<16}  {fps:>8.1f}")
+    model.depth_engine = DepthDecoderEngine(model)
+
+
+def _compiled_graphs():
+    return sum(torch._dynamo.utils.counters["stats"].values())
+
+
+def bench_compile(pipe, model_inputs, args):
+    print("decode step  warmup s  frames/s")
+    for name in ("eager", "compiled"):
+        if name == "compiled":
+            pipe.enable_compile()
+        start = time.perf_counter()
+        # compiled steps guard on the grad mode, warm up under the timed one
+        with torch.inference_mode():
+            pipe.warmup(
+                make_prompts(args),
+                cfg_scale=args.cfg_scale,
+                topk=args.topk,
+                temperature=args.temperature,
+            )
+        time_frames(pipe, model_inputs, args, repeats=1)  # untimed
+        warmup = time.perf_counter() - start
+        graphs = _compiled_graphs()
+        fps, _ = time_frames(pipe, model_inputs, args)
+        assert _compiled_graphs() == graphs, "the timed runs recompiled"
+        print(f"{name:<11}  {warmup:>8.1f}  {fps:>8.1f}")
+    pipe.compile_kwargs = None
+    pipe.decode_sessions = []
+
+
+@torch.inference_mode()
+def bench_sampler(pipe, model_inputs, args):
+    """one codebook draw of ``batch_size`` rows over the audio vocabulary"""
+    rows = args.batch_size
+    logits = torch.randn(
+        rows, pipe.model.config.audio_vocab_size, device=pipe.device, dtype=pipe.dtype
+    )
+    cases = [
+        ("sample_topk", lambda: sample_topk(logits, args.topk, args.temperature)),
+        (
+            "sample",
+            lambda: sample(
+                logits, SamplingParams(temperature=args.temperature, topk=args.topk)
+            ),
+        ),
+    ]
+    per_row = SamplingParams.create(
+        rows,
+        temperature=[args.temperature] * rows,
+        topk=[args.topk] * rows,
+        top_p=[0.95] * rows,
+        min_p=[0.02] * rows,
+        device=pipe.device,
+    )
+    cases.append(("sample per-row", lambda: sample(logits, per_row)))
+
+    print("sampler          us/call")
+    for name, fn in cases:
+        fn()
+        _sync(pipe.device)
+        start = time.perf_counter()
+        for _ in range(args.sampler_iters):
+            fn()
+        _sync(pipe.device)
+        elapsed = (time.perf_counter() - start) / args.sampler_iters
+        print(f"{name:<15}  {elapsed * 1e6:>7.1f}")
+
+
+@torch.inference_mode()
+def generate_codes(pipe, model_inputs, args):
+    """codes [num_quantizers, T] of the first song"""
+    frames = [
+        frame[0]
+        for frame, alive in pipe._generate_frames(
+            model_inputs,
+            max_audio_length_ms=args.max_audio_length_ms,
+            temperature=args.temperature,
+            topk=args.topk,
+            cfg_scale=args.cfg_scale,
+        )
+        if bool(alive[0])
+    ]
+    return torch.stack(frames, dim=1).long()
+
+
+@torch.inference_mode()
+def teacher_forced_c0_logits(pipe, model_inputs, codes, cfg_scale):
+    """guided codebook-0 logits [T, vocab] of a song given its codes [n, T]"""
+    model = pipe.model
+    tokens = model_inputs["tokens"]
+    rows, prompt_len = tokens.shape[:2]
+    num_frames = codes.size(1)
+    model.setup_caches(rows, prompt_len + num_frames)
+    with torch.autocast(device_type=pipe.device.type, dtype=pipe.dtype):
+        last_h = model.forward_backbone(
+            tokens,
+            model_inputs["tokens_mask"],
+            model_inputs["pos"],
+            cfg_scale,
+            continuous_segments=model_inputs["muq_embed"],
+            starts=model_inputs["muq_idx"],
+        )
+        frames = torch.full(
+            (rows, num_frames - 1, tokens.size(2)),
+            pipe.config.empty_id,
+            dtype=torch.long,
+            device=pipe.device,
+        )
+        frames[:, :, :-1] = codes[:, :-1].T
+        frames_mask = torch.ones_like(frames, dtype=torch.bool)
+        frames_mask[..., -1] = False
+        input_pos = torch.arange(prompt_len, prompt_len + num_frames - 1)
+        h = model.forward_backbone(
+            frames,
+            frames_mask,
+            input_pos.to(pipe.device).expand(rows, -1),
+            cfg_scale,
+            all_positions=True,
+        )
+        logits = model.codebook0_head(torch.cat([last_h.unsqueeze(1), h], dim=1))
+    logits = logits.float()
+    if _is_cfg_batch(rows, cfg_scale):
+        logits = _guide_logits(logits, cfg_scale)
+    return logits[0]
+
+
+def _log_spectrum(wav):
+    spec = torch.stft(
+        wav.float().mean(dim=0),
+        n_fft=2048,
+        hop_length=512,
+        window=torch.hann_window(2048, device=wav.device),
+        return_complex=True,
+    )
+    return 20 * torch.log10(spec.abs().clamp_min(1e-5))
+
+
+def _first_difference(a, b):
+    """index of the first frame where codes [n, T] differ, from frame 0
+
+    A song that stops earlier differs from the frame the other one goes on.
+    """
+    num_frames = min(a.size(1), b.size(1))
+    differs = (a[:, :num_frames] != b[:, :num_frames]).any(dim=0)
+    if differs.any():
+        return int(differs.int().argmax())
+    return num_frames
+
+
+def bench_kv_quant(pipe, model_inputs, args):
+    """int8 vs full-precision backbone KV caches
+
+    codebook-0 agreement and KL are teacher-forced on the reference codes, so
+    they measure the cache error of every step without compounding it. The
+    free-running codes and the rendered audio of both modes are compared too.
+    Random weights sample from near-uniform distributions that any rounding
+    flips, so the quality figures need ``--model_path``.
+    """
+    assert args.batch_size == 1, "the quality check compares a single song"
+    rows, prompt_len = model_inputs["tokens"].shape[:2]
+    max_seq_len = prompt_len + args.max_audio_length_ms // 80
+    for quantized in (False, True):
+        pipe.enable_kv_cache_quantization(quantized)
+        mib = pipe.model.cache_nbytes(rows, max_seq_len)["backbone_kv"] / 2**20
+        name = "int8" if quantized else str(pipe.dtype)
+        print(f"{name} backbone cache: {mib:.1f} MiB")
+    if args.model_path is None:
+        pipe.enable_kv_cache_quantization(False)
+        print("random weights: pass --model_path for the quality figures")
+        return
+
+    codes, wavs = {}, {}
+    for quantized in (False, True):
+        pipe.enable_kv_cache_quantization(quantized)
+        torch.manual_seed(args.seed)
+        codes[quantized] = generate_codes(pipe, model_inputs, args)
+    # the reference codes decide what both caches are fed
+    reference = codes[False]
+    logits = {}
+    for quantized in (False, True):
+        pipe.enable_kv_cache_quantization(quantized)
+        logits[quantized] = teacher_forced_c0_logits(
+            pipe, model_inputs, reference, args.cfg_scale
+        )
+    pipe.enable_kv_cache_quantization(False)
+
+    agreement = (logits[False].argmax(-1) == logits[True].argmax(-1)).float().mean()
+    kl = torch.nn.functional.kl_div(
+        logits[True].log_softmax(-1),
+        logits[False].log_softmax(-1),
+        log_target=True,
+        reduction="batchmean",
+    )
+    num_frames = max(codes[False].size(1), codes[True].size(1))
+    diverged = _first_difference(codes[False], codes[True])
+    print(f"codebook-0 top-1 agreement (teacher-forced): {agreement:.4f}")
+    print(f"codebook-0 KL(ref || int8) per frame:       {kl:.2e}")
+    print(f"free-running frames identical before divergence: {diverged}/{num_frames}")
+
+    for quantized in (False, True):
+        torch.manual_seed(args.seed)
+        wavs[quantized] = pipe.audio_codec.detokenize(
+            codes[quantized], device=pipe.device, disable_progress=True
+        )
+    length = min(wavs[False].size(-1), wavs[True].size(-1))
+    diff = _log_spectrum(wavs[False][..., :length]) - _log_spectrum(
+        wavs[True][..., :length]
+    )
+    lsd = diff.pow(2).mean(dim=0).sqrt().mean()
+    print(f"audio log-spectral distance: {lsd:.2f} dB")
+
+
+def _backbone_kv_bytes(model):
+    caches = [layer.attn.kv_cache for layer in model.backbone.layers]
+    return sum(
+        getattr(cache, name).nbytes
+        for cache in caches
+        for name in getattr(cache, "state_names", ("k_cache", "v_cache"))
+    )
+
+
+def bench_cfg_schedule(pipe, model_inputs, args):
+    """frames/s and memory of CFG schedules
+
+    ``end KV`` is the backbone cache left at the end of a song, ``peak`` the
+    peak allocation (CUDA only).
+    """
+    assert args.cfg_scale > 1.0, "schedules need --cfg_scale > 1"
+    k = args.cfg_frames
+    unguided = argparse.Namespace(**{**vars(args), "cfg_scale": 1.0})
+    schedules = [
+        ("full CFG", model_inputs, args, {}),
+        (f"first {k} frames", model_inputs, args, {"cfg_frames": k}),
+        ("codebook 0", model_inputs, args, {"cfg_codebooks": 1}),
+        (
+            f"first {k}, codebook 0",
+            model_inputs,
+            args,
+            {"cfg_frames": k, "cfg_codebooks": 1},
+        ),
+        ("no CFG", make_inputs(pipe, unguided), unguided, {}),
+    ]
+    print("schedule                frames/s  end KV MiB  peak MiB")
+    for name, inputs, schedule_args, kwargs in schedules:
+        if pipe.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(pipe.device)
+        fps, _ = time_frames(pipe, inputs, schedule_args, **kwargs)
+        end_kv = _backbone_kv_bytes(pipe.model) / 2**20
+        peak = "-"
+        if pipe.device.type == "cuda":
+            peak = f"{torch.cuda.max_memory_allocated(pipe.device) / 2**20:.0f}"
+        print(f"{name:<22}  {fps:>8.1f}  {end_kv:>10.1f}  {peak:>8}")
+
+
+@torch.inference_mode()
+def bench_codec_overlap(pipe, model_inputs, args):
+    """end-to-end seconds of LM + codec, serial and on a codec worker thread"""
+    forward_params = pipe._sanitize_parameters(
+        max_audio_length_ms=args.max_audio_length_ms,
+        temperature=args.temperature,
+        topk=args.topk,
+        cfg_scale=args.cfg_scale,
+    )[1]
+    print("mode          seconds")
+    for name, kwargs in (
+        ("LM only", {"detokenize": False}),
+        ("serial", {}),
+        ("overlapped", {"overlap_codec": True}),
+    ):
+        best = float("inf")
+        for _ in range(args.repeats):
+            torch.manual_seed(args.seed)
+            _sync(pipe.device)
+            start = time.perf_counter()
+            pipe._forward(model_inputs, **{**forward_params, **kwargs})
+            _sync(pipe.device)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:<12}  {best:>7.2f}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pipe = load_pipeline(args)
+    if args.ignore_eos:
+        pipe.config.audio_eos_id = pipe.model.config.audio_vocab_size
+    model_inputs = make_inputs(pipe, args)
+    if args.bench == "eos_check":
+        bench_eos_check(pipe, model_inputs, args)
+    elif args.bench == "speculative":
+        bench_speculative(pipe, model_inputs, args)
+    elif args.bench == "depth_decoder":
+        bench_depth_decoder(pipe, model_inputs, args)
+    elif args.bench == "compile":
+        bench_compile(pipe, model_inputs, args)
+    elif args.bench == "sampler":
+        bench_sampler(pipe, model_inputs, args)
+    elif args.bench == "kv_quant":
+        bench_kv_quant(pipe, model_inputs, args)
+    elif args.bench == "cfg_schedule":
+        bench_cfg_schedule(pipe, model_inputs, args)
+    elif args.bench == "codec_overlap":
+        bench_codec_overlap(pipe, model_inputs, args)
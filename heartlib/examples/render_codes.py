@@ -0,0 +1,66 @@
+"""Render audio codes saved by ``run_music_generation.py --codes_path``.
+
+The LM and the codec do not have to run on the same machine: generate with
+``--no_detokenize --codes_path song.pt`` and render the codes here, as often as
+needed and with other codec settings, without running HeartMuLa again.
+
+A ``.hlc`` codes archive renders every entry to ``<save_path root>_<i>.wav``,
+or only the ``--entries`` given.
+"""
+
+from heartlib import CodesArchive
+from heartlib.heartcodec.modeling_heartcodec import HeartCodec
+import argparse
+import os
+import soundfile as sf
+import torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--codes_path", type=str, nargs="+", required=True)
+    # defaults to the codes path with a .wav extension
+    parser.add_argument("--save_path", type=str, nargs="+", default=None)
+    parser.add_argument("--entries", type=int, nargs="+", default=None)
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--guidance_scale", type=float, default=1.25)
+    parser.add_argument("--duration", type=float, default=29.76)
+    parser.add_argument("--device", type=str, default="cuda")
+    # songs whose codec windows are solved together
+    parser.add_argument("--batch_size", type=int, default=8)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    save_paths = args.save_path or [
+        os.path.splitext(path)[0] + ".wav" for path in args.codes_path
+    ]
+    assert len(save_paths) == len(args.codes_path), "one --save_path per codes file"
+    device = torch.device(args.device)
+    codec = HeartCodec.from_pretrained(
+        os.path.join(args.model_path, "HeartCodec-oss"), device_map=device
+    )
+    jobs = []
+    for codes_path, save_path in zip(args.codes_path, save_paths):
+        if not codes_path.endswith(".hlc"):
+            jobs.append((codes_path, HeartCodec.load_codes(codes_path), save_path))
+            continue
+        archive = CodesArchive(codes_path)
+        root, ext = os.path.splitext(save_path)
+        for i in args.entries or range(len(archive)):
+            jobs.append((f"{codes_path}[{i}]", archive[i], f"{root}_{i}{ext}"))
+
+    for start in range(0, len(jobs), args.batch_size):
+        batch = jobs[start : start + args.batch_size]
+        wavs = codec.detokenize_batch(
+            [codes for _, codes, _ in batch],
+            duration=args.duration,
+            num_steps=args.num_steps,
+            guidance_scale=args.guidance_scale,
+            device=device,
+        )
+        for (name, _, save_path), wav in zip(batch, wavs):
+            sf.write(save_path, wav.float().cpu().numpy().T, codec.sample_rate)
+            print(f"Rendered {name} to {save_path}")
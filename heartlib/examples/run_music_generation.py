@@ -1,4 +1,4 @@
-from heartlib import HeartMuLaGenPipeline
+from heartlib import CodesArchiveWriter, HeartMuLaGenPipeline
 import argparse
 import torch
 
@@ -15,6 +15,20 @@ def parse_args():
     parser.add_argument("--topk", type=int, default=50)
     parser.add_argument("--temperature", type=float, default=1.0)
     parser.add_argument("--cfg_scale", type=float, default=1.5)
+    # audio frames (80 ms each) kept in the backbone KV cache, for long songs
+    parser.add_argument("--kv_window", type=int, default=None)
+    # takes of the same prompt, saved as <save_path root>_<k><ext>
+    parser.add_argument("--num_candidates", type=int, default=1)
+    # CFG only for the first frames / on the first codebooks of every frame
+    parser.add_argument("--cfg_frames", type=int, default=None)
+    parser.add_argument("--cfg_codebooks", type=int, default=None)
+    # save the codes to render them later with render_codes.py; a .hlc path
+    # appends them to a compact CodesArchive (created if missing) instead of
+    # writing a torch .pt file
+    parser.add_argument("--codes_path", type=str, default=None)
+    parser.add_argument("--no_detokenize", action="store_true")
+    # render finished codec windows on a second thread while the LM decodes
+    parser.add_argument("--overlap_codec", action="store_true")
     return parser.parse_args()
 
 
@@ -26,16 +40,39 @@ if __name__ == "__main__":
         dtype=torch.bfloat16,
         version=args.version,
     )
+    params = dict(
+        max_audio_length_ms=args.max_audio_length_ms,
+        topk=args.topk,
+        temperature=args.temperature,
+        cfg_scale=args.cfg_scale,
+        kv_window=args.kv_window,
+        num_candidates=args.num_candidates,
+        cfg_frames=args.cfg_frames,
+        cfg_codebooks=args.cfg_codebooks,
+    )
+    archive = args.codes_path is not None and args.codes_path.endswith(".hlc")
     with torch.no_grad():
-        pipe(
+        codes = pipe(
             {
                 "lyrics": args.lyrics,
                 "tags": args.tags,
             },
-            max_audio_length_ms=args.max_audio_length_ms,
             save_path=args.save_path,
-            topk=args.topk,
-            temperature=args.temperature,
-            cfg_scale=args.cfg_scale,
+            codes_path=None if archive else args.codes_path,
+            detokenize=not args.no_detokenize,
+            overlap_codec=args.overlap_codec,
+            **params,
         )
-    print(f"Generated music saved to {args.save_path}")
+    if archive:
+        with CodesArchiveWriter(
+            args.codes_path, pipe.config, params, append=True
+        ) as writer:
+            # the footer keeps the latest params, every entry its own
+            for candidate in codes if isinstance(codes, list) else [codes]:
+                writer.add(
+                    candidate, tags=args.tags, lyrics=args.lyrics, params=params
+                )
+    if not args.no_detokenize:
+        print(f"Generated music saved to {args.save_path}")
+    if args.codes_path is not None:
+        print(f"Audio codes saved to {args.codes_path}")
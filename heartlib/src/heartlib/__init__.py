@@ -1,7 +1,12 @@
 from .pipelines.music_generation import HeartMuLaGenPipeline
 from .pipelines.lyrics_transcription import HeartTranscriptorPipeline
+from .pipelines.scheduler import ContinuousBatchingScheduler
+from .heartcodec.codes_archive import CodesArchive, CodesArchiveWriter
 
 __all__ = [
     "HeartMuLaGenPipeline",
-    "HeartTranscriptorPipeline"
+    "HeartTranscriptorPipeline",
+    "ContinuousBatchingScheduler",
+    "CodesArchive",
+    "CodesArchiveWriter",
 ]
\ No newline at end of file
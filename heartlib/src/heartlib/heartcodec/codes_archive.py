@@ -0,0 +1,194 @@
+import dataclasses
+import json
+import os
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+
+_MAGIC = b"HLCODES1"
+_ALIGN = 64
+# per entry: byte offset, byte size, num_quantizers, num_frames, encoding
+_INDEX_FIELDS = 5
+_ENCODINGS = ("raw", "zlib", "delta-zlib")
+
+
+def _to_json(value) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    return dict(value)
+
+
+def _read_footer(data: np.ndarray, path: str) -> Dict[str, Any]:
+    tail = len(_MAGIC) + 8
+    assert (
+        bytes(data[: len(_MAGIC)]) == _MAGIC and bytes(data[-len(_MAGIC) :]) == _MAGIC
+    ), f"{path} is not a codes archive"
+    footer_len = int(data[-tail : -len(_MAGIC)].view("<u8")[0])
+    return json.loads(bytes(data[-tail - footer_len : -tail]))
+
+
+def _read_index(data: np.ndarray, footer: Dict[str, Any]) -> np.ndarray:
+    offset, n = footer["index_offset"], footer["num_entries"]
+    index = data[offset : offset + n * _INDEX_FIELDS * 8]
+    return index.view("<i8").reshape(n, _INDEX_FIELDS)
+
+
+class CodesArchiveWriter:
+    """Append-only file of audio codes, read back with ``CodesArchive``.
+
+    Codes are stored as little-endian int16 (every code is below
+    ``audio_vocab_size``): 16 bytes per 80 ms frame, against 64 for the int64
+    frames the pipeline returns and 15 kB for 16-bit stereo 48 kHz PCM. Entries
+    are 64-byte aligned.
+
+    ``encoding`` is one of
+      - ``"raw"``: plain int16 [num_quantizers, T], read back zero-copy
+      - ``"zlib"``: zlib-compressed int16
+      - ``"delta-zlib"``: zlib over the int16 differences along time
+
+    ``config`` (e.g. the pipeline's ``HeartMuLaGenConfig``) and ``params`` (the
+    generation arguments) go into the footer together with the ``meta`` of every
+    entry, the index for random access sits right before it.
+
+    With ``append=True`` an existing archive is reopened: its entries are kept,
+    new ones are written over the old index and ``close`` writes the extended
+    index and footer. ``config`` and ``params`` replace the stored ones unless
+    they are ``None``. A missing file is created as usual.
+
+    Example:
+        >>> with CodesArchiveWriter("songs.hlc", pipe.config, {"cfg_scale": 1.5}) as w:
+        ...     w.add(pipe(inputs, detokenize=False), tags=inputs["tags"])
+    """
+
+    def __init__(
+        self,
+        path: str,
+        config: Optional[Any] = None,
+        params: Optional[Dict[str, Any]] = None,
+        encoding: str = "raw",
+        append: bool = False,
+    ):
+        assert encoding in _ENCODINGS, f"encoding must be one of {_ENCODINGS}"
+        self.path = path
+        self.config = _to_json(config)
+        self.params = _to_json(params)
+        self.encoding = encoding
+        self._index: List[List[int]] = []
+        self._meta: List[Dict[str, Any]] = []
+        if append and os.path.exists(path):
+            data = np.fromfile(path, dtype=np.uint8)
+            footer = _read_footer(data, path)
+            self._index = _read_index(data, footer).tolist()
+            self._meta = footer["meta"]
+            self.config = self.config if config is not None else footer["config"]
+            self.params = self.params if params is not None else footer["params"]
+            # entries end before the old index, which close writes anew
+            self._fp = open(path, "r+b")
+            self._fp.seek(footer["index_offset"])
+            self._fp.truncate()
+        else:
+            self._fp = open(path, "wb")
+            self._fp.write(_MAGIC)
+
+    def _align(self) -> int:
+        offset = self._fp.tell()
+        padding = -offset % _ALIGN
+        self._fp.write(b"\0" * padding)
+        return offset + padding
+
+    def add(self, codes: torch.Tensor, **meta) -> int:
+        """append codes [num_quantizers, T], return their index in the archive"""
+        assert codes.dim() == 2, f"expected [num_quantizers, T], got {codes.shape}"
+        codes = codes.detach().cpu()
+        if codes.numel() > 0:
+            assert (
+                0 <= int(codes.min()) and int(codes.max()) < 2**15
+            ), "codes must fit in int16"
+        array = codes.numpy().astype("<i2")
+        if self.encoding == "raw":
+            payload = array.tobytes()
+        else:
+            if self.encoding == "delta-zlib":
+                # wraps around like the int16 cumsum that undoes it
+                array = np.diff(array, axis=1, prepend=np.zeros_like(array[:, :1]))
+            payload = zlib.compress(array.tobytes(), 9)
+
+        offset = self._align()
+        self._fp.write(payload)
+        self._index.append(
+            [offset, len(payload), *array.shape, _ENCODINGS.index(self.encoding)]
+        )
+        self._meta.append(meta)
+        return len(self._index) - 1
+
+    def close(self) -> None:
+        if self._fp.closed:
+            return
+        index_offset = self._align()
+        index = np.asarray(self._index, dtype="<i8").reshape(-1, _INDEX_FIELDS)
+        self._fp.write(index.tobytes())
+        footer = json.dumps(
+            {
+                "index_offset": index_offset,
+                "num_entries": len(self._index),
+                "config": self.config,
+                "params": self.params,
+                "meta": self._meta,
+            },
+            default=str,
+        ).encode("utf-8")
+        self._fp.write(footer)
+        self._fp.write(np.uint64(len(footer)).astype("<u8").tobytes())
+        self._fp.write(_MAGIC)
+        self._fp.close()
+
+    def __enter__(self) -> "CodesArchiveWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class CodesArchive:
+    """Memory-mapped reader of a ``CodesArchiveWriter`` file.
+
+    ``archive[i]`` is the int16 codes [num_quantizers, T] of entry ``i``. Raw
+    entries are views of the mapped file (copy-on-write, nothing is read until
+    the pages are touched); compressed ones are decoded on access. The tensors
+    can go straight to ``HeartCodec.detokenize``.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode="c")
+        footer = _read_footer(self._data, path)
+        self.config: Dict[str, Any] = footer["config"]
+        self.params: Dict[str, Any] = footer["params"]
+        self.meta: List[Dict[str, Any]] = footer["meta"]
+        self.index = _read_index(self._data, footer)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def num_frames(self, i: int) -> int:
+        return int(self.index[i, 3])
+
+    def __getitem__(self, i: int) -> torch.Tensor:
+        offset, nbytes, num_quantizers, num_frames, encoding = self.index[i].tolist()
+        payload = self._data[offset : offset + nbytes]
+        shape = (num_quantizers, num_frames)
+        if _ENCODINGS[encoding] == "raw":
+            return torch.from_numpy(payload.view("<i2").reshape(shape))
+        array = np.frombuffer(bytearray(zlib.decompress(payload)), dtype="<i2")
+        array = array.reshape(shape)
+        if _ENCODINGS[encoding] == "delta-zlib":
+            array = np.cumsum(array, axis=1, dtype="<i2")
+        return torch.from_numpy(array)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -3,8 +3,11 @@ from .models.flow_matching import FlowMatching
 from .models.sq_codec import ScalarModel
 from .configuration_heartcodec import HeartCodecConfig
 from transformers.modeling_utils import PreTrainedModel
+from contextlib import nullcontext
 import math
 import numpy as np
+import queue
+import threading
 
 
 class HeartCodec(PreTrainedModel):
@@ -63,119 +66,493 @@ class HeartCodec(PreTrainedModel):
         disable_progress=False,
         guidance_scale=1.25,
         device="cuda",
+        solver="euler",
+        schedule="uniform",
+        shift=1.0,
+        guidance_interval=None,
+        uncond_every=1,
+        uncond_extrapolate=False,
+        cache_interval=1,
+        cache_depth=0,
+        generator=None,
     ):
-        codes = codes.unsqueeze(0).to(device)
-        first_latent = torch.randn(codes.shape[0], int(duration * 25), 256).to(
+        """render codes [num_quantizers, T] to a [channels, samples] wav
+
+        Every window's flow is integrated by ``solver`` ("euler", "heun",
+        "midpoint" or "ab2") in ``num_steps`` steps of a ``schedule``
+        ("uniform" or "cosine") with timestep ``shift``, see ``time_schedule``.
+
+        CFG costs a second estimator pass. ``guidance_interval`` (start, end)
+        limits it to the ODE times in [start, end), 0 being noise, e.g.
+        (0.0, 0.5) guides the first half of the steps only. ``uncond_every``
+        > 1 runs the unconditional branch on every n-th evaluation and reuses
+        its velocity in between, extrapolated with ``uncond_extrapolate``.
+
+        ``cache_interval`` > 1 runs the estimator's first stage fully on every
+        n-th call only and recomputes just its first ``cache_depth`` blocks in
+        between, see ``FeatureCache``.
+
+        The noise of the solves is drawn from ``generator``, a CPU
+        ``torch.Generator``, or from the global RNG if it is None.
+        """
+        stream = self.detokenize_stream(
+            duration=duration,
+            num_steps=num_steps,
+            disable_progress=disable_progress,
+            guidance_scale=guidance_scale,
+            device=device,
+            solver=solver,
+            schedule=schedule,
+            shift=shift,
+            guidance_interval=guidance_interval,
+            uncond_every=uncond_every,
+            uncond_extrapolate=uncond_extrapolate,
+            cache_interval=cache_interval,
+            cache_depth=cache_depth,
+            generator=generator,
+        )
+        return DetokenizeStream._cat([stream.push(codes), stream.flush()])
+
+    @torch.inference_mode()
+    def detokenize_batch(self, codes, max_batch_size=None, generators=None, **kwargs):
+        """``detokenize`` a list of [num_quantizers, T_i] codes, one wav per song
+
+        The songs are rendered in lockstep: window k of every song that has one
+        goes through a single flow-matching solve, so the estimator runs at
+        batch 2 * songs instead of 2. At most
+        ``max_batch_size`` songs are rendered together. ``generators`` holds
+        one ``generator`` per song; ``kwargs`` are those of ``detokenize``.
+        """
+        max_batch_size = max_batch_size or max(len(codes), 1)
+        generators = generators or [None] * len(codes)
+        wavs = []
+        for start in range(0, len(codes), max_batch_size):
+            streams = []
+            for song_codes, generator in zip(
+                codes[start : start + max_batch_size],
+                generators[start : start + max_batch_size],
+            ):
+                stream = self.detokenize_stream(generator=generator, **kwargs)
+                stream._append(song_codes)
+                streams.append(stream)
+            wavs.extend(DetokenizeStream.flush_all(streams))
+        return wavs
+
+    @staticmethod
+    def load_codes(path: str) -> torch.Tensor:
+        """codes [num_quantizers, T] saved with ``codes_path`` by the pipeline"""
+        return torch.load(path, map_location="cpu")
+
+    def render(self, codes, **kwargs):
+        """``detokenize`` codes that were generated earlier, e.g. on another machine
+
+        ``codes`` is a [num_quantizers, T] tensor, e.g. an entry of a
+        ``CodesArchive``, or a file written by ``HeartMuLaGenPipeline`` with
+        ``codes_path``; ``kwargs`` are those of ``detokenize``.
+        """
+        if isinstance(codes, str):
+            codes = self.load_codes(codes)
+        return self.detokenize(codes, **kwargs)
+
+    def detokenize_stream(
+        self,
+        duration=29.76,
+        num_steps=10,
+        disable_progress=False,
+        guidance_scale=1.25,
+        device="cuda",
+        solver="euler",
+        schedule="uniform",
+        shift=1.0,
+        guidance_interval=None,
+        uncond_every=1,
+        uncond_extrapolate=False,
+        cache_interval=1,
+        cache_depth=0,
+        generator=None,
+    ):
+        return DetokenizeStream(
+            self,
+            duration=duration,
+            num_steps=num_steps,
+            disable_progress=disable_progress,
+            guidance_scale=guidance_scale,
+            device=device,
+            solver=solver,
+            schedule=schedule,
+            shift=shift,
+            guidance_interval=guidance_interval,
+            uncond_every=uncond_every,
+            uncond_extrapolate=uncond_extrapolate,
+            cache_interval=cache_interval,
+            cache_depth=cache_depth,
+            generator=generator,
+        )
+
+    def detokenize_worker(self, num_songs, max_queue=8, generators=None, **kwargs):
+        return DetokenizeWorker(
+            self, num_songs, max_queue=max_queue, generators=generators, **kwargs
+        )
+
+
+class DetokenizeStream:
+    """Incremental ``HeartCodec.detokenize``.
+
+    Codes are pushed as they are generated; every window of ``duration`` seconds
+    is rendered as soon as it is complete and the part of the waveform that the
+    next crossfade can no longer touch is returned. ``push`` followed by
+    ``flush`` yields exactly the output of ``detokenize`` on the full codes.
+    """
+
+    def __init__(
+        self,
+        codec: HeartCodec,
+        duration=29.76,
+        num_steps=10,
+        disable_progress=False,
+        guidance_scale=1.25,
+        device="cuda",
+        solver="euler",
+        schedule="uniform",
+        shift=1.0,
+        guidance_interval=None,
+        uncond_every=1,
+        uncond_extrapolate=False,
+        cache_interval=1,
+        cache_depth=0,
+        generator=None,
+    ):
+        self.codec = codec
+        self.num_steps = num_steps
+        self.disable_progress = disable_progress
+        self.guidance_scale = guidance_scale
+        self.device = device
+        self.solver = solver
+        self.schedule = schedule
+        self.shift = shift
+        self.guidance_interval = guidance_interval
+        self.uncond_every = uncond_every
+        self.uncond_extrapolate = uncond_extrapolate
+        self.cache_interval = cache_interval
+        self.cache_depth = cache_depth
+        self.generator = generator
+
+        self.first_latent = torch.randn(
+            1, int(duration * 25), 256, generator=generator
+        ).to(
             device
         )  # B, T, 64
-        first_latent_length = 0
-        first_latent_codes_length = 0
-        min_samples = int(duration * 12.5)
-        hop_samples = min_samples // 93 * 80
-        ovlp_samples = min_samples - hop_samples
-        ovlp_frames = ovlp_samples * 2
+        self.first_latent_length = 0
+        self.first_latent_codes_length = 0
+        self.min_samples = int(duration * 12.5)
+        self.hop_samples = self.min_samples // 93 * 80
+        self.ovlp_samples = self.min_samples - self.hop_samples
+        self.ovlp_frames = self.ovlp_samples * 2
+        self.latent_length = int(duration * 25)
+
+        self.wav_min_samples = int(duration * codec.sample_rate)
+        self.wav_hop_samples = self.wav_min_samples // 93 * 80
+        self.wav_ovlp_samples = self.wav_min_samples - self.wav_hop_samples
+
+        self.codes = None
+        self.sinx = 0
+        self.prev_latent = None
+        self.pending = None
+        self.emitted = 0
+
+    @torch.inference_mode()
+    def push(self, codes):
+        """add [num_quantizers, T] codes, return the newly finished [C, samples] audio
+
+        Any integer dtype works, e.g. the int16 codes of a ``CodesArchive``.
+        """
+        self._append(codes)
+        chunks = []
+        while self.sinx + self.min_samples <= self.codes.shape[-1]:
+            chunks.append(self._render_segment(self.codes))
+        return self._cat(chunks)
+
+    def _append(self, codes):
+        codes = codes.unsqueeze(0).to(self.device, torch.long)
+        if self.codes is None:
+            self.codes = codes
+        else:
+            self.codes = torch.cat([self.codes, codes], -1)
+
+    @torch.inference_mode()
+    def flush(self):
+        """render the remaining (repeat-padded) windows and return the tail audio"""
+        return self.flush_all([self])[0]
+
+    @staticmethod
+    @torch.inference_mode()
+    def flush_all(streams):
+        """``flush`` streams of the same settings, their windows rendered batched"""
+        tails = [stream._padded_codes() for stream in streams]
+        emitted = [stream.emitted for stream in streams]
+        chunks = [[] for _ in streams]
+        while True:
+            active = [
+                i
+                for i, (stream, (codes, _)) in enumerate(zip(streams, tails))
+                if stream.sinx <= codes.shape[-1] - stream.hop_samples
+            ]
+            if not active:
+                break
+            outputs = DetokenizeStream._render_segments(
+                [streams[i] for i in active], [tails[i][0] for i in active]
+            )
+            for i, output in zip(active, outputs):
+                chunks[i].append(output)
+
+        outputs = []
+        for i, stream in enumerate(streams):
+            chunks[i].append(stream.pending)
+            stream.pending = None
+            output = stream._cat(chunks[i])
+            output = output[:, 0 : max(tails[i][1] - emitted[i], 0)]
+            stream.emitted = emitted[i] + output.shape[-1]
+            outputs.append(output)
+        return outputs
+
+    def _padded_codes(self):
+        """codes repeat-padded to whole windows, and the number of samples to keep"""
+        codes = self.codes
         codes_len = codes.shape[-1]  #
         target_len = int(
-            (codes_len - first_latent_codes_length) / 12.5 * self.sample_rate
+            (codes_len - self.first_latent_codes_length)
+            / 12.5
+            * self.codec.sample_rate
         )
 
         # code repeat
-        if codes_len < min_samples:
-            while codes.shape[-1] < min_samples:
+        if codes_len < self.min_samples:
+            while codes.shape[-1] < self.min_samples:
                 codes = torch.cat([codes, codes], -1)
-            codes = codes[:, :, 0:min_samples]
+            codes = codes[:, :, 0 : self.min_samples]
         codes_len = codes.shape[-1]
-        if (codes_len - ovlp_frames) % hop_samples > 0:
+        if (codes_len - self.ovlp_frames) % self.hop_samples > 0:
             len_codes = (
-                math.ceil((codes_len - ovlp_samples) / float(hop_samples)) * hop_samples
-                + ovlp_samples
+                math.ceil((codes_len - self.ovlp_samples) / float(self.hop_samples))
+                * self.hop_samples
+                + self.ovlp_samples
             )
             while codes.shape[-1] < len_codes:
                 codes = torch.cat([codes, codes], -1)
             codes = codes[:, :, 0:len_codes]
-        latent_length = int(duration * 25)
-        latent_list = []
-
-        for sinx in range(0, codes.shape[-1] - hop_samples + 1, hop_samples):
-            codes_input = []
-            codes_input.append(codes[:, :, sinx : sinx + min_samples])
-            if sinx == 0 or ovlp_frames == 0:
-                incontext_length = first_latent_length
-                latents = self.flow_matching.inference_codes(
-                    codes_input,
-                    first_latent,
-                    latent_length,
-                    incontext_length,
-                    guidance_scale=guidance_scale,
-                    num_steps=num_steps,
-                    disable_progress=disable_progress,
-                    scenario="other_seg",
-                )
-                latent_list.append(latents)
-            else:
-                true_latent = latent_list[-1][:, -ovlp_frames:, :]
-                len_add_to_latent = latent_length - true_latent.shape[1]  #
-                incontext_length = true_latent.shape[1]
-                true_latent = torch.cat(
-                    [
-                        true_latent,
-                        torch.randn(
-                            true_latent.shape[0],
-                            len_add_to_latent,
-                            true_latent.shape[-1],
-                        ).to(device),
-                    ],
-                    1,
-                )
-                latents = self.flow_matching.inference_codes(
-                    codes_input,
-                    true_latent,
-                    latent_length,
-                    incontext_length,
-                    guidance_scale=guidance_scale,
-                    num_steps=num_steps,
-                    disable_progress=disable_progress,
-                    scenario="other_seg",
-                )
-                latent_list.append(latents)
-
-        latent_list = [l.float() for l in latent_list]
-        latent_list[0] = latent_list[0][:, first_latent_length:, :]
-        min_samples = int(duration * self.sample_rate)
-        hop_samples = min_samples // 93 * 80
-        ovlp_samples = min_samples - hop_samples
-
-        output = None
-        for i in range(len(latent_list)):
-            latent = latent_list[i]
-            bsz, t, f = latent.shape
-
-            latent = latent.reshape(
-                latent.shape[0], latent.shape[1], 2, latent.shape[2] // 2
-            ).permute(0, 2, 1, 3)
-            latent = latent.reshape(
-                latent.shape[0] * 2, latent.shape[2], latent.shape[3]
+        return codes, target_len
+
+    def _render_segment(self, codes):
+        return self._render_segments([self], [codes])[0]
+
+    @staticmethod
+    def _render_segments(streams, codes):
+        """render the next window of every stream, batched by window shape"""
+        inputs = [stream._segment_inputs(c) for stream, c in zip(streams, codes)]
+        outputs = [None] * len(streams)
+        # the first window of a song has a different in-context length
+        for incontext_length in dict.fromkeys(x[3] for x in inputs):
+            group = [i for i, x in enumerate(inputs) if x[3] == incontext_length]
+            first = streams[group[0]]
+            latents = first.codec.flow_matching.inference_codes(
+                [torch.cat([inputs[i][0] for i in group])],
+                torch.cat([inputs[i][1] for i in group]),
+                first.latent_length,
+                incontext_length,
+                noise=torch.cat([inputs[i][2] for i in group]),
+                guidance_scale=first.guidance_scale,
+                num_steps=first.num_steps,
+                disable_progress=first.disable_progress,
+                scenario="other_seg",
+                solver=first.solver,
+                schedule=first.schedule,
+                shift=first.shift,
+                guidance_interval=first.guidance_interval,
+                uncond_every=first.uncond_every,
+                uncond_extrapolate=first.uncond_extrapolate,
+                cache_interval=first.cache_interval,
+                cache_depth=first.cache_depth,
             )
-            cur_output = (
-                self.scalar_model.decode(latent.transpose(1, 2)).squeeze(0).squeeze(1)
-            )  # 1 512 256
-
-            cur_output = cur_output[:, 0:min_samples].detach().cpu()  # B, T
-            if cur_output.dim() == 3:
-                cur_output = cur_output[0]
-
-            if output is None:
-                output = cur_output
-            else:
-                if ovlp_samples == 0:
-                    output = torch.cat([output, cur_output], -1)
-                else:
-                    ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
-                    ov_win = torch.cat([ov_win, 1 - ov_win], -1)
-                    output[:, -ovlp_samples:] = (
-                        output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:]
-                        + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
-                    )
-                    output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
-        output = output[:, 0:target_len]
-        return output
+            # the vocoder's activations are large and gain little from batching
+            for k, i in enumerate(group):
+                latent = streams[i]._finish_segment(latents[k : k + 1])
+                outputs[i] = streams[i]._overlap_add(streams[i]._decode_latent(latent))
+        return outputs
+
+    def _segment_inputs(self, codes):
+        """codes, latents, noise and in-context length of the next window's solve"""
+        codes_input = codes[:, :, self.sinx : self.sinx + self.min_samples]
+        if self.sinx == 0 or self.ovlp_frames == 0:
+            true_latent = self.first_latent
+            return (
+                codes_input,
+                true_latent,
+                self._noise(codes_input, true_latent),
+                self.first_latent_length,
+            )
+        true_latent = self.prev_latent[:, -self.ovlp_frames :, :]
+        len_add_to_latent = self.latent_length - true_latent.shape[1]  #
+        incontext_length = true_latent.shape[1]
+        true_latent = torch.cat(
+            [
+                true_latent,
+                torch.randn(
+                    true_latent.shape[0],
+                    len_add_to_latent,
+                    true_latent.shape[-1],
+                    generator=self.generator,
+                ).to(self.device),
+            ],
+            1,
+        )
+        noise = self._noise(codes_input, true_latent)
+        return codes_input, true_latent, noise, incontext_length
+
+    def _noise(self, codes_input, true_latent):
+        """the solver's starting noise, two latent frames per code frame"""
+        return torch.randn(
+            true_latent.shape[0],
+            codes_input.shape[-1] * 2,
+            self.codec.flow_matching.latent_dim,
+            generator=self.generator,
+        ).to(self.device, true_latent.dtype)
+
+    def _finish_segment(self, latents):
+        """keep the solved window for the next overlap, return its latent to decode"""
+        sinx = self.sinx
+        self.prev_latent = latents
+        self.sinx += self.hop_samples
+
+        latent = latents.float()
+        if sinx == 0:
+            latent = latent[:, self.first_latent_length :, :]
+        return latent
+
+    def _decode_latent(self, latent):
+        bsz, t, f = latent.shape
+
+        latent = latent.reshape(
+            latent.shape[0], latent.shape[1], 2, latent.shape[2] // 2
+        ).permute(0, 2, 1, 3)
+        latent = latent.reshape(latent.shape[0] * 2, latent.shape[2], latent.shape[3])
+        cur_output = (
+            self.codec.scalar_model.decode(latent.transpose(1, 2))
+            .squeeze(0)
+            .squeeze(1)
+        )  # 1 512 256
+
+        cur_output = cur_output[:, 0 : self.wav_min_samples].detach().cpu()  # B, T
+        if cur_output.dim() == 3:
+            cur_output = cur_output[0]
+        return cur_output
+
+    def _overlap_add(self, cur_output):
+        ovlp_samples = self.wav_ovlp_samples
+        if self.pending is None:
+            output = cur_output
+        elif ovlp_samples == 0:
+            output = torch.cat([self.pending, cur_output], -1)
+        else:
+            output = self.pending
+            ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
+            ov_win = torch.cat([ov_win, 1 - ov_win], -1)
+            output[:, -ovlp_samples:] = (
+                output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:]
+                + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
+            )
+            output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
+
+        # only the last ``ovlp_samples`` can still be changed by the next window
+        split = output.shape[-1] - ovlp_samples
+        self.pending = output[:, split:]
+        self.emitted += split
+        return output[:, :split]
+
+    @staticmethod
+    def _cat(chunks):
+        chunks = [c for c in chunks if c is not None and c.numel() > 0]
+        if len(chunks) == 0:
+            return torch.zeros(0, 0)
+        return torch.cat(chunks, -1)
+
+
+class DetokenizeWorker:
+    """``DetokenizeStream``s of ``num_songs`` songs rendered on a background thread.
+
+    The caller keeps generating codes while finished windows go through flow
+    matching and the vocoder, so a song takes about max(LM, codec) instead of
+    LM + codec. ``push`` hands over codes of a song, ``finish`` marks its end and
+    ``join`` waits for the thread and returns one [C, samples] wav per song,
+    the same audio ``detokenize`` renders with the same ``generator``. At most ``max_queue`` pushes
+    wait for the thread; beyond that ``push`` blocks. On CUDA the thread works
+    on its own stream.
+
+    Song j draws its codec noise from ``generators[j]``, so the audio does not
+    depend on how the thread interleaves with the caller. Without them the
+    noise comes from the global RNG the caller may still sample from, and
+    only matches ``detokenize`` if the caller draws nothing meanwhile.
+    """
+
+    def __init__(
+        self, codec: HeartCodec, num_songs, max_queue=8, generators=None, **kwargs
+    ):
+        generators = generators or [None] * num_songs
+        self.streams = [
+            codec.detokenize_stream(generator=generator, **kwargs)
+            for generator in generators
+        ]
+        self.chunks = [[] for _ in range(num_songs)]
+        device = torch.device(kwargs.get("device", "cuda"))
+        self.cuda_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.queue = queue.Queue(max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def push(self, song, codes):
+        """queue [num_quantizers, T] more codes of ``song``"""
+        event = None
+        if self.cuda_stream is not None and codes.is_cuda:
+            # the codes are only valid once the caller's stream got there
+            event = torch.cuda.Event()
+            event.record()
+        self._put((song, codes, event))
+
+    def finish(self, song):
+        self._put((song, None, None))
+
+    def join(self):
+        self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return [DetokenizeStream._cat(chunks) for chunks in self.chunks]
+
+    def _put(self, item):
+        while True:
+            if self.error is not None:
+                raise RuntimeError("detokenize worker failed") from self.error
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        context = nullcontext()
+        if self.cuda_stream is not None:
+            context = torch.cuda.stream(self.cuda_stream)
+        try:
+            with context:
+                while (item := self.queue.get()) is not None:
+                    song, codes, event = item
+                    if codes is None:
+                        self.chunks[song].append(self.streams[song].flush())
+                        continue
+                    if event is not None:
+                        current = torch.cuda.current_stream()
+                        current.wait_event(event)
+                        codes.record_stream(current)
+                    self.chunks[song].append(self.streams[song].push(codes))
+        except BaseException as e:
+            self.error = e
@@ -1,12 +1,164 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from tqdm import tqdm
 from vector_quantize_pytorch import ResidualVQ
-from .transformer import LlamaTransformer
+from .transformer import FeatureCache, LlamaTransformer
+
+
+def time_schedule(num_steps, schedule="uniform", shift=1.0, device=None):
+    """ODE times from 0 (noise) to 1 (data), ``num_steps + 1`` of them
+
+    ``"cosine"`` takes smaller steps at both ends. ``shift`` > 1 moves the steps
+    towards the noise end (and < 1 towards the data end), like the timestep
+    shift of rectified-flow samplers.
+    """
+    assert schedule in ("uniform", "cosine"), f"unknown schedule {schedule}"
+    t_span = torch.linspace(0, 1, num_steps + 1, device=device)
+    if schedule == "cosine":
+        t_span = (1 - torch.cos(math.pi * t_span)) / 2
+    if shift != 1.0:
+        sigma = 1 - t_span
+        t_span = 1 - shift * sigma / (1 + (shift - 1) * sigma)
+    return t_span
+
+
+class _Guidance:
+    """CFG of one ODE solve: the steps it applies to and the cached uncond velocity
+
+    Outside ``interval`` (ODE times, 0 is noise) the estimator runs the
+    conditional branch alone. Inside it, only every ``uncond_every``-th
+    evaluation runs the unconditional branch too; the others reuse its last
+    velocity, or extrapolate linearly from the last two with ``extrapolate``.
+    """
+
+    def __init__(self, scale, interval=None, uncond_every=1, extrapolate=False):
+        assert uncond_every >= 1, "uncond_every must be at least 1"
+        self.scale = scale
+        self.interval = interval
+        self.uncond_every = uncond_every
+        self.extrapolate = extrapolate
+        self.evaluations = 0
+        # (t, velocity) of the latest unconditional evaluations, oldest first
+        self.uncond = []
+
+    def applies(self, t):
+        if self.scale <= 1.0:
+            return False
+        if self.interval is None:
+            return True
+        start, end = self.interval
+        return start <= float(t) < end
+
+    def uncond_due(self):
+        due = not self.uncond or self.evaluations % self.uncond_every == 0
+        self.evaluations += 1
+        return due
+
+    def store(self, t, uncond):
+        if self.uncond_every > 1:
+            self.uncond = (self.uncond + [(t, uncond)])[-2:]
+
+    def cached_uncond(self, t):
+        t1, uncond = self.uncond[-1]
+        if self.extrapolate and len(self.uncond) == 2:
+            t0, uncond_prev = self.uncond[0]
+            return uncond + (uncond - uncond_prev) * ((t - t1) / (t1 - t0))
+        return uncond
+
+
+class _InferencePlan:
+    """step-invariant inputs of one segment's ODE solve
+
+    Built once per segment: the in-context and conditioning channels of the CFG
+    and conditional batches, already through the estimator's input and
+    connection projections, and the AdaLN modulation of every ODE time. A
+    solver step only projects ``x`` and runs the blocks.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        x,
+        incontext_x,
+        incontext_length,
+        mu,
+        t_span,
+        guidance,
+        feature_cache=None,
+    ):
+        self.estimator = estimator
+        self.noise = x.clone()
+        self.incontext_x = incontext_x
+        self.incontext_length = int(incontext_length)
+        self.guidance = guidance
+        self.feature_cache = feature_cache
+        self.dtype = x.dtype
+
+        batch_size, _, num_varying = x.shape
+        if guidance.scale > 1.0:
+            constant = torch.cat(
+                [
+                    torch.cat([incontext_x, incontext_x], 0),
+                    torch.cat([torch.zeros_like(mu), mu], 0),
+                ],
+                2,
+            )
+        else:
+            constant = torch.cat([incontext_x, mu], 2)
+        projections = estimator.split_projections(constant, num_varying)
+        self.projections = {constant.shape[0]: projections}
+        # the conditional batch is the second half of the CFG one
+        self.projections[batch_size] = tuple(
+            (weight, projected[-batch_size:]) for weight, projected in projections
+        )
+
+        self.times = t_span.tolist()
+        modulation = estimator.modulation(t_span, self.dtype)
+        self.modulations = {
+            t: tuple(m[i : i + 1] for m in modulation) for i, t in enumerate(self.times)
+        }
+
+    def pin_incontext(self, x, t):
+        """put the in-context frames of ``x`` on their path from noise at time t"""
+        length = self.incontext_length
+        x[:, 0:length, :] = (1 - (1 - 1e-6) * t) * self.noise[
+            :, 0:length, :
+        ] + t * self.incontext_x[:, 0:length, :]
+
+    def _estimate(self, x, t):
+        if t not in self.modulations:
+            # off the schedule, e.g. the midpoint solver's half steps
+            timestep = torch.tensor([t], device=x.device)
+            self.modulations[t] = self.estimator.modulation(timestep, self.dtype)
+        return self.estimator(
+            x,
+            feature_cache=self.feature_cache,
+            modulation=self.modulations[t],
+            projections=self.projections[x.shape[0]],
+        )
+
+    def velocity(self, x, t):
+        """estimator velocity at time t, guided as ``guidance`` says"""
+        guidance = self.guidance
+        if not guidance.applies(t):
+            return self._estimate(x, t)
+        if guidance.uncond_due():
+            dphi_dt_uncond, dphi_dt_cond = self._estimate(
+                torch.cat([x, x], 0), t
+            ).chunk(2, 0)
+            guidance.store(t, dphi_dt_uncond)
+        else:
+            dphi_dt_uncond = guidance.cached_uncond(t)
+            dphi_dt_cond = self._estimate(x, t)
+        return torch.lerp(dphi_dt_uncond, dphi_dt_cond, guidance.scale)
 
 
 class FlowMatching(nn.Module):
+    # estimator evaluations per step: euler 1, heun 2, midpoint 2, ab2 1
+    solvers = ("euler", "heun", "midpoint", "ab2")
+
     def __init__(
         self,
         # rvq stuff
@@ -64,7 +216,17 @@ class FlowMatching(nn.Module):
         num_steps=20,
         disable_progress=True,
         scenario="start_seg",
+        solver="euler",
+        schedule="uniform",
+        shift=1.0,
+        guidance_interval=None,
+        uncond_every=1,
+        uncond_extrapolate=False,
+        cache_interval=1,
+        cache_depth=0,
+        noise=None,
     ):
+        assert solver in self.solvers, f"solver must be one of {self.solvers}"
         device = true_latents.device
         dtype = true_latents.dtype
         # codes_bestrq_middle, codes_bestrq_last = codes
@@ -82,9 +244,11 @@ class FlowMatching(nn.Module):
         ).permute(0, 2, 1)
 
         num_frames = quantized_feature_emb.shape[1]  #
-        latents = torch.randn(
-            (batch_size, num_frames, self.latent_dim), device=device, dtype=dtype
-        )
+        if noise is None:
+            noise = torch.randn(
+                (batch_size, num_frames, self.latent_dim), device=device, dtype=dtype
+            )
+        latents = noise
         latent_masks = torch.zeros(
             latents.shape[0], latents.shape[1], dtype=torch.int64, device=latents.device
         )
@@ -108,70 +272,87 @@ class FlowMatching(nn.Module):
 
         additional_model_input = torch.cat([quantized_feature_emb], 1)
         temperature = 1.0
-        t_span = torch.linspace(
-            0, 1, num_steps + 1, device=quantized_feature_emb.device
+        t_span = time_schedule(
+            num_steps, schedule, shift, device=quantized_feature_emb.device
         )
-        latents = self.solve_euler(
-            latents * temperature,
+        latents = latents * temperature
+        plan = _InferencePlan(
+            self.estimator,
+            latents,
             incontext_latents,
             incontext_length,
-            t_span,
             additional_model_input,
-            guidance_scale,
+            t_span,
+            _Guidance(
+                guidance_scale, guidance_interval, uncond_every, uncond_extrapolate
+            ),
+            FeatureCache(cache_interval, cache_depth) if cache_interval > 1 else None,
         )
+        latents = getattr(self, f"solve_{solver}")(latents, plan)
 
         latents[:, 0:incontext_length, :] = incontext_latents[
             :, 0:incontext_length, :
         ]  # B, T, dim
         return latents
 
-    def solve_euler(self, x, incontext_x, incontext_length, t_span, mu, guidance_scale):
+    def solve_euler(self, x, plan):
         """
-        Fixed euler solver for ODEs.
+        Fixed euler solver for ODEs, updates ``x`` in place.
         Args:
             x (torch.Tensor): random noise
-            t_span (torch.Tensor): n_timesteps interpolated
-                shape: (n_timesteps + 1,)
-            mu (torch.Tensor): output of encoder
-                shape: (batch_size, n_feats, mel_timesteps)
+                shape: (batch_size, mel_timesteps, n_feats)
+            plan (_InferencePlan): conditioning and times of the solve
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        noise = x.clone()
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
-        for step in tqdm(range(1, len(t_span))):
-            x[:, 0:incontext_length, :] = (1 - (1 - 1e-6) * t) * noise[
-                :, 0:incontext_length, :
-            ] + t * incontext_x[:, 0:incontext_length, :]
-            if guidance_scale > 1.0:
-                dphi_dt = self.estimator(
-                    torch.cat(
-                        [
-                            torch.cat([x, x], 0),
-                            torch.cat([incontext_x, incontext_x], 0),
-                            torch.cat([torch.zeros_like(mu), mu], 0),
-                        ],
-                        2,
-                    ),
-                    timestep=t.unsqueeze(-1).repeat(2),
-                )
-                dphi_dt_uncond, dhpi_dt_cond = dphi_dt.chunk(2, 0)
-                dphi_dt = dphi_dt_uncond + guidance_scale * (
-                    dhpi_dt_cond - dphi_dt_uncond
-                )
-            else:
-                dphi_dt = self.estimator(
-                    torch.cat([x, incontext_x, mu], 2), timestep=t.unsqueeze(-1)
-                )
+        times = plan.times
+        for step in tqdm(range(1, len(times))):
+            t, dt = times[step - 1], times[step] - times[step - 1]
+            plan.pin_incontext(x, t)
+            x.add_(plan.velocity(x, t), alpha=dt)
+        return x
+
+    def solve_heun(self, x, plan):
+        """Heun's method (explicit trapezoid), second order, two evaluations per step"""
+        times = plan.times
+        for step in tqdm(range(1, len(times))):
+            t, t_next = times[step - 1], times[step]
+            dt = t_next - t
+            plan.pin_incontext(x, t)
+            dphi_dt = plan.velocity(x, t)
+            x_next = x + dt * dphi_dt
+            plan.pin_incontext(x_next, t_next)
+            dphi_dt += plan.velocity(x_next, t_next)
+            x.add_(dphi_dt, alpha=0.5 * dt)
+        return x
 
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+    def solve_midpoint(self, x, plan):
+        """explicit midpoint method, second order, two evaluations per step"""
+        times = plan.times
+        for step in tqdm(range(1, len(times))):
+            t, dt = times[step - 1], times[step] - times[step - 1]
+            plan.pin_incontext(x, t)
+            x_mid = x + 0.5 * dt * plan.velocity(x, t)
+            t_mid = t + 0.5 * dt
+            plan.pin_incontext(x_mid, t_mid)
+            x.add_(plan.velocity(x_mid, t_mid), alpha=dt)
+        return x
 
-        result = sol[-1]
+    def solve_ab2(self, x, plan):
+        """two-step Adams-Bashforth, one evaluation per step
 
-        return result
+        Every step after the first (Euler) one extrapolates from the current
+        and the previous velocity, weighted for non-uniform steps.
+        """
+        times = plan.times
+        dphi_dt_prev = dt_prev = None
+        for step in tqdm(range(1, len(times))):
+            t, dt = times[step - 1], times[step] - times[step - 1]
+            plan.pin_incontext(x, t)
+            dphi_dt = plan.velocity(x, t)
+            if dphi_dt_prev is None:
+                x.add_(dphi_dt, alpha=dt)
+            else:
+                ratio = dt / dt_prev
+                x.add_(dphi_dt, alpha=dt * (1 + 0.5 * ratio))
+                x.add_(dphi_dt_prev, alpha=-dt * 0.5 * ratio)
+            dphi_dt_prev, dt_prev = dphi_dt, dt
+        return x
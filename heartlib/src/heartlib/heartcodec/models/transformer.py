@@ -274,13 +274,62 @@ class ProjectLayer(nn.Module):
         )
         self.ffn_2 = nn.Linear(filter_size, filter_size)
 
-    def forward(self, x):
-        x = self.ffn_1(x.transpose(1, 2)).transpose(1, 2)
+    def split(self, constant, varying):
+        """weight of the ``varying`` input channels, ffn_1 output of the others
+
+        ``varying`` is a bool mask over the input channels and ``constant``
+        holds the other channels, in order. ``forward(x, split)`` then takes
+        the varying channels alone and reuses the constant ones' projection.
+        """
+        weight = self.ffn_1.weight
+        constant = F.conv1d(
+            constant.transpose(1, 2),
+            weight[:, ~varying],
+            self.ffn_1.bias,
+            padding=self.ffn_1.padding,
+        ).transpose(1, 2)
+        return weight[:, varying], constant
+
+    def forward(self, x, split=None):
+        if split is None:
+            x = self.ffn_1(x.transpose(1, 2)).transpose(1, 2)
+        else:
+            weight, constant = split
+            x = F.conv1d(x.transpose(1, 2), weight, padding=self.ffn_1.padding)
+            x = x.transpose(1, 2) + constant
         x = x * self.kernel_size**-0.5
         x = self.ffn_2(x)
         return x
 
 
+class FeatureCache:
+    """DeepCache-style reuse of the first stage across ODE steps.
+
+    Neighbouring steps of a solve feed the estimator nearly the same input, so
+    only every ``interval``-th call runs all of ``transformer_blocks``. It
+    stores what the blocks after the first ``depth`` ones added to ``s``; the
+    calls in between run the first ``depth`` blocks and add that residual
+    instead. ``depth=0`` reuses the whole first stage, the second stage always
+    runs. Calls are counted per batch size, since the CFG and conditional-only
+    passes of a solve see different batches.
+
+    One cache serves one solve (``FlowMatching.inference_codes`` makes it).
+    """
+
+    def __init__(self, interval: int = 2, depth: int = 0):
+        assert interval >= 1, "interval must be at least 1"
+        self.interval = interval
+        self.depth = depth
+        self.calls = {}
+        self.residuals = {}
+
+    def reuse(self, batch_size: int) -> bool:
+        """whether this call skips the deep blocks (and counts the call)"""
+        calls = self.calls.get(batch_size, 0)
+        self.calls[batch_size] = calls + 1
+        return batch_size in self.residuals and calls % self.interval != 0
+
+
 class LlamaTransformer(nn.Module):
     def __init__(
         self,
@@ -351,22 +400,71 @@ class LlamaTransformer(nn.Module):
         self.adaln_single = AdaLayerNormSingleFlow(inner_dim)
         self.adaln_single_2 = AdaLayerNormSingleFlow(inner_dim_2)
 
+    def modulation(self, timestep: torch.Tensor, dtype: torch.dtype):
+        """AdaLN inputs of both stages for ``timestep`` [n], see ``forward``"""
+        timestep_mod, embedded_timestep = self.adaln_single(
+            timestep, hidden_dtype=dtype
+        )
+        timestep_mod_2, embedded_timestep_2 = self.adaln_single_2(
+            timestep, hidden_dtype=dtype
+        )
+        return timestep_mod, embedded_timestep, timestep_mod_2, embedded_timestep_2
+
+    def split_projections(self, constant: torch.Tensor, num_varying: int):
+        """project the constant ``hidden_states[..., num_varying:]`` once"""
+        varying = torch.zeros(
+            self.in_channels, dtype=torch.bool, device=constant.device
+        )
+        varying[:num_varying] = True
+        varying_2 = F.pad(varying, (0, self.inner_dim), value=True)
+        return (
+            self.proj_in.split(constant, varying),
+            self.connection_proj.split(constant, varying_2),
+        )
+
     def forward(
         self,
         hidden_states: torch.Tensor,
         timestep: Optional[torch.LongTensor] = None,
+        feature_cache: Optional[FeatureCache] = None,
+        modulation: Optional[Tuple[torch.Tensor, ...]] = None,
+        projections: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
     ):
-        s = self.proj_in(hidden_states)
+        """velocity of ``hidden_states`` [b, T, in_channels] at ``timestep`` [b]
+
+        A ``modulation`` of a single timestep replaces ``timestep``. With
+        ``projections`` of the constant channels ``hidden_states`` holds only
+        the leading, varying ones.
+        """
+        proj_in_split = connection_split = None
+        if projections is not None:
+            proj_in_split, connection_split = projections
+        s = self.proj_in(hidden_states, proj_in_split)
 
         embedded_timestep = None
         timestep_mod = None
-        if self.adaln_single is not None and timestep is not None:
+        if modulation is not None:
+            timestep_mod = modulation[0].expand(s.shape[0], -1)
+            embedded_timestep = modulation[1]
+        elif self.adaln_single is not None and timestep is not None:
             batch_size = s.shape[0]
             timestep_mod, embedded_timestep = self.adaln_single(
                 timestep, hidden_dtype=s.dtype
             )
-        for blk in self.transformer_blocks:
+        depth = len(self.transformer_blocks)
+        if feature_cache is not None:
+            depth = feature_cache.depth
+            reuse = feature_cache.reuse(s.shape[0])
+        for blk in self.transformer_blocks[:depth]:
             s = blk(s, timestep=timestep_mod)
+        if feature_cache is not None:
+            if reuse:
+                s = s + feature_cache.residuals[s.shape[0]]
+            else:
+                shallow = s
+                for blk in self.transformer_blocks[depth:]:
+                    s = blk(s, timestep=timestep_mod)
+                feature_cache.residuals[s.shape[0]] = s - shallow
 
         if embedded_timestep is None:
             embedded_timestep = torch.zeros(
@@ -380,11 +478,14 @@ class LlamaTransformer(nn.Module):
         s = s * (1 + scale) + shift
 
         x = torch.cat([hidden_states, s], dim=-1)
-        x = self.connection_proj(x)
+        x = self.connection_proj(x, connection_split)
 
         embedded_timestep_2 = None
         timestep_mod_2 = None
-        if self.adaln_single_2 is not None and timestep is not None:
+        if modulation is not None:
+            timestep_mod_2 = modulation[2].expand(x.shape[0], -1)
+            embedded_timestep_2 = modulation[3]
+        elif self.adaln_single_2 is not None and timestep is not None:
             batch_size = x.shape[0]
             timestep_mod_2, embedded_timestep_2 = self.adaln_single_2(
                 timestep, hidden_dtype=x.dtype
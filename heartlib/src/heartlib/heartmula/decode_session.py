@@ -0,0 +1,245 @@
+from typing import Optional
+
+import torch
+
+from .modeling_heartmula import (
+    HeartMuLa,
+    _causal_mask,
+    _decoder_rows,
+    _inference_only,
+    _padded_causal_mask,
+)
+from .sampling import SamplingParams
+
+_SAMPLING_FIELDS = ("temperature", "topk", "top_p", "min_p")
+
+
+def _sampling_signature(sampling: SamplingParams):
+    """what a compiled step specializes on: scalar values, tensor shapes"""
+    signature = [sampling.max_topk, sampling.generators is None]
+    for name in _SAMPLING_FIELDS:
+        value = getattr(sampling, name)
+        if isinstance(value, torch.Tensor):
+            signature.append((tuple(value.shape), value.dtype, value.device))
+        else:
+            signature.append(value)
+    return tuple(signature)
+
+
+class DecodeSession:
+    """Static-shape single-frame decode step of ``HeartMuLa``.
+
+    ``generate_frame`` allocates its CFG masks, embedding lookups and batch
+    indices on every call. It also branches on Python values that depend on
+    the inputs. A session fixes the batch size, sampling settings and padding
+    up front and keeps positions in preallocated buffers. ``step`` then does
+    the same work as ``generate_frame`` for one frame with only static shapes,
+    so it can run under ``torch.compile`` (inductor on CPU and GPU). Eager
+    steps sample exactly like ``generate_frame``.
+
+    Eager steps attend to the filled backbone cache entries without a mask.
+    Compiled steps switch the caches to device-side positions and pass a
+    causal mask over the whole cache instead, so their shapes stay the same
+    from step to step.
+
+    The codebooks of a frame are sampled by the model's ``depth_engine``, or by
+    the generic loop of ``HeartMuLa.sample_frame`` when it is ``None``.
+    ``cfg_codebooks`` limits CFG to the first codebooks of every frame, see
+    ``DepthDecoderEngine``.
+
+    The model's backbone caches must hold the prompt before ``start``.
+    """
+
+    def __init__(
+        self,
+        model: HeartMuLa,
+        batch_size: int,
+        sampling: SamplingParams,
+        cfg_scale: float,
+        pad_lens: Optional[torch.Tensor] = None,
+        cfg_codebooks: Optional[int] = None,
+    ):
+        self.model = model
+        self.batch_size = batch_size
+        self.sampling = sampling
+        self.cfg_scale = cfg_scale
+        self.cfg_codebooks = cfg_codebooks
+        self.padded = pad_lens is not None
+
+        device = next(model.parameters()).device
+        dtype = model.audio_embeddings.weight.dtype
+        n = model.config.audio_num_codebooks
+        self.codebook_offsets = model.config.audio_vocab_size * torch.arange(
+            n, device=device
+        )
+        # the text column of a decode step is masked out, i.e. always zero
+        self.text_slot = torch.zeros(
+            batch_size, 1, model.audio_embeddings.embedding_dim, dtype=dtype, device=device
+        )
+        self.input_pos = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+        self.cache_pos = torch.zeros(1, dtype=torch.long, device=device)
+        self.pad_lens = (
+            pad_lens.to(device).clone()
+            if self.padded
+            else torch.zeros(batch_size, dtype=torch.long, device=device)
+        )
+        self.engine = model.depth_engine
+        self.decoder_rows = _decoder_rows(batch_size, cfg_scale, cfg_codebooks)
+        self._setup_engine()
+        self._step = self._decode_step
+        self.compiled = False
+
+    def matches(
+        self,
+        batch_size: int,
+        sampling: SamplingParams,
+        cfg_scale: float,
+        padded: bool,
+        cfg_codebooks: Optional[int] = None,
+    ) -> bool:
+        """whether ``start`` can reuse this session (and its compiled step)"""
+        if _inference_only(self.input_pos):
+            return False
+        if self.engine is not self.model.depth_engine:
+            return False
+        signature = (
+            batch_size,
+            _sampling_signature(sampling),
+            cfg_scale,
+            padded,
+            cfg_codebooks,
+        )
+        return signature == (
+            self.batch_size,
+            _sampling_signature(self.sampling),
+            self.cfg_scale,
+            self.padded,
+            self.cfg_codebooks,
+        )
+
+    def compile(self, **compile_kwargs) -> "DecodeSession":
+        compile_kwargs.setdefault("dynamic", False)
+        self._step = torch.compile(self._decode_step, **compile_kwargs)
+        self.compiled = True
+        return self
+
+    def start(
+        self,
+        input_pos: torch.Tensor,
+        cache_pos: int,
+        pad_lens: Optional[torch.Tensor] = None,
+        sampling: Optional[SamplingParams] = None,
+    ) -> None:
+        """position of the first decode step: ``input_pos`` [b, 1] and cache index
+
+        ``sampling`` must match the session's signature, per-row values are
+        copied into the session's tensors.
+        """
+        self.input_pos.copy_(input_pos)
+        self.cache_pos.fill_(cache_pos)
+        # another session may have resized the decoder caches
+        self._setup_engine()
+        if self.compiled:
+            # host-side lengths would change the step's shapes every frame
+            for layer in self.model.backbone.layers:
+                layer.attn.kv_cache.length = None
+        if pad_lens is not None:
+            self.pad_lens.copy_(pad_lens)
+        if sampling is not None:
+            for name in _SAMPLING_FIELDS:
+                value = getattr(self.sampling, name)
+                if isinstance(value, torch.Tensor):
+                    value.copy_(getattr(sampling, name))
+            self.sampling.generators = sampling.generators
+
+    def _setup_engine(self) -> None:
+        """size the engine's buffers and decoder caches for this session"""
+        engine = self.engine
+        if engine is None:
+            return
+        if (
+            engine.batch_size != self.batch_size
+            or engine.decoder_rows != self.decoder_rows
+            or engine.samples.device != self.input_pos.device
+            or _inference_only(engine.samples)
+        ):
+            engine._setup(self.batch_size, self.input_pos.device, self.decoder_rows)
+        else:
+            engine.setup_decoder_caches()
+
+    def _decode_step(self, frame: torch.Tensor) -> torch.Tensor:
+        model = self.model
+        audio_embeds = model.audio_embeddings(frame + self.codebook_offsets)
+        embeds = torch.cat([audio_embeds, self.text_slot], dim=1).unsqueeze(1)
+        h = embeds.sum(dim=2, dtype=embeds.dtype)
+
+        cache_len = model.backbone_cache_len
+        if self.padded:
+            mask = _padded_causal_mask(self.cache_pos, self.pad_lens, cache_len)
+        elif self.compiled:
+            mask = _causal_mask(self.input_pos, cache_len)
+        else:
+            mask = None
+        h = model._run_backbone(h, self.input_pos, mask)
+
+        if self.engine is None:
+            return model.sample_frame(
+                h[:, -1, :],
+                None,
+                None,
+                self.cfg_scale,
+                sampling=self.sampling,
+                cfg_codebooks=self.cfg_codebooks,
+            )
+        self.engine.rewind()
+        samples = self.engine._loop(
+            h[:, -1, :],
+            None,
+            None,
+            self.cfg_scale,
+            self.sampling,
+            self.cfg_codebooks,
+        )
+        return samples.clone()
+
+    def step(self, frame: torch.Tensor) -> torch.Tensor:
+        """feed ``frame`` [b, num_codebooks] and sample the next one"""
+        next_frame = self._step(frame)
+        self.input_pos += 1
+        self.cache_pos += 1
+        return next_frame
+
+    def shift_positions(self, count: int) -> None:
+        """move back by ``count`` after ``HeartMuLa.evict_backbone_entries``"""
+        self.input_pos -= count
+        self.cache_pos -= count
+
+    def warmup(self, num_steps: int = 2) -> None:
+        """run (and compile) ``num_steps`` throwaway steps
+
+        Cache write indices, positions and the RNG state are restored
+        afterwards; the entries written past the current position are never
+        read.
+        """
+        caches = [layer.attn.kv_cache for layer in self.model.backbone.layers]
+        saved_pos = [(cache.cache_pos.clone(), cache.length) for cache in caches]
+        saved_input_pos = self.input_pos.clone()
+        saved_cache_pos = self.cache_pos.clone()
+
+        device = self.input_pos.device
+        devices = [device] if device.type == "cuda" else []
+        frame = torch.zeros(
+            self.batch_size,
+            self.model.config.audio_num_codebooks,
+            dtype=torch.int,
+            device=device,
+        )
+        with torch.random.fork_rng(devices=devices):
+            for _ in range(num_steps):
+                frame = self.step(frame)
+
+        for cache, (pos, length) in zip(caches, saved_pos):
+            cache.cache_pos.copy_(pos)
+            cache.length = length
+        self.input_pos.copy_(saved_input_pos)
+        self.cache_pos.copy_(saved_cache_pos)
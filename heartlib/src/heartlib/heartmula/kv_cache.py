@@ -0,0 +1,512 @@
+import hashlib
+import inspect
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+from torchtune.modules import KVCache
+
+
+def _cache_num_heads(attn) -> int:
+    # torchtune<0.5 caches keys/values after expanding them to num_heads
+    if "num_heads" in inspect.signature(KVCache.__init__).parameters:
+        return attn.num_heads
+    return attn.num_kv_heads
+
+
+class CausalKVCache(KVCache):
+    """``KVCache`` that tracks on the host how many entries it holds.
+
+    torchtune's cache returns all ``max_seq_len`` entries from ``update`` and
+    relies on an explicit mask to hide the unwritten ones. This cache writes at
+    ``length`` and returns only the ``length`` entries written so far. A single
+    new token then attends to everything returned, and a prefill into an empty
+    cache is plain causal attention, so neither needs a mask.
+
+    ``length = None`` means the position is only known on the device, as in
+    compiled ``DecodeSession`` steps. The cache then writes at ``cache_pos`` and
+    returns every entry like ``KVCache``, and the caller has to pass a mask.
+    """
+
+    # [batch, heads, seq, ...] buffers that make up the cache state
+    state_names = ("k_cache", "v_cache")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.length = 0
+
+    def reset(self) -> None:
+        super().reset()
+        self.length = 0
+
+    def _store(self, index, k_val: torch.Tensor, v_val: torch.Tensor) -> None:
+        self.k_cache[:, :, index] = k_val
+        self.v_cache[:, :, index] = v_val
+
+    def _load(self, end: Optional[int] = None):
+        if end is None:
+            return self.k_cache, self.v_cache
+        return self.k_cache[:, :, :end], self.v_cache[:, :, :end]
+
+    def update(self, k_val: torch.Tensor, v_val: torch.Tensor):
+        seq_len = k_val.size(2)
+        if self.length is None:
+            self._store(self.cache_pos[:seq_len], k_val, v_val)
+            self.cache_pos += seq_len
+            return self._load()
+
+        end = self.length + seq_len
+        assert end <= self.k_cache.size(2), "KV cache is full"
+        self._store(slice(self.length, end), k_val, v_val)
+        # keep the device index in sync for steps that switch to it
+        self.cache_pos += seq_len
+        self.length = end
+        return self._load(end)
+
+    def evict(
+        self,
+        start: int,
+        count: int,
+        end: int,
+        rotate: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+    ) -> None:
+        """drop entries ``[start, start + count)`` of the first ``end`` entries
+
+        The entries behind them move ``count`` slots down, ``rotate`` maps their
+        keys to the new positions. The write index moves back by ``count``.
+        """
+        k, v = self._load(end)
+        k, v = k[:, :, start + count :], v[:, :, start + count :]
+        if rotate is not None:
+            k = rotate(k)
+        # the source and destination ranges overlap
+        self._store(slice(start, end - count), k.clone(), v.clone())
+        self.cache_pos -= count
+        if self.length is not None:
+            self.length = end - count
+
+
+def _quantize(x: torch.Tensor):
+    """symmetric int8 with one scale per (row, head, token)"""
+    scale = x.abs().amax(dim=-1, keepdim=True).float().clamp_min(1e-8) / 127.0
+    q = torch.round(x.float() / scale).clamp_(-127, 127).to(torch.int8)
+    return q, scale
+
+
+class QuantizedKVCache(CausalKVCache):
+    """``CausalKVCache`` that stores keys and values as int8.
+
+    Every cached key/value vector gets its own float32 scale (absmax / 127), so
+    an entry takes ``head_dim + 4`` bytes instead of ``2 * head_dim`` in bf16.
+    ``update`` dequantizes the entries it returns to ``dtype`` right before the
+    attention, one layer at a time.
+    """
+
+    state_names = ("k_cache", "v_cache", "k_scale", "v_scale")
+
+    def __init__(
+        self,
+        batch_size: int,
+        max_seq_len: int,
+        num_heads: int,
+        head_dim: int,
+        dtype: torch.dtype,
+    ):
+        super().__init__(batch_size, max_seq_len, num_heads, head_dim, torch.int8)
+        self.dtype = dtype
+        scale_shape = (batch_size, num_heads, max_seq_len, 1)
+        self.register_buffer(
+            "k_scale", torch.zeros(scale_shape, dtype=torch.float), persistent=False
+        )
+        self.register_buffer(
+            "v_scale", torch.zeros(scale_shape, dtype=torch.float), persistent=False
+        )
+
+    def _store(self, index, k_val: torch.Tensor, v_val: torch.Tensor) -> None:
+        self.k_cache[:, :, index], self.k_scale[:, :, index] = _quantize(k_val)
+        self.v_cache[:, :, index], self.v_scale[:, :, index] = _quantize(v_val)
+
+    def _load(self, end: Optional[int] = None):
+        end = self.k_cache.size(2) if end is None else end
+        k = self.k_cache[:, :, :end] * self.k_scale[:, :, :end]
+        v = self.v_cache[:, :, :end] * self.v_scale[:, :, :end]
+        return k.to(self.dtype), v.to(self.dtype)
+
+
+class SlotKVCache(nn.Module):
+    """KV cache whose rows are addressed per request.
+
+    Unlike torchtune's ``KVCache`` (one write index shared by the whole batch),
+    every row of the current forward is mapped to a cache slot and writes at its
+    own position. ``bind`` selects the slots and write positions before a forward;
+    ``update`` then behaves like ``KVCache.update`` for those rows and returns
+    their first ``length`` cache entries.
+    """
+
+    def __init__(
+        self,
+        num_slots: int,
+        max_seq_len: int,
+        num_heads: int,
+        head_dim: int,
+        dtype: torch.dtype,
+    ) -> None:
+        super().__init__()
+        cache_shape = (num_slots, num_heads, max_seq_len, head_dim)
+        self.register_buffer(
+            "k_cache", torch.zeros(cache_shape, dtype=dtype), persistent=False
+        )
+        self.register_buffer(
+            "v_cache", torch.zeros(cache_shape, dtype=dtype), persistent=False
+        )
+        self.batch_size = num_slots
+        self.max_seq_len = max_seq_len
+        self.slots = None
+        self.write_pos = torch.zeros(num_slots, dtype=torch.long)
+        self.length = max_seq_len
+
+    def bind(
+        self,
+        slots: Optional[torch.Tensor],
+        write_pos: torch.Tensor,
+        length: Optional[int] = None,
+    ) -> None:
+        """``slots=None`` binds the first ``len(write_pos)`` slots without a gather"""
+        self.slots = slots
+        self.write_pos = write_pos.clone()
+        self.length = self.max_seq_len if length is None else length
+
+    def reset(self) -> None:
+        self.write_pos.zero_()
+
+    @property
+    def size(self) -> int:
+        return int(self.write_pos.max().item())
+
+    def update(self, k_val: torch.Tensor, v_val: torch.Tensor):
+        bsz, _, seq_len, _ = k_val.shape
+        assert bsz == self.write_pos.shape[0], "cache is bound to a different batch"
+
+        idx = self.write_pos.view(-1, 1) + torch.arange(seq_len, device=k_val.device)
+        rows = (
+            torch.arange(bsz, device=k_val.device)
+            if self.slots is None
+            else self.slots
+        )
+        rows = rows.view(-1, 1).expand(bsz, seq_len)
+        self.k_cache[rows, :, idx] = k_val.transpose(1, 2)
+        self.v_cache[rows, :, idx] = v_val.transpose(1, 2)
+        self.write_pos += seq_len
+
+        if self.slots is None:
+            return (
+                self.k_cache[:bsz, :, : self.length],
+                self.v_cache[:bsz, :, : self.length],
+            )
+        return (
+            self.k_cache[self.slots, :, : self.length],
+            self.v_cache[self.slots, :, : self.length],
+        )
+
+
+class KVCachePool:
+    """Backbone and depth-decoder KV caches owned outside of ``HeartMuLa``.
+
+    The pool holds ``num_slots`` cache rows of ``max_seq_len`` entries for every
+    backbone layer, plus per-frame decoder caches for the same number of rows.
+    ``install`` swaps them into the model's attention layers; ``uninstall``
+    restores whatever caches the model had before.
+    """
+
+    def __init__(self, model, num_slots: int, max_seq_len: int):
+        self.model = model
+        self.num_slots = num_slots
+        self.max_seq_len = max_seq_len
+
+        dtype = next(model.parameters()).dtype
+        device = next(model.parameters()).device
+        with device:
+            self.backbone_caches = self._make_caches(
+                model.backbone, num_slots, max_seq_len, dtype
+            )
+            self.decoder_caches = self._make_caches(
+                model.decoder, num_slots, model.config.audio_num_codebooks, dtype
+            )
+        self._saved = None
+
+    @staticmethod
+    def _make_caches(decoder, num_slots, max_seq_len, dtype) -> List[SlotKVCache]:
+        return [
+            SlotKVCache(
+                num_slots,
+                max_seq_len,
+                _cache_num_heads(layer.attn),
+                layer.attn.head_dim,
+                dtype,
+            )
+            for layer in decoder.layers
+        ]
+
+    def _attns(self):
+        return [layer.attn for layer in self.model.backbone.layers] + [
+            layer.attn for layer in self.model.decoder.layers
+        ]
+
+    def install(self) -> None:
+        if self._saved is not None:
+            return
+        attns = self._attns()
+        self._saved = [(attn.kv_cache, attn.cache_enabled) for attn in attns]
+        for attn, cache in zip(attns, self.backbone_caches + self.decoder_caches):
+            attn.kv_cache = cache
+            attn.cache_enabled = True
+
+    def uninstall(self) -> None:
+        if self._saved is None:
+            return
+        for attn, (cache, enabled) in zip(self._attns(), self._saved):
+            attn.kv_cache = cache
+            attn.cache_enabled = enabled
+        self._saved = None
+
+    def bind(
+        self, slots: Optional[torch.Tensor], write_pos: torch.Tensor, length: int
+    ) -> None:
+        """route the next backbone forward to ``slots`` (one per batch row)"""
+        for cache in self.backbone_caches:
+            cache.bind(slots, write_pos, length)
+        # the depth decoder restarts every frame, rows only need to line up
+        zeros = torch.zeros_like(write_pos)
+        for cache in self.decoder_caches:
+            cache.bind(None, zeros)
+
+    def nbytes(self) -> int:
+        return sum(
+            c.k_cache.nbytes + c.v_cache.nbytes
+            for c in self.backbone_caches + self.decoder_caches
+        )
+
+
+def _set_cache_len(cache, length: int) -> None:
+    if isinstance(cache, SlotKVCache):
+        cache.write_pos.fill_(length)
+    else:
+        cache.cache_pos.copy_(
+            torch.arange(cache.cache_pos.numel(), device=cache.cache_pos.device)
+            + length
+        )
+        if isinstance(cache, CausalKVCache):
+            cache.length = length
+
+
+def _state_names(cache) -> Tuple[str, ...]:
+    return getattr(cache, "state_names", ("k_cache", "v_cache"))
+
+
+def snapshot_kv(decoder, length: int) -> List[Tuple[torch.Tensor, ...]]:
+    """copy the first ``length`` cache entries of every layer of ``decoder``
+
+    Every layer gives ``(k, v)``, plus the scales of a ``QuantizedKVCache``.
+    """
+    return [
+        tuple(
+            getattr(layer.attn.kv_cache, name)[:, :, :length].clone()
+            for name in _state_names(layer.attn.kv_cache)
+        )
+        for layer in decoder.layers
+    ]
+
+
+def restore_kv(decoder, kv: List[Tuple[torch.Tensor, ...]]) -> None:
+    """write a ``snapshot_kv`` result back and move the caches' write index after it"""
+    for layer, state in zip(decoder.layers, kv):
+        cache = layer.attn.kv_cache
+        names = _state_names(cache)
+        assert len(names) == len(state), "snapshot is from a different cache type"
+        length = state[0].shape[2]
+        for name, value in zip(names, state):
+            getattr(cache, name)[:, :, :length].copy_(value)
+        _set_cache_len(cache, length)
+
+
+@contextmanager
+def narrow_kv(decoder, batch_size: int):
+    """let the caches of ``decoder`` act as if they only had their first rows
+
+    The narrowed buffers are views, writes land in the full caches.
+    """
+    saved = []
+    for layer in decoder.layers:
+        cache = layer.attn.kv_cache
+        state = {name: getattr(cache, name) for name in _state_names(cache)}
+        saved.append((cache, state))
+        for name, value in state.items():
+            setattr(cache, name, value[:batch_size])
+    try:
+        yield
+    finally:
+        for cache, state in saved:
+            for name, value in state.items():
+                setattr(cache, name, value)
+
+
+def fork_kv(decoder, index: torch.Tensor, length: int) -> None:
+    """row ``i`` of every cache gets the first ``length`` entries of row ``index[i]``"""
+    for layer in decoder.layers:
+        cache = layer.attn.kv_cache
+        for name in _state_names(cache):
+            value = getattr(cache, name)
+            value[: len(index), :, :length] = value[index, :, :length]
+
+
+def shrink_kv(decoder, batch_size: int) -> None:
+    """keep only the first ``batch_size`` rows of every cache and free the rest"""
+    for layer in decoder.layers:
+        cache = layer.attn.kv_cache
+        for name in _state_names(cache):
+            setattr(cache, name, getattr(cache, name)[:batch_size].clone())
+        cache.batch_size = batch_size
+
+
+class UnconditionalPrefix:
+    """Backbone state of an unconditional CFG row after its prompt.
+
+    Every prompt position of an unconditional row is embedded as
+    ``unconditional_text_embedding``, so its KV entries and hidden states only
+    depend on the position, not on the tags or lyrics. They are computed once,
+    extended when a longer prompt comes along and sliced for shorter ones.
+    """
+
+    def __init__(self):
+        self.kv = None
+        self.hidden = None
+        self.signature = None
+
+    @property
+    def length(self) -> int:
+        return 0 if self.hidden is None else self.hidden.size(1)
+
+    def extend(self, model, length: int) -> None:
+        """compute the first ``length`` positions if they are not cached yet
+
+        Row 0 of ``model``'s backbone caches is used as scratch space, and the
+        caches are rewound to position 0 afterwards.
+        """
+        cache = model.backbone.layers[0].attn.kv_cache
+        signature = (type(cache), cache.k_cache.dtype, cache.k_cache.device)
+        if signature != self.signature:
+            self.kv, self.hidden, self.signature = None, None, signature
+        if length <= self.length:
+            return
+
+        with narrow_kv(model.backbone, 1):
+            if self.kv is None:
+                for layer in model.backbone.layers:
+                    _set_cache_len(layer.attn.kv_cache, 0)
+            else:
+                restore_kv(model.backbone, self.kv)
+            pos = torch.arange(self.length, length, device=cache.k_cache.device)
+            hidden = model._run_backbone(
+                model._unconditional_embeds(length - self.length),
+                pos.unsqueeze(0),
+            )
+            self.kv = snapshot_kv(model.backbone, length)
+        self.hidden = hidden if self.hidden is None else torch.cat(
+            [self.hidden, hidden], dim=1
+        )
+        for layer in model.backbone.layers:
+            _set_cache_len(layer.attn.kv_cache, 0)
+
+    def install(self, model, rows: List[int], pad_lens: List[int], length: int):
+        """write the state into backbone cache ``rows``, each after its padding
+
+        Returns the rows' last hidden states [len(rows), dim].
+        """
+        for layer, state in zip(model.backbone.layers, self.kv):
+            cache = layer.attn.kv_cache
+            for name, value in zip(_state_names(cache), state):
+                buffer = getattr(cache, name)
+                for row, pad_len in zip(rows, pad_lens):
+                    buffer[row, :, pad_len:length] = value[0, :, : length - pad_len]
+        last = torch.tensor(pad_lens, device=self.hidden.device)
+        return self.hidden[0, length - 1 - last]
+
+
+@dataclass
+class PrefixEntry:
+    """backbone state right after a prompt prefill"""
+
+    kv: List[Tuple[torch.Tensor, ...]]
+    last_h: torch.Tensor
+
+    @property
+    def nbytes(self) -> int:
+        return self.last_h.nbytes + sum(t.nbytes for state in self.kv for t in state)
+
+    def to(self, device) -> "PrefixEntry":
+        return PrefixEntry(
+            [tuple(t.to(device) for t in state) for state in self.kv],
+            self.last_h.to(device),
+        )
+
+
+class PrefixCache:
+    """LRU cache of post-prefill backbone KV states, bounded in bytes.
+
+    Entries are kept on the device they were produced on. When ``spill_dir`` is
+    set, evicted entries are written there and loaded back on the next hit
+    instead of being recomputed; the spill directory itself is not bounded.
+    """
+
+    def __init__(self, max_bytes: int = 4 << 30, spill_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*tensors: torch.Tensor, dtype: torch.dtype) -> str:
+        h = hashlib.sha1(str(dtype).encode())
+        for t in tensors:
+            t = t.detach().cpu().contiguous()
+            h.update(f"{t.dtype}{tuple(t.shape)}".encode())
+            h.update(t.view(-1).view(torch.uint8).numpy().tobytes())
+        return h.hexdigest()
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.pt")
+
+    def get(self, key: str, device=None) -> Optional[PrefixEntry]:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.spill_dir is not None and os.path.isfile(self._spill_path(key)):
+            data = torch.load(self._spill_path(key), map_location=device or "cpu")
+            entry = PrefixEntry(data["kv"], data["last_h"])
+            self.put(key, entry)
+            return entry
+        return None
+
+    def put(self, key: str, entry: PrefixEntry) -> None:
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            old_key, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+            if self.spill_dir is not None and not os.path.isfile(
+                self._spill_path(old_key)
+            ):
+                cpu = old.to("cpu")
+                torch.save({"kv": cpu.kv, "last_h": cpu.last_h}, self._spill_path(old_key))
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.nbytes = 0
@@ -6,6 +6,19 @@ import torch
 import torch.nn as nn
 import torchtune
 from torchtune.models import llama3_2
+from torchtune.modules import delete_kv_caches, disable_kv_cache
+from .kv_cache import (
+    CausalKVCache,
+    QuantizedKVCache,
+    SlotKVCache,
+    _cache_num_heads,
+    _set_cache_len,
+)
+from .sampling import SamplingParams, _multinomial, sample
+from .sampling import probs as sampling_probs
+from functools import partial
+from typing import Dict, Optional
+import warnings
 
 
 def llama3_2_3B() -> torchtune.modules.transformer.TransformerDecoder:
@@ -87,33 +100,247 @@ def _prepare_transformer(model):
     return model, embed_dim
 
 
-def _create_causal_mask(seq_len: int, device: torch.device):
-    return torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool, device=device))
-
+def _causal_mask(input_pos: torch.Tensor, length: int):
+    """rows ``input_pos`` of a [length, length] causal mask, built from positions"""
+    return torch.arange(length, device=input_pos.device) <= input_pos.unsqueeze(-1)
+
+
+def _padded_causal_mask(cache_pos: torch.Tensor, pad_lens: torch.Tensor, length: int):
+    """causal mask for left-padded rows: [b, s, length]
+
+    padding slots are hidden from every real token; a padding token only attends
+    to itself so that its (unused) attention output stays finite.
+    """
+    r = _causal_mask(cache_pos, length).unsqueeze(0)
+    slots = torch.arange(length, device=cache_pos.device)
+    valid = slots.view(1, 1, -1) >= pad_lens.view(-1, 1, 1)
+    own = slots.view(1, 1, -1) == cache_pos.view(1, -1, 1)
+    return r & (valid | own)
+
+
+def _position_attention(attention_call):
+    """wrap a torchtune attention call for ``CausalKVCache`` backbones
+
+    Keys and values hold exactly the filled cache entries and the queries are
+    the newest of them. Without a mask a single query attends to all of them, a
+    full-length query block is causal, and only a block appended to a non-empty
+    cache needs a (small, position-built) mask. Masks sized for the whole cache
+    are cut down to the returned entries.
+    """
+
+    def _call(q, k, v, mask, dropout_p, is_causal):
+        q_len, kv_len = q.size(2), k.size(2)
+        if mask is not None:
+            mask = mask[..., :kv_len]
+        elif q_len == kv_len:
+            is_causal = True
+        elif q_len > 1:
+            pos = torch.arange(kv_len - q_len, kv_len, device=q.device)
+            mask = _causal_mask(pos, kv_len).expand(q.size(0), -1, -1)
+        return attention_call(
+            q, k, v, mask=mask, dropout_p=dropout_p, is_causal=is_causal
+        )
 
-def _index_causal_mask(mask: torch.Tensor, input_pos: torch.Tensor):
-    r = mask[input_pos, :]
-    return r
+    return _call
 
 
-def _multinomial_sample_one_no_sync(
-    probs,
-):  # Does multinomial sampling without a cuda synchronization
-    q = torch.empty_like(probs).exponential_(1)
-    return torch.argmax(probs / q, dim=-1, keepdim=True).to(dtype=torch.int)
+def _rope_shift_back(rope, keys: torch.Tensor, offset: int) -> torch.Tensor:
+    """re-rotate RoPE'd ``keys`` [b, h, s, head_dim] to ``offset`` positions earlier"""
+    cos, sin = rope.cache[offset].unbind(-1)
+    x0, x1 = keys.float().unflatten(-1, (-1, 2)).unbind(-1)
+    # the inverse of the rotation RoPE applies at position ``offset``
+    out = torch.stack([x0 * cos + x1 * sin, x1 * cos - x0 * sin], dim=-1)
+    return out.flatten(-2).to(keys.dtype)
 
 
 def sample_topk(logits: torch.Tensor, topk: int, temperature: float):
-    logits = logits / temperature
+    """deprecated, use ``sampling.sample`` with ``SamplingParams``"""
+    warnings.warn(
+        "sample_topk is deprecated, use heartlib.heartmula.sampling.sample",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    return sample(logits, SamplingParams(temperature=temperature, topk=topk))
+
+
+def _is_cfg_batch(b: int, cfg_scale: float) -> bool:
+    return cfg_scale > 1.0 and b > 1 and (b % 2 == 0)
+
+
+def _decoder_rows(b: int, cfg_scale: float, cfg_codebooks: Optional[int]) -> int:
+    """rows the depth decoder runs: unguided codebooks only need the cond rows"""
+    if _is_cfg_batch(b, cfg_scale) and cfg_codebooks is not None and cfg_codebooks <= 1:
+        return b // 2
+    return b
+
+
+def _guide_logits(logits: torch.Tensor, cfg_scale: float) -> torch.Tensor:
+    """[cond rows, uncond rows] -> guided logits of the cond rows"""
+    actual_B = logits.size(0) // 2
+    cond_logits = logits[:actual_B]
+    uncond_logits = logits[actual_B:]
+    return uncond_logits + (cond_logits - uncond_logits) * cfg_scale
+
+
+def _inference_only(tensor: torch.Tensor) -> bool:
+    """made under ``torch.inference_mode``, no in-place updates outside of it"""
+    return tensor.is_inference() and not torch.is_inference_mode_enabled()
+
+
+class DepthDecoderEngine:
+    """Static-input version of the per-frame depth decoder loop.
+
+    ``HeartMuLa.sample_frame`` rebuilds positions and masks every frame. It
+    also zeroes the decoder caches (which reads their size back from the
+    device) and grows the frame with ``torch.cat``. The engine keeps positions,
+    masks and a sample buffer per batch size. It only rewinds the caches' write
+    index, since stale entries are masked out anyway. Samples are identical to
+    ``sample_frame``.
+
+    ``compile()`` runs the whole codebook loop as one ``torch.compile`` region.
+
+    ``cfg_codebooks`` restricts CFG to the first codebooks of a frame, the
+    others are sampled from the conditional rows alone. With at most codebook
+    0 guided the depth decoder only runs the conditional rows.
+    """
+
+    def __init__(self, model: "HeartMuLa"):
+        self.model = model
+        self.batch_size = None
+        self.decoder_rows = None
+        self._loop = self._sample_codebooks
+
+    def compile(self, **compile_kwargs) -> "DepthDecoderEngine":
+        compile_kwargs.setdefault("dynamic", False)
+        self._loop = torch.compile(self._sample_codebooks, **compile_kwargs)
+        return self
+
+    def _setup(
+        self, batch_size: int, device: torch.device, decoder_rows: int = None
+    ) -> None:
+        n = self.model.config.audio_num_codebooks
+        decoder_rows = batch_size if decoder_rows is None else decoder_rows
+        self.samples = torch.zeros(batch_size, n, dtype=torch.int, device=device)
+        # [h, c0] at positions 0, 1, then one codebook per step
+        self.positions = [
+            torch.arange(2, device=device).unsqueeze(0).repeat(decoder_rows, 1)
+        ] + [
+            torch.full((decoder_rows, 1), i, dtype=torch.long, device=device)
+            for i in range(2, n)
+        ]
+        self.masks = [_causal_mask(pos, n) for pos in self.positions]
+        self.cache_pos = torch.arange(n, device=device)
+        self.batch_size = batch_size
+        self.decoder_rows = decoder_rows
+        self.setup_decoder_caches()
+
+    def setup_decoder_caches(self) -> None:
+        """(re)allocate the decoder caches with ``decoder_rows`` rows
+
+        A scheduler's ``SlotKVCache``s are kept as long as they have at least
+        ``decoder_rows`` rows, the first ``decoder_rows`` of them are bound.
+        """
+        decoder = self.model.decoder
+        if decoder.caches_are_setup():
+            cache = decoder.layers[0].attn.kv_cache
+            if isinstance(cache, SlotKVCache):
+                if cache.k_cache.size(0) >= self.decoder_rows:
+                    write_pos = torch.zeros(
+                        self.decoder_rows, dtype=torch.long, device=cache.k_cache.device
+                    )
+                    for layer in decoder.layers:
+                        layer.attn.kv_cache.bind(None, write_pos)
+                    return
+            elif cache.k_cache.size(0) == self.decoder_rows and not _inference_only(
+                cache.k_cache
+            ):
+                return
+            delete_kv_caches(decoder)
+        param = next(self.model.parameters())
+        with param.device:
+            decoder.setup_caches(
+                self.decoder_rows,
+                param.dtype,
+                decoder_max_seq_len=self.model.config.audio_num_codebooks,
+            )
 
-    filter_value: float = -float("Inf")
-    indices_to_remove = logits < torch.topk(logits, topk)[0][..., -1, None]
-    scores_processed = logits.masked_fill(indices_to_remove, filter_value)
-    scores_processed = torch.nn.functional.log_softmax(scores_processed, dim=-1)
-    probs = torch.nn.functional.softmax(scores_processed, dim=-1)
+    def rewind(self) -> None:
+        for layer in self.model.decoder.layers:
+            cache = layer.attn.kv_cache
+            if isinstance(cache, SlotKVCache):
+                cache.reset()
+            else:
+                cache.cache_pos.copy_(self.cache_pos)
 
-    sample_token = _multinomial_sample_one_no_sync(probs)
-    return sample_token
+    def _sample_codebooks(
+        self,
+        last_h: torch.Tensor,
+        temperature: float,
+        topk: int,
+        cfg_scale: float,
+        sampling: Optional[SamplingParams] = None,
+        cfg_codebooks: Optional[int] = None,
+    ) -> torch.Tensor:
+        model = self.model
+        b = last_h.size(0)
+        guided = _is_cfg_batch(b, cfg_scale)
+        rows = b // 2 if guided else b
+        num_guided = model.config.audio_num_codebooks
+        if guided and cfg_codebooks is not None:
+            num_guided = cfg_codebooks
+        decoder_rows = _decoder_rows(b, cfg_scale, cfg_codebooks)
+        if sampling is None:
+            sampling = SamplingParams(temperature=temperature, topk=topk)
+
+        def _sample(logits: torch.Tensor, codebook: int) -> torch.Tensor:
+            if guided and codebook < num_guided:
+                logits = _guide_logits(logits, cfg_scale)
+            elif guided:
+                logits = logits[:rows]
+            return sample(logits, sampling)
+
+        c0_sample = _sample(model.codebook0_head(last_h), 0)
+        self.samples[:, :1] = c0_sample.repeat(b // rows, 1)
+        c0_embed = model._embed_audio(0, c0_sample.repeat(decoder_rows // rows, 1))
+        curr_h = torch.cat([last_h[:decoder_rows].unsqueeze(1), c0_embed], dim=1)
+        curr_h = curr_h.to(c0_embed.dtype)
+        for i in range(1, model.config.audio_num_codebooks):
+            decoder_h = model.decoder(
+                model.projection(curr_h),
+                input_pos=self.positions[i - 1],
+                mask=self.masks[i - 1],
+            )
+            ci_logits = torch.mm(decoder_h[:, -1, :], model.audio_head[i - 1])
+            ci_sample = _sample(ci_logits, i)
+            self.samples[:, i : i + 1] = ci_sample.repeat(b // rows, 1)
+            curr_h = model._embed_audio(i, ci_sample.repeat(decoder_rows // rows, 1))
+        return self.samples
+
+    def __call__(
+        self,
+        last_h: torch.Tensor,
+        temperature: float,
+        topk: int,
+        cfg_scale: float,
+        sampling: Optional[SamplingParams] = None,
+        cfg_codebooks: Optional[int] = None,
+    ) -> torch.Tensor:
+        b = last_h.size(0)
+        decoder_rows = _decoder_rows(b, cfg_scale, cfg_codebooks)
+        if (
+            self.batch_size != b
+            or self.decoder_rows != decoder_rows
+            or self.samples.device != last_h.device
+            or _inference_only(self.samples)
+        ):
+            self._setup(b, last_h.device, decoder_rows)
+        else:
+            self.setup_decoder_caches()
+        self.rewind()
+        # callers keep frames around, the buffer is reused by the next call
+        return self._loop(
+            last_h, temperature, topk, cfg_scale, sampling, cfg_codebooks
+        ).clone()
 
 
 class HeartMuLa(PreTrainedModel):
@@ -152,32 +379,122 @@ class HeartMuLa(PreTrainedModel):
         self.muq_linear = nn.Linear(config.muq_dim, backbone_dim)
         self.post_init()
 
-    def setup_caches(self, max_batch_size: int):
+        # set to None to fall back to the generic loop of ``sample_frame``, in
+        # ``generate_frame`` and ``DecodeSession`` steps alike
+        self.depth_engine = DepthDecoderEngine(self)
+        # int8 backbone KV caches (``QuantizedKVCache``), read by ``setup_caches``
+        self.quantize_kv_cache = False
+        for layer in self.backbone.layers:
+            layer.attn._attention_call = _position_attention(layer.attn._attention_call)
+
+    @property
+    def backbone_cache_len(self) -> int:
+        """entries the backbone KV caches hold, 0 before ``setup_caches``"""
+        if not self.backbone.caches_are_setup():
+            return 0
+        return self.backbone.layers[0].attn.kv_cache.k_cache.size(2)
+
+    def cache_nbytes(self, batch_size: int, max_seq_len: int = None) -> Dict[str, int]:
+        """bytes ``setup_caches(batch_size, max_seq_len)`` allocates"""
+        itemsize = next(self.parameters()).element_size()
+        if max_seq_len is None:
+            max_seq_len = self.backbone.max_seq_len
+        n = self.config.audio_num_codebooks
+
+        def _kv(decoder, seq_len: int, quantized: bool = False) -> int:
+            total = 0
+            for layer in decoder.layers:
+                head_dim = layer.attn.head_dim
+                # int8 values plus a float32 scale per vector
+                vector = head_dim + 4 if quantized else head_dim * itemsize
+                num_heads = _cache_num_heads(layer.attn)
+                total += 2 * batch_size * num_heads * seq_len * vector
+            return total
+
+        sizes = {
+            "backbone_kv": _kv(self.backbone, max_seq_len, self.quantize_kv_cache),
+            "decoder_kv": _kv(self.decoder, n),
+        }
+        sizes["total"] = sum(sizes.values())
+        return sizes
+
+    def setup_caches(self, max_batch_size: int, max_seq_len: int = None):
+        """prepare KV caches for ``max_batch_size`` rows of ``max_seq_len`` entries
+
+        ``max_seq_len`` defaults to the backbone's ``max_seq_len``. Existing
+        caches are kept when the batch size matches and they are long enough,
+        they are only rewound to position 0. The backbone gets ``CausalKVCache``s,
+        so its attention needs no mask unless rows are padded, or
+        ``QuantizedKVCache``s when ``quantize_kv_cache`` is set.
+        """
         dtype = next(self.parameters()).dtype
         device = next(self.parameters()).device
-
-        try:
-            self.reset_caches()
-        except RuntimeError:
-            pass
+        if max_seq_len is None:
+            max_seq_len = self.backbone.max_seq_len
+        max_seq_len = min(max_seq_len, self.backbone.max_seq_len)
+
+        cache_cls = QuantizedKVCache if self.quantize_kv_cache else CausalKVCache
+        if self.backbone.caches_are_setup():
+            cache = self.backbone.layers[0].attn.kv_cache
+            k_cache = cache.k_cache
+            if (
+                type(cache) is not cache_cls
+                or k_cache.size(0) != max_batch_size
+                or k_cache.size(2) < max_seq_len
+                or getattr(cache, "dtype", k_cache.dtype) != dtype
+                or k_cache.device != device
+                or _inference_only(k_cache)
+            ):
+                delete_kv_caches(self.backbone)
+        if self.decoder.caches_are_setup():
+            k_cache = self.decoder.layers[0].attn.kv_cache.k_cache
+            if (
+                k_cache.size(0) != max_batch_size
+                or k_cache.dtype != dtype
+                or k_cache.device != device
+                or _inference_only(k_cache)
+            ):
+                delete_kv_caches(self.decoder)
 
         with device:
-            self.backbone.setup_caches(max_batch_size, dtype)
-            self.decoder.setup_caches(
-                max_batch_size,
-                dtype,
-                decoder_max_seq_len=self.config.audio_num_codebooks,
+            if not self.backbone.caches_are_setup():
+                for layer in self.backbone.layers:
+                    layer.attn.kv_cache = cache_cls(
+                        max_batch_size,
+                        max_seq_len,
+                        _cache_num_heads(layer.attn),
+                        layer.attn.head_dim,
+                        dtype,
+                    )
+                    layer.attn.cache_enabled = True
+            if not self.decoder.caches_are_setup():
+                self.decoder.setup_caches(
+                    max_batch_size,
+                    dtype,
+                    decoder_max_seq_len=self.config.audio_num_codebooks,
+                )
+        # stale entries past the write index are masked out, no need to zero them
+        for decoder in (self.backbone, self.decoder):
+            for layer in decoder.layers:
+                _set_cache_len(layer.attn.kv_cache, 0)
+
+    def evict_backbone_entries(self, start: int, count: int, end: int) -> None:
+        """drop backbone cache entries ``[start, start + count)`` of the first ``end``
+
+        The entries behind them move down and their keys are re-rotated to
+        ``count`` positions earlier, so positions stay contiguous and bounded by
+        the cache length. Callers move their own positions back by ``count``.
+        """
+        for layer in self.backbone.layers:
+            layer.attn.kv_cache.evict(
+                start,
+                count,
+                end,
+                rotate=partial(
+                    _rope_shift_back, layer.attn.pos_embeddings, offset=count
+                ),
             )
 
-        self.register_buffer(
-            "backbone_causal_mask",
-            _create_causal_mask(self.backbone.max_seq_len, device),
-        )
-        self.register_buffer(
-            "decoder_causal_mask",
-            _create_causal_mask(self.config.audio_num_codebooks, device),
-        )
-
     def generate_frame(
         self,
         tokens: torch.Tensor,
@@ -188,11 +505,43 @@ class HeartMuLa(PreTrainedModel):
         cfg_scale: float,
         continuous_segments: torch.Tensor = None,
         starts=None,
+        mask: torch.Tensor = None,
+        sampling: Optional[SamplingParams] = None,
+    ) -> torch.Tensor:
+        last_h = self.forward_backbone(
+            tokens,
+            tokens_mask,
+            input_pos,
+            cfg_scale,
+            continuous_segments=continuous_segments,
+            starts=starts,
+            mask=mask,
+        )
+        return self.sample_frame(
+            last_h, temperature, topk, cfg_scale, sampling=sampling
+        )
+
+    def forward_backbone(
+        self,
+        tokens: torch.Tensor,
+        tokens_mask: torch.Tensor,
+        input_pos: torch.Tensor,
+        cfg_scale: float,
+        continuous_segments: torch.Tensor = None,
+        starts=None,
+        mask: torch.Tensor = None,
+        all_positions: bool = False,
     ) -> torch.Tensor:
+        """run the backbone over ``tokens``, return the hidden state of the last position
+
+        ``tokens`` continue the sequence in the backbone caches. ``mask`` is only
+        needed for padded rows or caches that do not track their length on the
+        host. ``all_positions`` returns the hidden states of every position
+        instead.
+        """
         b, s, _ = tokens.size()
 
         assert self.backbone.caches_are_enabled(), "backbone caches are not enabled"
-        curr_backbone_mask = _index_causal_mask(self.backbone_causal_mask, input_pos)
 
         uncond_mask = None
         if cfg_scale > 1.0 and b > 1:
@@ -219,56 +568,135 @@ class HeartMuLa(PreTrainedModel):
                 )
             batch_indices = torch.arange(h.shape[0], device=h.device)
             h[batch_indices, starts] = continuous_segments
-        h = self.backbone(h, input_pos=input_pos, mask=curr_backbone_mask)
-        last_h = h[:, -1, :]  # the last frame
-        c0_logits = self.codebook0_head(last_h)  # only predict the audio part
+        h = self._run_backbone(h, input_pos, mask)
+        if all_positions:
+            return h
+        return h[:, -1, :]  # the last frame
 
-        if cfg_scale > 1.0 and b > 1 and (b % 2 == 0):
-            actual_B = b // 2
-            cond_logits = c0_logits[:actual_B, :]
-            uncond_logits = c0_logits[actual_B:, :]
-            guided_logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
-            c0_sample = sample_topk(guided_logits, topk, temperature)
-            c0_sample = c0_sample.repeat(
-                2, 1
-            )  # repeat to both branches to keep alignment
-        else:
-            c0_sample = sample_topk(c0_logits, topk, temperature)
+    def _run_backbone(
+        self, h: torch.Tensor, input_pos: torch.Tensor, mask: torch.Tensor = None
+    ) -> torch.Tensor:
+        # ``TransformerDecoder.forward`` insists on a mask whenever caches are on
+        for layer in self.backbone.layers:
+            h = layer(h, mask=mask, input_pos=input_pos)
+        return self.backbone.norm(h).float()
 
-        c0_embed = self._embed_audio(0, c0_sample)
+    def sample_frame(
+        self,
+        last_h: torch.Tensor,
+        temperature: float,
+        topk: int,
+        cfg_scale: float,
+        prefix: torch.Tensor = None,
+        return_probs: bool = False,
+        sampling: Optional[SamplingParams] = None,
+        cfg_codebooks: Optional[int] = None,
+    ):
+        """sample every codebook of the next frame from the backbone's last hidden state
+
+        ``prefix`` [b, m] fixes the first m codebooks, only the rest is sampled.
+        ``return_probs`` also returns the distributions the sampled codebooks were
+        drawn from, [b (b // 2 with CFG), num_sampled, audio_vocab_size].
+        ``sampling`` gives per-row settings and replaces ``temperature``/``topk``.
+        ``cfg_codebooks`` only guides the first codebooks, see ``DepthDecoderEngine``.
+        """
+        if self.depth_engine is not None and prefix is None and not return_probs:
+            return self.depth_engine(
+                last_h, temperature, topk, cfg_scale, sampling, cfg_codebooks
+            )
+        assert cfg_codebooks is None, "cfg_codebooks needs the depth decoder engine"
+
+        b = last_h.size(0)
+        guided = _is_cfg_batch(b, cfg_scale)
+        if sampling is None:
+            sampling = SamplingParams(temperature=temperature, topk=topk)
+        probs = []
+
+        def _sample(logits: torch.Tensor) -> torch.Tensor:
+            if guided:
+                logits = _guide_logits(logits, cfg_scale)
+            if return_probs:
+                ci_probs = sampling_probs(logits, sampling)
+                probs.append(ci_probs)
+                ci_sample = _multinomial(ci_probs, sampling)
+            else:
+                ci_sample = sample(logits, sampling)
+            if guided:
+                # repeat to both branches to keep alignment
+                ci_sample = ci_sample.repeat(2, 1)
+            return ci_sample
+
+        if prefix is None:
+            c0_logits = self.codebook0_head(last_h)  # only predict the audio part
+            prefix = _sample(c0_logits)
+        prefix_embed = torch.cat(
+            [self._embed_audio(i, prefix[:, i : i + 1]) for i in range(prefix.size(1))],
+            dim=1,
+        )
 
         self.decoder.reset_caches()
-        curr_h = torch.cat([last_h.unsqueeze(1), c0_embed], dim=1)
-        curr_sample = c0_sample.clone()
+        curr_h = torch.cat([last_h.unsqueeze(1), prefix_embed], dim=1)
+        curr_sample = prefix.clone()
         curr_pos = (
             torch.arange(0, curr_h.size(1), device=curr_h.device)
             .unsqueeze(0)
             .repeat(curr_h.size(0), 1)
         )
-        curr_h = curr_h.to(embeds.dtype)
-        for i in range(1, self.config.audio_num_codebooks):
-            curr_decoder_mask = _index_causal_mask(self.decoder_causal_mask, curr_pos)
+        curr_h = curr_h.to(prefix_embed.dtype)
+        for i in range(prefix.size(1), self.config.audio_num_codebooks):
+            curr_decoder_mask = _causal_mask(curr_pos, self.config.audio_num_codebooks)
             decoder_h = self.decoder(
                 self.projection(curr_h), input_pos=curr_pos, mask=curr_decoder_mask
             )
             ci_logits = torch.mm(decoder_h[:, -1, :], self.audio_head[i - 1])
-            if cfg_scale > 1.0 and b > 1 and (b % 2 == 0):
-                actual_B = b // 2
-                cond_ci = ci_logits[:actual_B, :]
-                uncond_ci = ci_logits[actual_B:, :]
-                guided_ci = uncond_ci + (cond_ci - uncond_ci) * cfg_scale
-
-                ci_sample = sample_topk(guided_ci, topk, temperature)
-                ci_sample = ci_sample.repeat(2, 1)
-            else:
-                ci_sample = sample_topk(ci_logits, topk, temperature)
+            ci_sample = _sample(ci_logits)
             ci_embed = self._embed_audio(i, ci_sample)
             curr_h = ci_embed
             curr_sample = torch.cat([curr_sample, ci_sample], dim=1)
             curr_pos = curr_pos[:, -1:] + 1
 
+        if return_probs:
+            return curr_sample, torch.stack(probs, dim=1)
         return curr_sample
 
+    def frame_probs(
+        self,
+        h: torch.Tensor,
+        frames: torch.Tensor,
+        temperature: float,
+        topk: int,
+        cfg_scale: float,
+        sampling: Optional[SamplingParams] = None,
+    ) -> torch.Tensor:
+        """teacher-forced codebook distributions of given frames
+
+        ``h`` [b, k, dim] are backbone states and ``frames`` [b, k, num_codebooks]
+        the frames that followed them. All k frames go through the depth decoder
+        in one forward without touching its cache. Returns the sampling
+        distributions of ``sample_frame``, [b (b // 2 with CFG), k, num_codebooks,
+        audio_vocab_size]. ``sampling`` may only hold scalar settings here.
+        """
+        b, k, _ = h.size()
+        n = self.config.audio_num_codebooks
+        c0_logits = self.codebook0_head(h).unsqueeze(2)
+
+        codes_embed = torch.stack(
+            [self._embed_audio(i, frames[:, :, i]) for i in range(n - 1)], dim=2
+        )
+        curr_h = torch.cat([h.unsqueeze(2), codes_embed], dim=2)
+        curr_h = curr_h.to(codes_embed.dtype).view(b * k, n, -1)
+        mask = _causal_mask(torch.arange(n, device=h.device), n).expand(b * k, -1, -1)
+        with disable_kv_cache(self.decoder):
+            decoder_h = self.decoder(self.projection(curr_h), mask=mask)
+        ci_logits = torch.einsum("bnd,ndv->bnv", decoder_h[:, 1:], self.audio_head)
+
+        logits = torch.cat([c0_logits, ci_logits.view(b, k, n - 1, -1)], dim=2)
+        if _is_cfg_batch(b, cfg_scale):
+            logits = _guide_logits(logits, cfg_scale)
+        if sampling is None:
+            sampling = SamplingParams(temperature=temperature, topk=topk)
+        return sampling_probs(logits, sampling)
+
     def reset_caches(self):
         self.backbone.reset_caches()
         self.decoder.reset_caches()
@@ -287,6 +715,11 @@ class HeartMuLa(PreTrainedModel):
     def _embed_audio(self, codebook: int, tokens: torch.Tensor) -> torch.Tensor:
         return self.audio_embeddings(tokens + codebook * self.config.audio_vocab_size)
 
+    def _unconditional_embeds(self, length: int) -> torch.Tensor:
+        """backbone input of ``length`` prompt positions of an unconditional row"""
+        embed = self.unconditional_text_embedding.weight[:1]
+        return embed.view(1, 1, -1).expand(1, length, -1)
+
     def _embed_tokens(
         self, tokens: torch.Tensor, uncond_mask: torch.Tensor | None
     ) -> torch.Tensor:
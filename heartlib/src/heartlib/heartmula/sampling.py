@@ -0,0 +1,229 @@
+import math
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Union
+
+import torch
+
+Scalar = Union[int, float]
+RowValues = Union[Scalar, Sequence[Scalar], torch.Tensor]
+
+
+def _per_row(values: RowValues, batch_size: int, dtype, device):
+    if isinstance(values, (int, float)):
+        return values
+    values = torch.as_tensor(values, dtype=dtype, device=device).view(-1)
+    if values.numel() == 1:
+        values = values.expand(batch_size)
+    assert values.numel() == batch_size, "expected one value per row"
+    return values.contiguous()
+
+
+def _max_topk(topk) -> int:
+    """largest top-k over the rows, 0 when any row keeps the whole vocabulary"""
+    if isinstance(topk, torch.Tensor):
+        return 0 if bool((topk <= 0).any()) else int(topk.max())
+    if isinstance(topk, Sequence):
+        return 0 if min(topk) <= 0 else max(topk)
+    return max(int(topk), 0)
+
+
+@dataclass
+class SamplingParams:
+    """Per-row sampling settings, one row per sampled sequence.
+
+    Under CFG only the guided (cond) rows are sampled, so a batch of n songs
+    has n rows. Every setting is either a Python scalar shared by all rows or
+    a [rows] tensor. ``topk <= 0``, ``top_p >= 1`` and ``min_p <= 0`` disable
+    the respective filter, ``temperature <= 0`` samples greedily.
+    ``generators`` optionally gives every row its own ``torch.Generator``
+    (``None`` entries use the global RNG).
+    """
+
+    temperature: Union[float, torch.Tensor] = 1.0
+    topk: Union[int, torch.Tensor] = 50
+    top_p: Union[float, torch.Tensor] = 1.0
+    min_p: Union[float, torch.Tensor] = 0.0
+    generators: Optional[List[Optional[torch.Generator]]] = None
+    # largest top-k of all rows, the only value that has to live on the host
+    max_topk: int = field(default=None)
+
+    def __post_init__(self):
+        if self.max_topk is None:
+            self.max_topk = _max_topk(self.topk)
+
+    @classmethod
+    def create(
+        cls,
+        batch_size: int,
+        temperature: RowValues = 1.0,
+        topk: RowValues = 50,
+        top_p: RowValues = 1.0,
+        min_p: RowValues = 0.0,
+        generators: Optional[Sequence[Optional[torch.Generator]]] = None,
+        device=None,
+    ) -> "SamplingParams":
+        """settings from scalars or per-row sequences"""
+        if generators is not None:
+            generators = list(generators)
+            assert len(generators) == batch_size, "expected one generator per row"
+        return cls(
+            temperature=_per_row(temperature, batch_size, torch.float, device),
+            topk=_per_row(topk, batch_size, torch.long, device),
+            top_p=_per_row(top_p, batch_size, torch.float, device),
+            min_p=_per_row(min_p, batch_size, torch.float, device),
+            generators=generators,
+            max_topk=_max_topk(topk),
+        )
+
+    @classmethod
+    def cat(cls, params: Sequence["SamplingParams"], sizes: Sequence[int], device=None):
+        """stack the rows of several settings; ``sizes`` are their row counts"""
+
+        def _cat(name, dtype):
+            values = [getattr(p, name) for p in params]
+            if all(isinstance(v, (int, float)) for v in values) and len(set(values)) == 1:
+                return values[0]
+            return torch.cat(
+                [
+                    _per_row(v, size, dtype, device).to(device)
+                    if isinstance(v, torch.Tensor)
+                    else torch.full((size,), v, dtype=dtype, device=device)
+                    for v, size in zip(values, sizes)
+                ]
+            )
+
+        generators = None
+        if any(p.generators is not None for p in params):
+            generators = []
+            for p, size in zip(params, sizes):
+                generators += p.generators if p.generators is not None else [None] * size
+        return cls(
+            temperature=_cat("temperature", torch.float),
+            topk=_cat("topk", torch.long),
+            top_p=_cat("top_p", torch.float),
+            min_p=_cat("min_p", torch.float),
+            generators=generators,
+            max_topk=(
+                0
+                if any(p.max_topk == 0 for p in params)
+                else max(p.max_topk for p in params)
+            ),
+        )
+
+
+def _candidates(logits: torch.Tensor, params: SamplingParams):
+    """top-k/top-p/min-p filtered candidates of 2D ``logits``
+
+    Only a single ``torch.topk`` touches the whole vocabulary; temperature,
+    the per-row filters and normalization work on the ``max_topk`` sorted
+    candidates. Returns the scaled candidate logits (-inf where filtered, the
+    first candidate is always kept) and their vocabulary indices.
+    """
+    vocab_size = logits.size(-1)
+    k = params.max_topk if 0 < params.max_topk < vocab_size else vocab_size
+    scores, indices = torch.topk(logits, k, dim=-1)
+    scores = scores.float()
+    rank = torch.arange(k, device=logits.device)
+
+    temperature = params.temperature
+    if isinstance(temperature, torch.Tensor):
+        temperature = temperature.view(-1, 1)
+        scores = scores / torch.where(temperature > 0, temperature, 1.0)
+    elif temperature > 0:
+        scores = scores / temperature
+
+    remove = None
+    if isinstance(params.topk, torch.Tensor):
+        topk = params.topk.view(-1, 1)
+        remove = (rank >= topk) & (topk > 0)
+
+    min_p = params.min_p
+    if isinstance(min_p, torch.Tensor) or min_p > 0:
+        # p_i >= min_p * p_max  <=>  s_i >= s_max + log(min_p)
+        if isinstance(min_p, torch.Tensor):
+            log_min_p = torch.log(min_p.view(-1, 1).clamp_min(1e-30))
+        else:
+            log_min_p = math.log(min_p)
+        below = scores < scores[:, :1] + log_min_p
+        remove = below if remove is None else remove | below
+
+    if remove is not None:
+        scores = scores.masked_fill(remove, -float("inf"))
+
+    top_p = params.top_p
+    if isinstance(top_p, torch.Tensor) or top_p < 1.0:
+        probs = torch.softmax(scores, dim=-1)
+        mass_before = probs.cumsum(dim=-1) - probs
+        if isinstance(top_p, torch.Tensor):
+            top_p = top_p.view(-1, 1)
+        scores = scores.masked_fill(mass_before > top_p, -float("inf"))
+
+    return scores, indices
+
+
+def _exponential(scores: torch.Tensor, params: SamplingParams) -> torch.Tensor:
+    if params.generators is None:
+        return torch.empty_like(scores).exponential_(1)
+    return torch.stack(
+        [
+            torch.empty_like(row).exponential_(1, generator=generator)
+            for row, generator in zip(scores, params.generators)
+        ]
+    )
+
+
+def _uniform(values: torch.Tensor, params: SamplingParams) -> torch.Tensor:
+    """U[0, 1) shaped like ``values``, row ``i`` drawn from generator ``i``"""
+    if params.generators is None:
+        return torch.rand_like(values)
+    return torch.stack(
+        [
+            torch.rand(
+                row.shape, dtype=row.dtype, device=row.device, generator=generator
+            )
+            for row, generator in zip(values, params.generators)
+        ]
+    )
+
+
+def _multinomial(probs: torch.Tensor, params: SamplingParams) -> torch.Tensor:
+    """one index per row of ``probs`` [rows, n] -> [rows, 1] int, no host sync"""
+    choice = torch.argmax(probs / _exponential(probs, params), dim=-1, keepdim=True)
+    return choice.to(dtype=torch.int)
+
+
+def sample(logits: torch.Tensor, params: SamplingParams) -> torch.Tensor:
+    """sample one token per row of ``logits`` [rows, vocab] -> [rows, 1] int"""
+    scores, indices = _candidates(logits, params)
+    # exponential race over the unnormalized candidate weights, no host sync
+    weights = torch.exp(scores - scores[:, :1])
+    choice = torch.argmax(weights / _exponential(scores, params), dim=-1, keepdim=True)
+
+    temperature = params.temperature
+    if isinstance(temperature, torch.Tensor):
+        choice = torch.where(temperature.view(-1, 1) > 0, choice, 0)
+    elif temperature <= 0:
+        choice = torch.zeros_like(choice)
+    return indices.gather(-1, choice).to(dtype=torch.int)
+
+
+def probs(logits: torch.Tensor, params: SamplingParams) -> torch.Tensor:
+    """the full-vocabulary distribution ``sample`` draws from, same shape as ``logits``"""
+    shape = logits.shape
+    scores, indices = _candidates(logits.reshape(-1, shape[-1]), params)
+    candidate_probs = torch.softmax(scores, dim=-1)
+    temperature = params.temperature
+    if isinstance(temperature, torch.Tensor):
+        greedy = (temperature.view(-1, 1) <= 0) & (
+            torch.arange(scores.size(-1), device=scores.device) == 0
+        )
+        candidate_probs = torch.where(
+            temperature.view(-1, 1) > 0, candidate_probs, greedy.to(candidate_probs)
+        )
+    elif temperature <= 0:
+        candidate_probs = torch.zeros_like(candidate_probs)
+        candidate_probs[:, 0] = 1.0
+    out = torch.zeros(
+        indices.size(0), shape[-1], dtype=candidate_probs.dtype, device=logits.device
+    )
+    return out.scatter_(-1, indices, candidate_probs).view(shape)
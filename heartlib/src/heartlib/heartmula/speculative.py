@@ -0,0 +1,203 @@
+from dataclasses import dataclass, field
+from typing import List
+
+import torch
+
+from .kv_cache import _set_cache_len
+from .modeling_heartmula import HeartMuLa
+from .sampling import SamplingParams, _multinomial, _uniform
+
+
+@dataclass
+class SpeculativeStats:
+    """how many draft frames the target model accepted per verification round"""
+
+    accepted_lengths: List[int] = field(default_factory=list)
+    num_drafted: int = 0
+
+    @property
+    def num_rounds(self) -> int:
+        return len(self.accepted_lengths)
+
+    @property
+    def num_accepted(self) -> int:
+        return sum(self.accepted_lengths)
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.num_accepted / max(self.num_drafted, 1)
+
+    @property
+    def frames_per_forward(self) -> float:
+        """frames produced per target backbone forward (1.0 without speculation)"""
+        return (self.num_accepted + self.num_rounds) / max(self.num_rounds, 1)
+
+
+def _rewind(decoder, length: int) -> None:
+    for layer in decoder.layers:
+        _set_cache_len(layer.attn.kv_cache, length)
+
+
+class SpeculativeDecoder:
+    """Draft-and-verify frame decoding for a single song.
+
+    ``draft_model`` is a ``HeartMuLa`` with a small backbone (e.g. llama-300M)
+    that proposes ``num_draft_frames`` frames one by one. ``model`` then scores
+    them with a single multi-position backbone forward and one teacher-forced
+    depth decoder pass. A frame is read as its sequence of codebooks, and every
+    code is accepted with probability min(1, p / q). The first rejected code is
+    resampled from max(0, p - q), and the rest of that frame comes from the
+    target's depth decoder. This keeps the output distributed exactly like
+    plain decoding with ``model``, including the ``sampling`` filters and CFG.
+    Both models apply CFG on their own [cond, uncond] rows.
+    The acceptance tests and resampled codes draw from ``sampling.generators``
+    like the samples themselves, so a seeded song does not depend on the
+    global RNG.
+
+    Both models must have their caches set up for the same batch. ``prefill``
+    runs the draft over the prompt; the target prompt is expected to be in its
+    cache already.
+    """
+
+    def __init__(
+        self,
+        model: HeartMuLa,
+        draft_model: HeartMuLa,
+        num_draft_frames: int,
+        sampling: SamplingParams,
+        cfg_scale: float,
+        empty_id: int = 0,
+    ):
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_frames = num_draft_frames
+        self.sampling = sampling
+        self.cfg_scale = cfg_scale
+        self.empty_id = empty_id
+        self.stats = SpeculativeStats()
+
+    def _feed(self, model: HeartMuLa, frames: torch.Tensor, start: int, **kwargs):
+        b, s, n = frames.size()
+        tokens = torch.full(
+            (b, s, n + 1), self.empty_id, dtype=torch.long, device=frames.device
+        )
+        tokens[:, :, :-1] = frames
+        tokens_mask = torch.ones_like(tokens, dtype=torch.bool)
+        tokens_mask[..., -1] = False
+        input_pos = torch.arange(start, start + s, device=frames.device).expand(b, s)
+        return model.forward_backbone(
+            tokens, tokens_mask, input_pos, self.cfg_scale, **kwargs
+        )
+
+    def _sample(self, model: HeartMuLa, last_h: torch.Tensor, **kwargs):
+        return model.sample_frame(
+            last_h, None, None, self.cfg_scale, sampling=self.sampling, **kwargs
+        )
+
+    def prefill(
+        self,
+        tokens: torch.Tensor,
+        tokens_mask: torch.Tensor,
+        input_pos: torch.Tensor,
+        continuous_segments: torch.Tensor = None,
+        starts=None,
+    ) -> None:
+        self.draft_model.setup_caches(
+            tokens.size(0), self.model.backbone_cache_len
+        )
+        self.draft_model.forward_backbone(
+            tokens,
+            tokens_mask,
+            input_pos,
+            self.cfg_scale,
+            continuous_segments=continuous_segments,
+            starts=starts,
+        )
+        self.prompt_len = tokens.size(1)
+
+    def generate(self, frame: torch.Tensor):
+        """yields the frames [b, num_codebooks] that follow ``frame``
+
+        ``frame`` is the last sampled frame, it is not in either cache yet.
+        Iteration ends when the target cache is full.
+        """
+        target_len = draft_len = self.prompt_len
+        target_max = self.model.backbone_cache_len
+        draft_max = self.draft_model.backbone_cache_len
+        n = frame.size(1)
+        pending, unfed = frame, [frame]
+
+        while True:
+            k = min(
+                self.num_draft_frames,
+                target_max - target_len - 1,
+                draft_max - draft_len - len(unfed) + 1,
+            )
+            if target_len + 1 > target_max:
+                return
+            k = max(k, 0)
+
+            # draft k frames, the last one is not fed back into the draft
+            drafts, draft_probs = [], []
+            frames = torch.stack(unfed, dim=1)
+            for _ in range(k):
+                last_h = self._feed(self.draft_model, frames, draft_len)
+                draft_len += frames.size(1)
+                draft, q = self._sample(self.draft_model, last_h, return_probs=True)
+                drafts.append(draft)
+                draft_probs.append(q)
+                frames = draft.unsqueeze(1)
+
+            # score [pending, drafts...] with one target forward
+            h = self._feed(
+                self.model,
+                torch.stack([pending] + drafts, dim=1),
+                target_len,
+                all_positions=True,
+            )
+            num_accepted = 0
+            if k > 0:
+                x = torch.stack(drafts, dim=1)
+                p = self.model.frame_probs(
+                    h[:, :k], x, None, None, self.cfg_scale, sampling=self.sampling
+                )
+                q = torch.stack(draft_probs, dim=1)
+                x = x[: p.size(0)].unsqueeze(-1)
+                p_x = p.gather(-1, x).squeeze(-1)
+                q_x = q.gather(-1, x).squeeze(-1)
+                accept = _uniform(p_x, self.sampling) * q_x <= p_x
+                # codes are accepted in (frame, codebook) order until the first rejection
+                num_codes = int(accept[0].flatten().cumprod(0).sum())
+                num_accepted = num_codes // n
+
+            if num_accepted == k:
+                new_frame = self._sample(self.model, h[:, k])
+            else:
+                j, i = num_accepted, num_codes % n
+                residual = (p[:, j, i] - q[:, j, i]).clamp_min(0)
+                if not bool(residual.sum() > 0):
+                    residual = p[:, j, i]
+                code = _multinomial(residual, self.sampling)
+                prefix = torch.cat([x[:, j, :i, 0], code.to(x.dtype)], dim=1)
+                prefix = prefix.repeat(drafts[j].size(0) // prefix.size(0), 1)
+                new_frame = self._sample(self.model, h[:, j], prefix=prefix)
+
+            self.stats.accepted_lengths.append(num_accepted)
+            self.stats.num_drafted += k
+
+            # keep [pending, accepted drafts] in the target cache
+            target_len += 1 + num_accepted
+            _rewind(self.model.backbone, target_len)
+            if k == 0:
+                unfed.append(new_frame)
+            elif num_accepted == k:
+                unfed = [drafts[-1], new_frame]
+            else:
+                draft_len = draft_len - (k - 1) + num_accepted
+                _rewind(self.draft_model.backbone, draft_len)
+                unfed = [new_frame]
+            pending = new_frame
+
+            for draft in drafts[:num_accepted]:
+                yield draft
+            yield new_frame
@@ -1,17 +1,94 @@
 from transformers.pipelines.base import Pipeline
 from tokenizers import Tokenizer
-from ..heartmula.modeling_heartmula import HeartMuLa
+from ..heartmula.modeling_heartmula import HeartMuLa, _padded_causal_mask
+from ..heartmula.kv_cache import (
+    PrefixCache,
+    PrefixEntry,
+    UnconditionalPrefix,
+    fork_kv,
+    narrow_kv,
+    restore_kv,
+    shrink_kv,
+    snapshot_kv,
+)
+from ..heartmula.speculative import SpeculativeDecoder
+from ..heartmula.decode_session import DecodeSession
+from ..heartmula.sampling import SamplingParams
 from ..heartcodec.modeling_heartcodec import HeartCodec
 import torch
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from tqdm import tqdm
 import soundfile as sf  # Use soundfile instead of torchaudio for saving (avoids torchcodec issues)
 import json
+from functools import lru_cache
 from transformers import BitsAndBytesConfig
 
 
+# frames handed to the codec worker at once with ``overlap_codec``
+_CODEC_PUSH_FRAMES = 80
+# forward params of ``_forward`` only, ``_generate_frames`` does not take them
+_CODEC_PARAMS = ("detokenize", "overlap_codec")
+
+# decode sessions kept for reuse, e.g. one per phase of a CFG schedule
+_MAX_DECODE_SESSIONS = 4
+
+
+def _repeat_per_song(values, n: int):
+    """per-song sampling values -> per-candidate values, song-major"""
+    if isinstance(values, (int, float)):
+        return values
+    return torch.as_tensor(values).view(-1).repeat_interleave(n)
+
+
+def _codec_generators(num_songs: int, generator=None) -> List[torch.Generator]:
+    """CPU generators of the songs' codec noise, seeded on the caller's thread
+
+    The seed is that of the first ``generator``, or else drawn from the global
+    RNG, so the audio is the same whether the codec overlaps with the LM or not.
+    """
+    if isinstance(generator, (list, tuple)):
+        generator = generator[0]
+    if generator is None:
+        seed = int(torch.randint(2**62, ()))
+    else:
+        seed = generator.initial_seed()
+    return [torch.Generator().manual_seed(seed + j) for j in range(num_songs)]
+
+
+def _spawn(generator: torch.Generator) -> torch.Generator:
+    """an independent generator seeded from ``generator``"""
+    seed = torch.randint(2**62, (), generator=generator, device=generator.device)
+    return torch.Generator(device=generator.device).manual_seed(seed.item())
+
+
+def _song_paths(path: Union[None, str, List[str]], n: int) -> List[Optional[str]]:
+    """one path per song: ``<root>_<i><ext>`` for a single path"""
+    if path is None:
+        return [None] * n
+    if isinstance(path, str):
+        root, ext = os.path.splitext(path)
+        return [f"{root}_{i}{ext}" for i in range(n)]
+    assert len(path) == n, f"expected {n} save paths, but got {len(path)}"
+    return path
+
+
+def _cfg_phase(
+    frame: int,
+    cfg_frames: Optional[Tuple[int, int]],
+    cfg_codebooks: Optional[int],
+) -> Tuple[bool, Optional[int]]:
+    """(unconditional rows kept, guided codebooks) for sampling frame ``frame``"""
+    if cfg_frames is None:
+        return True, cfg_codebooks
+    begin, end = cfg_frames
+    if frame >= end:
+        return False, None
+    # before the interval the unconditional rows only follow along
+    return True, 0 if frame < begin else cfg_codebooks
+
+
 @dataclass
 class HeartMuLaGenConfig:
     text_bos_id: int = 128000
@@ -26,6 +103,53 @@ class HeartMuLaGenConfig:
         return cls(**data)
 
 
+@dataclass
+class DecodeSnapshot:
+    """decode state after ``num_frames`` frames, enough to continue from there"""
+
+    model_inputs: Dict[str, Any]
+    kv: List[Tuple[torch.Tensor, ...]]
+    # [num_songs, num_quantizers, num_frames] and [num_songs, num_frames]
+    frames: torch.Tensor
+    alive: torch.Tensor
+    # input of the next decode step [rows, num_quantizers] and its positions
+    token: torch.Tensor
+    input_pos: torch.Tensor
+    cache_len: int
+    cfg_scale: float
+    kv_window: Optional[int] = None
+    num_candidates: int = 1
+    cfg_frames: Optional[Union[int, Tuple[int, int]]] = None
+    cfg_codebooks: Optional[int] = None
+    # taken after ``cfg_frames``: the unconditional rows already left the batch
+    cfg_dropped: bool = False
+
+    @property
+    def num_frames(self) -> int:
+        return self.frames.shape[-1]
+
+    def to(self, device) -> "DecodeSnapshot":
+        def _to(x):
+            return x.to(device) if isinstance(x, torch.Tensor) else x
+
+        return replace(
+            self,
+            model_inputs={k: _to(v) for k, v in self.model_inputs.items()},
+            kv=[tuple(t.to(device) for t in state) for state in self.kv],
+            frames=_to(self.frames),
+            alive=_to(self.alive),
+            token=_to(self.token),
+            input_pos=_to(self.input_pos),
+        )
+
+    def save(self, path: str) -> None:
+        torch.save(vars(self), path)
+
+    @classmethod
+    def load(cls, path: str, device=None) -> "DecodeSnapshot":
+        return cls(**torch.load(path, map_location=device or "cpu"))
+
+
 class HeartMuLaGenPipeline(Pipeline):
     def __init__(
         self,
@@ -47,20 +171,274 @@ class HeartMuLaGenPipeline(Pipeline):
         self._parallel_number = audio_codec.config.num_quantizers + 1
         self._muq_dim = model.config.muq_dim
 
+        self._encode = lru_cache(maxsize=256)(
+            lambda text: tuple(self.text_tokenizer.encode(text).ids)
+        )
+        self.prefix_cache = None
+        # shared by the unconditional rows of every CFG prompt, None turns it off
+        self.uncond_prefix = UnconditionalPrefix()
+        self.draft_model = None
+        self.num_draft_frames = 4
+        self.speculative_stats = None
+        self.compile_kwargs = None
+        self.decode_sessions = []
+        self.snapshot_interval = None
+        self.snapshot_dir = None
+        self.snapshots = {}
+
+    def enable_prefix_cache(
+        self, max_bytes: int = 4 << 30, spill_dir: Optional[str] = None
+    ) -> PrefixCache:
+        """reuse the backbone prefill of repeated tags/lyrics across calls
+
+        Post-prefill KV states are kept in an LRU cache of at most ``max_bytes``,
+        evicted entries are written to ``spill_dir`` when it is given.
+        """
+        self.prefix_cache = PrefixCache(max_bytes=max_bytes, spill_dir=spill_dir)
+        return self.prefix_cache
+
+    def enable_speculative_decoding(
+        self, draft_model: Optional[HeartMuLa], num_draft_frames: int = 4
+    ) -> None:
+        """let a small ``draft_model`` propose ``num_draft_frames`` frames per step
+
+        The draft has to share the audio vocabulary and live on the same device
+        and dtype as ``model``; ``None`` turns speculative decoding off again.
+        Only single songs are decoded speculatively, batches of prompts take the
+        regular loop. After a call, ``speculative_stats`` holds the accepted
+        draft lengths.
+        """
+        self.draft_model = draft_model
+        self.num_draft_frames = num_draft_frames
+        if draft_model is not None:
+            draft_model.quantize_kv_cache = self.model.quantize_kv_cache
+
+    def enable_kv_cache_quantization(self, enabled: bool = True) -> None:
+        """store the backbone KV caches as int8 with per-vector scales
+
+        Roughly halves the cache memory of a bf16 model; see
+        ``QuantizedKVCache``. Applies to the draft model as well.
+        """
+        self.model.quantize_kv_cache = enabled
+        if self.draft_model is not None:
+            self.draft_model.quantize_kv_cache = enabled
+
+    def enable_snapshots(
+        self, interval: Optional[int] = 750, snapshot_dir: Optional[str] = None
+    ) -> None:
+        """snapshot the decode state every ``interval`` frames for ``resume``
+
+        After a call, ``snapshots`` maps frame counts to ``DecodeSnapshot``s in
+        host memory, or to the files they were saved to in ``snapshot_dir``.
+        ``interval=None`` turns snapshots off again. Calls with snapshots never
+        decode speculatively.
+        """
+        self.snapshot_interval = interval
+        self.snapshot_dir = snapshot_dir
+        if snapshot_dir is not None:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+    def resume(self, snapshot: Union[int, str, DecodeSnapshot], **kwargs):
+        """continue a take from a snapshot, e.g. with a new seed or settings
+
+        ``snapshot`` is a frame count in ``snapshots``, a ``DecodeSnapshot`` or a
+        file it was saved to. Its ``num_frames`` frames are kept and the rest of
+        the song is sampled again with ``kwargs`` (as for ``__call__``); the
+        output is saved and returned like ``__call__`` does. ``cfg_scale``,
+        ``kv_window``, ``num_candidates`` and the CFG schedule are those of the
+        snapshot.
+        """
+        take = self.snapshots
+        if isinstance(snapshot, int):
+            snapshot = take[snapshot]
+        # resuming the latest take: the new one shares its frames up to the
+        # snapshot, and with them the snapshots taken on the way there
+        earlier = {}
+        if any(s is snapshot for s in take.values()):
+            earlier = {n: s for n, s in take.items() if n <= snapshot.num_frames}
+        if isinstance(snapshot, str):
+            snapshot = DecodeSnapshot.load(snapshot)
+        kwargs.update(
+            cfg_scale=snapshot.cfg_scale,
+            kv_window=snapshot.kv_window,
+            num_candidates=snapshot.num_candidates,
+            cfg_frames=snapshot.cfg_frames,
+            cfg_codebooks=snapshot.cfg_codebooks,
+        )
+        _, forward_params, postprocess_params = self._sanitize_parameters(**kwargs)
+        model_outputs = self.forward(
+            snapshot.model_inputs, resume=snapshot, **forward_params
+        )
+        self.snapshots = {**earlier, **self.snapshots}
+        if not snapshot.model_inputs["batched"]:
+            return self.postprocess(model_outputs, **postprocess_params)
+        return self._postprocess_batch(model_outputs, **postprocess_params)
+
+    def _save_snapshot(self, snapshot: DecodeSnapshot) -> None:
+        snapshot = snapshot.to("cpu")
+        if self.snapshot_dir is None:
+            self.snapshots[snapshot.num_frames] = snapshot
+            return
+        path = os.path.join(self.snapshot_dir, f"frame_{snapshot.num_frames:06d}.pt")
+        snapshot.save(path)
+        self.snapshots[snapshot.num_frames] = path
+
+    def enable_compile(self, **compile_kwargs) -> None:
+        """run the per-frame decode step under ``torch.compile(**compile_kwargs)``
+
+        Compilation happens on the first frame of a call with new batch size or
+        sampling settings; ``warmup`` triggers it ahead of time.
+        """
+        self.compile_kwargs = compile_kwargs
+        self.decode_sessions = []
+
+    def warmup(self, inputs, num_frames: int = 3, **kwargs) -> None:
+        """decode ``num_frames`` throwaway frames for ``inputs`` with ``kwargs``
+
+        Compiles the decode step for the same batch shape and sampling settings
+        as a later call. The RNG state is left untouched. Compiled steps also
+        guard on the grad mode: this runs under ``no_grad`` like a pipeline
+        call, code decoding under ``torch.inference_mode`` warms up inside it.
+        """
+        preprocess_params, forward_params, _ = self._sanitize_parameters(**kwargs)
+        forward_params["max_audio_length_ms"] = num_frames * 80
+        for name in _CODEC_PARAMS:
+            forward_params.pop(name)
+        model_inputs = self.preprocess(inputs, **preprocess_params)
+        model_inputs = self._ensure_tensor_on_device(model_inputs, device=self.device)
+        devices = [self.device] if self.device.type == "cuda" else []
+        with torch.random.fork_rng(devices=devices), self.get_inference_context()():
+            for _ in self._generate_frames(model_inputs, **forward_params):
+                pass
+
+    def _audio_window(
+        self, prompt_len: int, max_audio_frames: int, kv_window: Optional[int]
+    ) -> Optional[int]:
+        """audio frames kept in the backbone caches, ``None`` keeps every frame"""
+        if kv_window is None:
+            # past the backbone's context, slide over whatever room the prompt leaves
+            if prompt_len + max_audio_frames <= self.model.backbone.max_seq_len:
+                return None
+            kv_window = self.model.backbone.max_seq_len - prompt_len
+        assert 0 < kv_window <= self.model.backbone.max_seq_len - prompt_len, (
+            f"kv_window must be in [1, {self.model.backbone.max_seq_len - prompt_len}]"
+            f" for a prompt of {prompt_len} tokens, but got {kv_window}"
+        )
+        return kv_window if kv_window < max_audio_frames else None
+
+    def _cache_len(
+        self,
+        prompt_len: int,
+        max_audio_length_ms: int,
+        kv_window: Optional[int] = None,
+    ) -> int:
+        # the prompt plus one cache entry per decode step, or per windowed frame
+        max_audio_frames = max_audio_length_ms // 80
+        window = self._audio_window(prompt_len, max_audio_frames, kv_window)
+        cache_len = prompt_len + (max_audio_frames if window is None else window)
+        if self.compile_kwargs is not None:
+            # compiled steps specialize on the cache length, keep the shapes few
+            cache_len = -(-cache_len // 1024) * 1024
+        return cache_len
+
+    def estimate_memory(self, inputs, **kwargs) -> Dict[str, int]:
+        """bytes of the KV caches a call with these arguments allocates
+
+        Nothing is allocated, only the prompts are tokenized. Weights and
+        activations are not included.
+        """
+        preprocess_params, forward_params, _ = self._sanitize_parameters(**kwargs)
+        model_inputs = self.preprocess(inputs, **preprocess_params)
+        batch_size, prompt_len = model_inputs["tokens"].shape[:2]
+        batch_size *= forward_params["num_candidates"]
+        max_seq_len = self._cache_len(
+            prompt_len,
+            forward_params["max_audio_length_ms"],
+            forward_params["kv_window"],
+        )
+        sizes = self.model.cache_nbytes(batch_size, max_seq_len)
+        if self.draft_model is not None:
+            draft = self.draft_model.cache_nbytes(batch_size, max_seq_len)
+            sizes.update({f"draft_{k}": v for k, v in draft.items() if k != "total"})
+            sizes["total"] += draft["total"]
+        return sizes
+
+    def _decode_session(
+        self,
+        batch_size: int,
+        sampling: SamplingParams,
+        cfg_scale: float,
+        pad_lens: Optional[torch.Tensor],
+        cfg_codebooks: Optional[int] = None,
+    ) -> DecodeSession:
+        # sessions are kept across calls so that compiled steps are reused, a
+        # CFG schedule switches between a few of them within one call
+        for session in self.decode_sessions:
+            if session.model is self.model and session.matches(
+                batch_size, sampling, cfg_scale, pad_lens is not None, cfg_codebooks
+            ):
+                return session
+        session = DecodeSession(
+            self.model, batch_size, sampling, cfg_scale, pad_lens, cfg_codebooks
+        )
+        if self.compile_kwargs is not None:
+            session.compile(**self.compile_kwargs)
+        self.decode_sessions = self.decode_sessions[-(_MAX_DECODE_SESSIONS - 1) :]
+        self.decode_sessions.append(session)
+        return session
+
     def _sanitize_parameters(self, **kwargs):
         preprocess_kwargs = {"cfg_scale": kwargs.get("cfg_scale", 1.5)}
         forward_kwargs = {
             "max_audio_length_ms": kwargs.get("max_audio_length_ms", 120_000),
             "temperature": kwargs.get("temperature", 1.0),
             "topk": kwargs.get("topk", 50),
+            "top_p": kwargs.get("top_p", 1.0),
+            "min_p": kwargs.get("min_p", 0.0),
+            "generator": kwargs.get("generator", None),
             "cfg_scale": kwargs.get("cfg_scale", 1.5),
+            "eos_check_interval": kwargs.get("eos_check_interval", 1),
+            "kv_window": kwargs.get("kv_window", None),
+            "num_candidates": kwargs.get("num_candidates", 1),
+            "cfg_frames": kwargs.get("cfg_frames", None),
+            "cfg_codebooks": kwargs.get("cfg_codebooks", None),
+            "detokenize": kwargs.get("detokenize", True),
+            "overlap_codec": kwargs.get("overlap_codec", False),
         }
         postprocess_kwargs = {
             "save_path": kwargs.get("save_path", "output.mp3"),
+            "codes_path": kwargs.get("codes_path", None),
         }
         return preprocess_kwargs, forward_kwargs, postprocess_kwargs
 
-    def preprocess(self, inputs: Dict[str, Any], cfg_scale: float):
+    def __call__(self, inputs, *args, **kwargs):
+        if not isinstance(inputs, list):
+            return super().__call__(inputs, *args, **kwargs)
+
+        # a list of {tags, lyrics} is generated as one padded batch instead of
+        # being iterated one song at a time
+        preprocess_params, forward_params, postprocess_params = (
+            self._sanitize_parameters(**kwargs)
+        )
+        model_inputs = self.preprocess(inputs, **preprocess_params)
+        model_outputs = self.forward(model_inputs, **forward_params)
+        return self._postprocess_batch(model_outputs, **postprocess_params)
+
+    def _postprocess_batch(self, model_outputs, save_path, codes_path=None):
+        num_songs = len(model_outputs["codes"])
+        return [
+            self.postprocess(
+                {"wav": wav, "codes": codes}, save_path=path, codes_path=song_codes_path
+            )
+            for wav, codes, path, song_codes_path in zip(
+                model_outputs["wav"],
+                model_outputs["codes"],
+                _song_paths(save_path, num_songs),
+                _song_paths(codes_path, num_songs),
+            )
+        ]
+
+    def _build_prompt(self, inputs: Dict[str, Any]):
 
         # process tags
         tags = inputs["tags"]
@@ -76,7 +454,7 @@ class HeartMuLaGenPipeline(Pipeline):
         if not tags.endswith("</tag>"):
             tags = f"{tags}</tag>"
 
-        tags_ids = self.text_tokenizer.encode(tags).ids
+        tags_ids = list(self._encode(tags))
         if tags_ids[0] != self.config.text_bos_id:
             tags_ids = [self.config.text_bos_id] + tags_ids
         if tags_ids[-1] != self.config.text_eos_id:
@@ -99,7 +477,7 @@ class HeartMuLaGenPipeline(Pipeline):
         ), f"lyrics must be a string, but got {type(lyrics)}"
         lyrics = lyrics.lower()
 
-        lyrics_ids = self.text_tokenizer.encode(lyrics).ids
+        lyrics_ids = list(self._encode(lyrics))
         if lyrics_ids[0] != self.config.text_bos_id:
             lyrics_ids = [self.config.text_bos_id] + lyrics_ids
         if lyrics_ids[-1] != self.config.text_eos_id:
@@ -115,98 +493,586 @@ class HeartMuLaGenPipeline(Pipeline):
         tokens_mask = torch.zeros_like(tokens, dtype=torch.bool)
         tokens_mask[:, -1] = True
 
+        return tokens, tokens_mask, muq_embed, muq_idx
+
+    def preprocess(self, inputs: Dict[str, Any], cfg_scale: float):
+        batched = isinstance(inputs, list)
+        prompts = [self._build_prompt(x) for x in (inputs if batched else [inputs])]
+
+        # left-pad every prompt to the longest one so that all rows start
+        # sampling audio at the same cache index
+        max_len = max(p[0].shape[0] for p in prompts)
+        tokens, tokens_mask, muq_embed, muq_idx, pos, pad_lens = [], [], [], [], [], []
+        for p_tokens, p_tokens_mask, p_muq_embed, p_muq_idx in prompts:
+            prompt_len = p_tokens.shape[0]
+            pad_len = max_len - prompt_len
+            tokens.append(
+                torch.cat([p_tokens.new_zeros(pad_len, p_tokens.shape[1]), p_tokens])
+            )
+            tokens_mask.append(
+                torch.cat(
+                    [p_tokens_mask.new_zeros(pad_len, p_tokens.shape[1]), p_tokens_mask]
+                )
+            )
+            muq_embed.append(p_muq_embed)
+            muq_idx.append(pad_len + p_muq_idx)
+            pos.append(
+                torch.cat(
+                    [
+                        torch.zeros(pad_len, dtype=torch.long),
+                        torch.arange(prompt_len, dtype=torch.long),
+                    ]
+                )
+            )
+            pad_lens.append(pad_len)
+
         bs_size = 2 if cfg_scale != 1.0 else 1
 
         def _cfg_cat(tensor: torch.Tensor, cfg_scale: float):
-            tensor = tensor.unsqueeze(0)
             if cfg_scale != 1.0:
                 tensor = torch.cat([tensor, tensor], dim=0)
             return tensor
 
         return {
-            "tokens": _cfg_cat(tokens, cfg_scale),
-            "tokens_mask": _cfg_cat(tokens_mask, cfg_scale),
-            "muq_embed": _cfg_cat(muq_embed, cfg_scale),
-            "muq_idx": [muq_idx] * bs_size,
-            "pos": _cfg_cat(torch.arange(prompt_len, dtype=torch.long), cfg_scale),
+            "tokens": _cfg_cat(torch.stack(tokens), cfg_scale),
+            "tokens_mask": _cfg_cat(torch.stack(tokens_mask), cfg_scale),
+            "muq_embed": _cfg_cat(torch.stack(muq_embed), cfg_scale),
+            "muq_idx": muq_idx * bs_size,
+            "pos": _cfg_cat(torch.stack(pos), cfg_scale),
+            "pad_lens": _cfg_cat(torch.tensor(pad_lens, dtype=torch.long), cfg_scale),
+            "batched": batched,
         }
 
-    def _forward(
+    def _generate_frames(
         self,
         model_inputs: Dict[str, Any],
         max_audio_length_ms: int,
         temperature: float,
         topk: int,
         cfg_scale: float,
+        top_p: float = 1.0,
+        min_p: float = 0.0,
+        generator=None,
+        eos_check_interval: int = 1,
+        kv_window: Optional[int] = None,
+        resume: Optional[DecodeSnapshot] = None,
+        snapshot_interval: Optional[int] = None,
+        num_candidates: int = 1,
+        cfg_frames: Optional[Union[int, Tuple[int, int]]] = None,
+        cfg_codebooks: Optional[int] = None,
     ):
+        """yields ([num_songs, num_quantizers] frame, [num_songs] alive) per step
+
+        ``alive`` is False for songs that already emitted EOS; their frames are
+        to be dropped. Both stay on the model device. Whether every song is
+        finished is only checked every ``eos_check_interval`` frames, so up to
+        ``eos_check_interval - 1`` extra frames may be yielded with all songs dead.
+
+        ``temperature``, ``topk``, ``top_p`` and ``min_p`` are either shared or
+        given per song as a list. ``generator`` is a ``torch.Generator`` or a
+        list with one per song.
+
+        ``kv_window`` bounds the backbone caches to the prompt plus that many
+        recent audio frames (long-form generation). The prompt stays pinned;
+        whenever the window is full its oldest quarter is evicted and the kept
+        frames move to earlier positions, so memory and per-frame cost stay flat
+        however long the song gets. Songs that would not fit the backbone's
+        ``max_seq_len`` get the largest window that does.
+
+        ``resume`` continues from a ``DecodeSnapshot`` of the same inputs: its
+        frames are yielded again and decoding goes on from there. Snapshots are
+        saved every ``snapshot_interval`` frames.
+
+        ``num_candidates`` decodes every song that many times from a single
+        prefill: the prompt's cache rows are forked and every candidate samples
+        with its own RNG stream. Candidates then count as songs, song-major.
+
+        ``cfg_frames`` and ``cfg_codebooks`` schedule CFG. Guidance only applies
+        to frames ``[begin, end)`` of ``cfg_frames`` (an int K is ``(0, K)``);
+        once it ends the unconditional rows leave the batch and their backbone
+        cache rows are freed, so the rest of the song decodes at half the batch.
+        ``cfg_codebooks`` guides only the first that many codebooks of a frame;
+        with 1 the depth decoder runs on the conditional rows alone.
+        """
+        prompt_tokens = model_inputs["tokens"]
+        prompt_pos = model_inputs["pos"]
+        pad_lens = model_inputs["pad_lens"]
+
+        # rows are laid out as [cond_0 .. cond_n, uncond_0 .. uncond_n]
+        prompt_rows = prompt_tokens.shape[0]
+        num_prompts = prompt_rows // 2 if cfg_scale != 1.0 else prompt_rows
+        prompt_len = prompt_tokens.shape[1]
+        padded = bool(torch.any(pad_lens > 0))
+        if isinstance(generator, torch.Generator):
+            generator = [generator] * num_prompts
+        if isinstance(cfg_frames, int):
+            cfg_frames = (0, cfg_frames)
+        if cfg_frames is not None:
+            assert 0 <= cfg_frames[0] < cfg_frames[1], "cfg_frames must be a range"
+        if cfg_codebooks is not None:
+            num_codebooks = self.model.config.audio_num_codebooks
+            assert (
+                1 <= cfg_codebooks <= num_codebooks
+            ), f"cfg_codebooks must be in [1, {num_codebooks}]"
+        scheduled = cfg_scale != 1.0 and (
+            cfg_frames is not None or cfg_codebooks is not None
+        )
+        if not scheduled:
+            cfg_frames = cfg_codebooks = None
+        # snapshots keep the take's scale, ``cfg_scale`` drops to 1 after the window
+        take_cfg_scale = cfg_scale
+
+        fork = torch.arange(prompt_rows, device=self.device)
+        if num_candidates > 1:
+            # [c_0 .. c_n, u_0 .. u_n] -> [c_00 .. c_0k, c_10 .., u_00 .. u_0k, ..]
+            fork = fork.repeat_interleave(num_candidates)
+            prompt_pos, pad_lens = prompt_pos[fork], pad_lens[fork]
+            temperature, topk, top_p, min_p = (
+                _repeat_per_song(values, num_candidates)
+                for values in (temperature, topk, top_p, min_p)
+            )
+            if generator is not None:
+                generator = [_spawn(g) for g in generator for _ in range(num_candidates)]
+        bs_size = prompt_rows * num_candidates
+        num_songs = num_prompts * num_candidates
+        sampling = SamplingParams.create(
+            num_songs, temperature, topk, top_p, min_p, generator, device=self.device
+        )
+
+        max_audio_frames = max_audio_length_ms // 80
+        window = self._audio_window(prompt_len, max_audio_frames, kv_window)
+        self.model.setup_caches(
+            bs_size, self._cache_len(prompt_len, max_audio_length_ms, kv_window)
+        )
+
+        if resume is None:
+            with narrow_kv(self.model.backbone, prompt_rows):
+                last_h = self._prefill(model_inputs, cfg_scale)
+            if num_candidates > 1:
+                fork_kv(self.model.backbone, fork, prompt_len)
+                last_h = last_h[fork]
+            with torch.autocast(device_type=self.device.type, dtype=self.dtype):
+                curr_token = self.model.sample_frame(
+                    last_h,
+                    temperature,
+                    topk,
+                    cfg_scale,
+                    sampling=sampling,
+                    cfg_codebooks=_cfg_phase(0, cfg_frames, cfg_codebooks)[1],
+                )
+            # EOS is tracked on device and only read back every eos_check_interval
+            # frames, so the loop does not wait for the device after each frame
+            alive = torch.ones(num_songs, dtype=torch.bool, device=curr_token.device)
+            history = [(curr_token[:num_songs], alive)]
+            input_pos = prompt_pos[..., -1:] + 1
+            cache_len = prompt_len
+        else:
+            assert resume.num_frames <= max_audio_frames, "snapshot is past the end"
+            resume = resume.to(self.device)
+            if resume.cfg_dropped:
+                # taken after the CFG interval, the unconditional rows are gone
+                shrink_kv(self.model.backbone, num_songs)
+            restore_kv(self.model.backbone, resume.kv)
+            curr_token = resume.token
+            history = list(zip(resume.frames.unbind(-1), resume.alive.unbind(-1)))
+            alive = history[-1][1]
+            input_pos = resume.input_pos
+            cache_len = resume.cache_len
+        yield from history
+        start = len(history) - 1
+        phase = _cfg_phase(start, cfg_frames, cfg_codebooks)
+        if not phase[0]:
+            bs_size, cfg_scale, pad_lens = num_songs, 1.0, pad_lens[:num_songs]
+        if snapshot_interval is not None:
+            self.snapshots = {}
+
+        # speculative decoding keeps a single song with all of its frames in its
+        # own caches, batches of prompts or candidates and windows fall back to
+        # the decode session
+        if (
+            self.draft_model is not None
+            and num_songs == 1
+            and window is None
+            and resume is None
+            and snapshot_interval is None
+            and not scheduled
+        ):
+            yield from self._speculative_frames(
+                model_inputs,
+                curr_token,
+                max_audio_length_ms // 80,
+                sampling,
+                cfg_scale,
+            )
+            return
+
+        session = self._decode_session(
+            bs_size, sampling, cfg_scale, pad_lens if padded else None, phase[1]
+        )
+        session.start(
+            input_pos,
+            cache_len,
+            pad_lens if padded else None,
+            sampling=sampling,
+        )
+
+        pbar = tqdm(total=max_audio_frames, initial=start)
+        for i in range(start, max_audio_frames):
+            if (
+                snapshot_interval is not None
+                and (i + 1) % snapshot_interval == 0
+                and (i > start or resume is None)
+            ):
+                self._save_snapshot(
+                    DecodeSnapshot(
+                        model_inputs=model_inputs,
+                        kv=snapshot_kv(self.model.backbone, cache_len),
+                        frames=torch.stack([frame for frame, _ in history], dim=-1),
+                        alive=torch.stack([a for _, a in history], dim=-1),
+                        token=curr_token,
+                        input_pos=session.input_pos.clone(),
+                        cache_len=cache_len,
+                        cfg_scale=take_cfg_scale,
+                        kv_window=kv_window,
+                        num_candidates=num_candidates,
+                        cfg_frames=cfg_frames,
+                        cfg_codebooks=cfg_codebooks,
+                        cfg_dropped=not phase[0],
+                    )
+                )
+            if _cfg_phase(i + 1, cfg_frames, cfg_codebooks) != phase:
+                phase = _cfg_phase(i + 1, cfg_frames, cfg_codebooks)
+                input_pos = session.input_pos
+                if not phase[0]:
+                    shrink_kv(self.model.backbone, num_songs)
+                    bs_size, cfg_scale = num_songs, 1.0
+                    curr_token = curr_token[:num_songs]
+                    input_pos, pad_lens = input_pos[:num_songs], pad_lens[:num_songs]
+                session = self._decode_session(
+                    bs_size, sampling, cfg_scale, pad_lens if padded else None, phase[1]
+                )
+                session.start(
+                    input_pos.clone(),
+                    cache_len,
+                    pad_lens if padded else None,
+                    sampling=sampling,
+                )
+            if window is not None and cache_len == prompt_len + window:
+                evict = max(window // 4, 1)
+                self.model.evict_backbone_entries(prompt_len, evict, cache_len)
+                session.shift_positions(evict)
+                cache_len -= evict
+            cache_len += 1
+            with torch.autocast(device_type=self.device.type, dtype=self.dtype):
+                curr_token = session.step(curr_token)
+            # a song is frozen after its first EOS
+            eos = torch.any(curr_token[:num_songs] >= self.config.audio_eos_id, dim=-1)
+            alive = alive & ~eos
+            if (i + 1) % eos_check_interval == 0 or i + 1 == max_audio_frames:
+                pbar.update(i + 1 - pbar.n)
+                if not bool(alive.any()):
+                    break
+            if snapshot_interval is not None:
+                history.append((curr_token[:num_songs].clone(), alive))
+            yield curr_token[:num_songs], alive
+        pbar.close()
+
+    def _prefill(self, model_inputs: Dict[str, Any], cfg_scale: float) -> torch.Tensor:
+        """fill the backbone caches with the prompt, return its last hidden state"""
         prompt_tokens = model_inputs["tokens"]
         prompt_tokens_mask = model_inputs["tokens_mask"]
         continuous_segment = model_inputs["muq_embed"]
         starts = model_inputs["muq_idx"]
         prompt_pos = model_inputs["pos"]
+        pad_lens = model_inputs["pad_lens"]
+        prompt_len = prompt_tokens.shape[1]
 
-        frames = []
+        entry = None
+        if self.prefix_cache is not None:
+            key = PrefixCache.make_key(
+                prompt_tokens,
+                prompt_tokens_mask,
+                prompt_pos,
+                continuous_segment,
+                torch.tensor(
+                    list(starts)
+                    + [int(cfg_scale > 1.0), int(self.model.quantize_kv_cache)]
+                ),
+                dtype=self.dtype,
+            )
+            entry = self.prefix_cache.get(key, device=self.device)
 
-        bs_size = 2 if cfg_scale != 1.0 else 1
-        self.model.setup_caches(bs_size)
+        if entry is None:
+            rows = prompt_tokens.shape[0]
+            with torch.autocast(device_type=self.device.type, dtype=self.dtype):
+                if cfg_scale > 1.0 and self.uncond_prefix is not None:
+                    # only the conditional rows depend on the prompt's content
+                    self.uncond_prefix.extend(self.model, prompt_len)
+                    with narrow_kv(self.model.backbone, rows // 2):
+                        last_h = self._forward_prompt(model_inputs, rows // 2, 1.0)
+                    uncond_h = self.uncond_prefix.install(
+                        self.model,
+                        list(range(rows // 2, rows)),
+                        pad_lens[rows // 2 :].tolist(),
+                        prompt_len,
+                    )
+                    last_h = torch.cat([last_h, uncond_h])
+                else:
+                    last_h = self._forward_prompt(model_inputs, rows, cfg_scale)
+            if self.prefix_cache is not None:
+                self.prefix_cache.put(
+                    key,
+                    PrefixEntry(snapshot_kv(self.model.backbone, prompt_len), last_h),
+                )
+        else:
+            restore_kv(self.model.backbone, entry.kv)
+            last_h = entry.last_h
+        return last_h
+
+    def _forward_prompt(
+        self, model_inputs: Dict[str, Any], num_rows: int, cfg_scale: float
+    ) -> torch.Tensor:
+        """run the backbone over the prompt of the first ``num_rows`` rows"""
+        pad_lens = model_inputs["pad_lens"][:num_rows]
+        prompt_len = model_inputs["tokens"].shape[1]
+        mask = None
+        if bool(torch.any(pad_lens > 0)):
+            cache_pos = torch.arange(prompt_len, device=pad_lens.device)
+            mask = _padded_causal_mask(cache_pos, pad_lens, prompt_len)
+        return self.model.forward_backbone(
+            tokens=model_inputs["tokens"][:num_rows],
+            tokens_mask=model_inputs["tokens_mask"][:num_rows],
+            input_pos=model_inputs["pos"][:num_rows],
+            cfg_scale=cfg_scale,
+            continuous_segments=model_inputs["muq_embed"][:num_rows],
+            starts=model_inputs["muq_idx"][:num_rows],
+            mask=mask,
+        )
+
+    def _speculative_frames(
+        self,
+        model_inputs: Dict[str, Any],
+        curr_token: torch.Tensor,
+        max_audio_frames: int,
+        sampling: SamplingParams,
+        cfg_scale: float,
+    ):
+        num_songs = len(model_inputs["pad_lens"]) // (2 if cfg_scale != 1.0 else 1)
+        assert num_songs == 1, "speculative decoding only supports a single song"
+        # a single row, the verifier's distributions take scalar settings
+        sampling = replace(
+            sampling,
+            **{
+                name: value.item()
+                for name in ("temperature", "topk", "top_p", "min_p")
+                if isinstance(value := getattr(sampling, name), torch.Tensor)
+            },
+        )
+
+        decoder = SpeculativeDecoder(
+            self.model,
+            self.draft_model,
+            self.num_draft_frames,
+            sampling,
+            cfg_scale,
+            empty_id=self.config.empty_id,
+        )
+        self.speculative_stats = decoder.stats
         with torch.autocast(device_type=self.device.type, dtype=self.dtype):
-            curr_token = self.model.generate_frame(
-                tokens=prompt_tokens,
-                tokens_mask=prompt_tokens_mask,
-                input_pos=prompt_pos,
-                temperature=temperature,
-                topk=topk,
-                cfg_scale=cfg_scale,
-                continuous_segments=continuous_segment,
-                starts=starts,
+            decoder.prefill(
+                model_inputs["tokens"],
+                model_inputs["tokens_mask"],
+                model_inputs["pos"],
+                continuous_segments=model_inputs["muq_embed"],
+                starts=model_inputs["muq_idx"],
             )
-        frames.append(curr_token[0:1,])
-
-        def _pad_audio_token(token: torch.Tensor):
-            padded_token = (
-                torch.ones(
-                    (token.shape[0], self._parallel_number),
-                    device=token.device,
-                    dtype=torch.long,
+
+        frames = decoder.generate(curr_token)
+        alive = torch.ones(1, dtype=torch.bool, device=curr_token.device)
+        for _ in tqdm(range(max_audio_frames)):
+            with torch.autocast(device_type=self.device.type, dtype=self.dtype):
+                frame = next(frames, None)
+            if frame is None or bool(torch.any(frame >= self.config.audio_eos_id)):
+                break
+            yield frame[:1], alive
+
+    def _forward(
+        self,
+        model_inputs: Dict[str, Any],
+        max_audio_length_ms: int,
+        temperature: float,
+        topk: int,
+        cfg_scale: float,
+        top_p: float = 1.0,
+        min_p: float = 0.0,
+        generator=None,
+        eos_check_interval: int = 1,
+        kv_window: Optional[int] = None,
+        resume: Optional[DecodeSnapshot] = None,
+        num_candidates: int = 1,
+        cfg_frames: Optional[Union[int, Tuple[int, int]]] = None,
+        cfg_codebooks: Optional[int] = None,
+        detokenize: bool = True,
+        overlap_codec: bool = False,
+    ):
+        """decode the songs' codes and, unless ``detokenize=False``, render them
+
+        With ``overlap_codec`` the codec renders finished windows on a
+        ``DetokenizeWorker`` thread while the LM keeps decoding; the audio is
+        the same as without it.
+        """
+        num_prompts = len(model_inputs["pad_lens"]) // (2 if cfg_scale != 1.0 else 1)
+        num_songs = num_prompts * num_candidates
+        max_frames = max_audio_length_ms // 80 + 1
+        frames = torch.empty(
+            (num_songs, self._parallel_number - 1, max_frames),
+            dtype=torch.long,
+            device=self.device,
+        )
+        alive = torch.zeros((num_songs, max_frames), dtype=torch.bool, device=self.device)
+        # seeded before the LM samples, the same for every way of rendering
+        codec_generators = _codec_generators(num_songs, generator)
+        worker = None
+        if detokenize and overlap_codec:
+            worker = self.audio_codec.detokenize_worker(
+                num_songs, generators=codec_generators, device=self.device
+            )
+            finished = [False] * num_songs
+            pushed = 0
+        num_steps = 0
+        for i, (frame, frame_alive) in enumerate(
+            self._generate_frames(
+                model_inputs,
+                max_audio_length_ms,
+                temperature,
+                topk,
+                cfg_scale,
+                top_p=top_p,
+                min_p=min_p,
+                generator=generator,
+                eos_check_interval=eos_check_interval,
+                kv_window=kv_window,
+                resume=resume,
+                snapshot_interval=self.snapshot_interval,
+                num_candidates=num_candidates,
+                cfg_frames=cfg_frames,
+                cfg_codebooks=cfg_codebooks,
+            )
+        ):
+            frames[:, :, i] = frame
+            alive[:, i] = frame_alive
+            num_steps = i + 1
+            if worker is not None and num_steps - pushed >= _CODEC_PUSH_FRAMES:
+                pushed = self._push_codes(
+                    worker, frames, alive, pushed, num_steps, finished
                 )
-                * self.config.empty_id
+        num_frames = alive.sum(dim=1).tolist()
+
+        codes = [frames[j, :, : num_frames[j]] for j in range(num_songs)]
+        if worker is not None:
+            self._push_codes(worker, frames, alive, pushed, num_steps, finished)
+            for j in range(num_songs):
+                if not finished[j]:
+                    worker.finish(j)
+            wavs = worker.join()
+        elif detokenize:
+            wavs = self.audio_codec.detokenize_batch(
+                codes, generators=codec_generators, device=self.device
             )
-            padded_token[:, :-1] = token
-            padded_token = padded_token.unsqueeze(1)
-            padded_token_mask = torch.ones_like(
-                padded_token, device=token.device, dtype=torch.bool
+        else:
+            # rendered later on, see HeartCodec.render
+            wavs = [None] * num_songs
+        if num_candidates > 1:
+            # one list of candidates per song
+            codes, wavs = (
+                [x[j : j + num_candidates] for j in range(0, num_songs, num_candidates)]
+                for x in (codes, wavs)
             )
-            padded_token_mask[..., -1] = False
-            return padded_token, padded_token_mask
+        if not model_inputs["batched"]:
+            codes, wavs = codes[0], wavs[0]
+        return {"wav": wavs, "codes": codes}
 
-        max_audio_frames = max_audio_length_ms // 80
+    def _push_codes(self, worker, frames, alive, start, end, finished) -> int:
+        """hand frames ``[start, end)`` of the unfinished songs to ``worker``"""
+        counts = alive[:, start:end].sum(dim=1).tolist()
+        for j, count in enumerate(counts):
+            if finished[j]:
+                continue
+            if count > 0:
+                worker.push(j, frames[j, :, start : start + count])
+            # alive only ever turns False, at the song's EOS
+            if count < end - start:
+                worker.finish(j)
+                finished[j] = True
+        return end
 
-        for i in tqdm(range(max_audio_frames)):
-            curr_token, curr_token_mask = _pad_audio_token(curr_token)
-            with torch.autocast(device_type=self.device.type, dtype=self.dtype):
-                curr_token = self.model.generate_frame(
-                    tokens=curr_token,
-                    tokens_mask=curr_token_mask,
-                    input_pos=prompt_pos[..., -1:] + i + 1,
-                    temperature=temperature,
-                    topk=topk,
-                    cfg_scale=cfg_scale,
-                    continuous_segments=None,
-                    starts=None,
-                )
-            if torch.any(curr_token[0:1, :] >= self.config.audio_eos_id):
-                break
-            frames.append(curr_token[0:1,])
-        frames = torch.stack(frames).permute(1, 2, 0).squeeze(0)
-        wav = self.audio_codec.detokenize(frames)
-        return {"wav": wav}
+    def stream(self, inputs: Dict[str, Any], **kwargs):
+        """Generator version of ``__call__`` for a single song.
+
+        Finished codec windows are detokenized while the LM keeps sampling, and
+        48 kHz PCM chunks of shape [channels, samples] are yielded with the
+        crossfades already applied. Concatenating all chunks gives the same
+        audio as ``__call__`` with the same seed or ``generator``.
+        """
+        assert not isinstance(inputs, list), "stream only supports a single song"
+        preprocess_params, forward_params, _ = self._sanitize_parameters(**kwargs)
+        assert forward_params["num_candidates"] == 1, "stream decodes one candidate"
+        for name in _CODEC_PARAMS:
+            forward_params.pop(name)
+        inference_context = self.get_inference_context()
+
+        model_inputs = self.preprocess(inputs, **preprocess_params)
+        model_inputs = self._ensure_tensor_on_device(model_inputs, device=self.device)
+        (codec_generator,) = _codec_generators(1, forward_params["generator"])
+        frames = self._generate_frames(
+            model_inputs, snapshot_interval=self.snapshot_interval, **forward_params
+        )
+        codec_stream = self.audio_codec.detokenize_stream(
+            generator=codec_generator, device=self.device
+        )
+
+        while True:
+            with inference_context():
+                step = next(frames, None)
+                if step is None:
+                    break
+                frame, alive = step
+                if not bool(alive[0]):
+                    continue
+                chunk = codec_stream.push(frame[0:1].T)
+            if chunk.numel() > 0:
+                yield chunk
 
-    def postprocess(self, model_outputs: Dict[str, Any], save_path: str):
-        wav = model_outputs["wav"]
+        with inference_context():
+            chunk = codec_stream.flush()
+        if chunk.numel() > 0:
+            yield chunk
+
+    def postprocess(
+        self,
+        model_outputs: Dict[str, Any],
+        save_path: str,
+        codes_path: Optional[str] = None,
+    ):
+        """write the wav to ``save_path``, and the codes to ``codes_path`` if given
+
+        Returns the codes [num_quantizers, T] (a list of them for candidates).
+        Calls with ``detokenize=False`` skip the codec and write no wav,
+        ``HeartCodec.render`` turns the saved codes into audio later on.
+        """
+        wav, codes = model_outputs["wav"], model_outputs["codes"]
+        if isinstance(codes, list):
+            # candidates of one song go to <root>_<k><ext>
+            return self._postprocess_batch(model_outputs, save_path, codes_path)
+        if codes_path is not None:
+            torch.save(codes.cpu(), codes_path)
+        if wav is None:
+            return codes
         # Use soundfile instead of torchaudio to avoid torchcodec dependency
         # Convert from (channels, samples) to (samples, channels) for soundfile
         wav_numpy = wav.cpu().numpy().T
         sf.write(save_path, wav_numpy, 48000)
+        return codes
 
     @classmethod
     def from_pretrained(
@@ -216,6 +1082,7 @@ class HeartMuLaGenPipeline(Pipeline):
         dtype: torch.dtype,
         version: str,
         bnb_config: Optional[BitsAndBytesConfig] = None,
+        draft_version: Optional[str] = None,
     ):
 
         if os.path.exists(
@@ -256,4 +1123,18 @@ class HeartMuLaGenPipeline(Pipeline):
                 f"Expected to find gen_config.json for HeartMuLa at {gen_config_path} but not found. Please check your folder {pretrained_path}."
             )
 
-        return cls(heartmula, heartcodec, None, tokenizer, gen_config, device, dtype)
+        pipe = cls(heartmula, heartcodec, None, tokenizer, gen_config, device, dtype)
+
+        if draft_version is not None:
+            if not os.path.exists(
+                draft_path := os.path.join(
+                    pretrained_path, f"HeartMuLa-oss-{draft_version}"
+                )
+            ):
+                raise FileNotFoundError(
+                    f"Expected to find checkpoint for the draft HeartMuLa at {draft_path} but not found. Please check your folder {pretrained_path}."
+                )
+            draft = HeartMuLa.from_pretrained(draft_path, dtype=dtype)
+            pipe.enable_speculative_decoding(draft.to(pipe.device).eval())
+
+        return pipe
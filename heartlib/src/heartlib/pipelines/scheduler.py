@@ -0,0 +1,263 @@
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import torch
+
+from ..heartmula.kv_cache import KVCachePool
+from ..heartmula.sampling import SamplingParams
+
+
+@dataclass
+class _Request:
+    request_id: int
+    model_inputs: Dict[str, Any]
+    max_frames: int
+    sampling: SamplingParams
+    slots: List[int] = field(default_factory=list)
+    pos: int = 0
+    frames: List[torch.Tensor] = field(default_factory=list)
+    last_token: Optional[torch.Tensor] = None
+    done: bool = False
+
+
+class ContinuousBatchingScheduler:
+    """Serve many songs from one ``HeartMuLaGenPipeline`` at once.
+
+    The scheduler owns a ``KVCachePool`` of ``num_slots`` backbone cache rows.
+    Between two ``generate_frame`` decode steps it admits waiting requests into
+    free slots, and a request gives its slots back as soon as it emits
+    ``audio_eos_id`` (or reaches its frame budget). With CFG every request takes
+    two slots, the conditional and the unconditional row.
+
+    Every admitted request is prefilled by a forward of its own, right before
+    the shared decode step; prompts are not folded into the decode batch. The
+    running requests therefore wait one prefill per admission, but never
+    restart or lose their cache rows.
+
+    ``step`` installs the pool's caches into the model and leaves them there,
+    so that consecutive steps keep their rows. ``run`` hands the model its own
+    caches back when it is done; a caller driving ``step`` by hand does so with
+    ``close`` or by using the scheduler as a context manager.
+
+    ``temperature``, ``topk``, ``top_p`` and ``min_p`` are defaults, every
+    request can override them (and bring its own ``torch.Generator``) in
+    ``submit``. Requests with different settings still share one decode step.
+    ``cfg_scale`` is shared by all requests of a scheduler.
+
+    Example:
+        >>> scheduler = ContinuousBatchingScheduler(pipe, num_slots=8)
+        >>> request_id = scheduler.submit({"tags": tags, "lyrics": lyrics})
+        >>> codes = scheduler.run()[request_id]  # [num_quantizers, T]
+        >>> wav = pipe.audio_codec.detokenize(codes)
+
+        >>> with ContinuousBatchingScheduler(pipe, num_slots=8) as scheduler:
+        ...     scheduler.submit({"tags": tags, "lyrics": lyrics})
+        ...     while scheduler.has_unfinished():
+        ...         finished_ids = scheduler.step()
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        num_slots: int = 8,
+        max_seq_len: int = 4096,
+        temperature: float = 1.0,
+        topk: int = 50,
+        cfg_scale: float = 1.5,
+        top_p: float = 1.0,
+        min_p: float = 0.0,
+    ):
+        self.pipeline = pipeline
+        self.model = pipeline.model
+        self.config = pipeline.config
+        self.device = pipeline.device
+        self.temperature = temperature
+        self.topk = topk
+        self.top_p = top_p
+        self.min_p = min_p
+        self.cfg_scale = cfg_scale
+        self.rows_per_request = 2 if cfg_scale != 1.0 else 1
+
+        assert (
+            num_slots % self.rows_per_request == 0
+        ), f"num_slots must be a multiple of {self.rows_per_request}"
+        self.pool = KVCachePool(self.model, num_slots, max_seq_len)
+        self.free_slots = list(range(num_slots))
+
+        self.waiting = deque()
+        self.running: List[_Request] = []
+        self.finished: Dict[int, torch.Tensor] = {}
+        self._next_id = 0
+
+    def submit(
+        self,
+        inputs: Dict[str, Any],
+        max_audio_length_ms: int = 120_000,
+        temperature: Optional[float] = None,
+        topk: Optional[int] = None,
+        top_p: Optional[float] = None,
+        min_p: Optional[float] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> int:
+        model_inputs = self.pipeline.preprocess(inputs, cfg_scale=self.cfg_scale)
+        model_inputs = self.pipeline._ensure_tensor_on_device(
+            model_inputs, device=self.device
+        )
+        max_frames = max_audio_length_ms // 80
+        prompt_len = model_inputs["tokens"].shape[1]
+        assert prompt_len + max_frames + 1 <= self.pool.max_seq_len, (
+            f"request needs {prompt_len + max_frames + 1} cache entries, "
+            f"but slots only hold {self.pool.max_seq_len}"
+        )
+
+        sampling = SamplingParams.create(
+            1,
+            temperature=self.temperature if temperature is None else temperature,
+            topk=self.topk if topk is None else topk,
+            top_p=self.top_p if top_p is None else top_p,
+            min_p=self.min_p if min_p is None else min_p,
+            generators=None if generator is None else [generator],
+            device=self.device,
+        )
+        request = _Request(self._next_id, model_inputs, max_frames, sampling)
+        self._next_id += 1
+        self.waiting.append(request)
+        return request.request_id
+
+    def has_unfinished(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    # not inference_mode: the model's caches and buffers outlive the scheduler
+    # and are reused by the pipeline, which runs under no_grad
+    @torch.no_grad()
+    def step(self) -> List[int]:
+        """admit + prefill waiting requests, then run one decode step
+
+        Returns the ids of the requests that finished during this step. The
+        pool stays installed in the model until ``close``.
+        """
+        self.pool.install()
+        done = []
+        while self.waiting and len(self.free_slots) >= self.rows_per_request:
+            request = self.waiting.popleft()
+            request.slots = [self.free_slots.pop(0) for _ in range(self.rows_per_request)]
+            self._prefill(request)
+            self.running.append(request)
+
+        if self.running:
+            self._decode()
+
+        for request in list(self.running):
+            if request.done:
+                self.running.remove(request)
+                self.free_slots.extend(request.slots)
+                self.free_slots.sort()
+                self.finished[request.request_id] = torch.stack(request.frames).T
+                done.append(request.request_id)
+        return done
+
+    def run(self) -> Dict[int, torch.Tensor]:
+        """step until every submitted request is done; returns id -> codes"""
+        try:
+            while self.has_unfinished():
+                self.step()
+        finally:
+            self.close()
+        finished, self.finished = self.finished, {}
+        return finished
+
+    def close(self) -> None:
+        """give the model its own caches back
+
+        Requests that are still running keep their slots; the next ``step``
+        installs the pool again and continues them.
+        """
+        self.pool.uninstall()
+
+    def __enter__(self) -> "ContinuousBatchingScheduler":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _generate(self, **kwargs) -> torch.Tensor:
+        with torch.autocast(device_type=self.device.type, dtype=self.pipeline.dtype):
+            return self.model.generate_frame(
+                temperature=None,
+                topk=None,
+                cfg_scale=self.cfg_scale,
+                **kwargs,
+            )
+
+    def _prefill(self, request: _Request):
+        inputs = request.model_inputs
+        prompt_len = inputs["tokens"].shape[1]
+        slots = torch.tensor(request.slots, device=self.device)
+        self.pool.bind(
+            slots,
+            torch.zeros(len(request.slots), dtype=torch.long, device=self.device),
+            prompt_len,
+        )
+        cache_pos = torch.arange(prompt_len, device=self.device)
+        mask = cache_pos.view(1, -1, 1) >= cache_pos.view(1, 1, -1)
+        curr_token = self._generate(
+            tokens=inputs["tokens"],
+            tokens_mask=inputs["tokens_mask"],
+            input_pos=inputs["pos"],
+            continuous_segments=inputs["muq_embed"],
+            starts=inputs["muq_idx"],
+            mask=mask.expand(len(request.slots), -1, -1),
+            sampling=request.sampling,
+        )
+        request.pos = prompt_len
+        self._append(request, curr_token[0], first=True)
+
+    def _decode(self):
+        # [cond rows of every request, uncond rows of every request]
+        rows = [
+            (request, r)
+            for r in range(self.rows_per_request)
+            for request in self.running
+        ]
+        slots = torch.tensor([req.slots[r] for req, r in rows], device=self.device)
+        pos = torch.tensor([req.pos for req, _ in rows], device=self.device)
+        length = int(max(req.pos for req in self.running)) + 1
+
+        tokens = torch.full(
+            (len(rows), 1, self.pipeline._parallel_number),
+            self.config.empty_id,
+            dtype=torch.long,
+            device=self.device,
+        )
+        tokens[:, 0, :-1] = torch.stack([req.last_token for req, _ in rows])
+        tokens_mask = torch.ones_like(tokens, dtype=torch.bool)
+        tokens_mask[..., -1] = False
+
+        self.pool.bind(slots, pos, length)
+        mask = torch.arange(length, device=self.device).view(1, 1, -1) <= pos.view(
+            -1, 1, 1
+        )
+        curr_token = self._generate(
+            tokens=tokens,
+            tokens_mask=tokens_mask,
+            input_pos=pos.view(-1, 1),
+            mask=mask,
+            sampling=SamplingParams.cat(
+                [request.sampling for request in self.running],
+                [1] * len(self.running),
+                device=self.device,
+            ),
+        )
+        for i, request in enumerate(self.running):
+            request.pos += 1
+            self._append(request, curr_token[i])
+
+    def _append(self, request: _Request, token: torch.Tensor, first: bool = False):
+        if not first and torch.any(token >= self.config.audio_eos_id):
+            request.done = True
+            return
+        request.frames.append(token)
+        request.last_token = token
+        if len(request.frames) > request.max_frames:
+            request.done = True
@@ -0,0 +1,114 @@
+import pytest
+import torch
+from torchtune.models import llama3_2
+
+from heartlib.heartcodec.configuration_heartcodec import HeartCodecConfig
+from heartlib.heartcodec.modeling_heartcodec import HeartCodec
+from heartlib.heartmula import modeling_heartmula
+from heartlib.heartmula.configuration_heartmula import HeartMuLaConfig
+from heartlib.heartmula.modeling_heartmula import HeartMuLa
+from heartlib.pipelines.music_generation import (
+    HeartMuLaGenConfig,
+    HeartMuLaGenPipeline,
+)
+
+
+def _tiny_llama(num_layers, max_seq_len):
+    def build():
+        return llama3_2.llama3_2(
+            vocab_size=64,
+            num_layers=num_layers,
+            num_heads=4,
+            num_kv_heads=2,
+            embed_dim=64,
+            max_seq_len=max_seq_len,
+            intermediate_dim=128,
+            attn_dropout=0.0,
+            norm_eps=1e-5,
+            rope_base=500_000,
+            scale_factor=32,
+        )
+
+    return build
+
+
+class _Tokenizer:
+    """stands in for the text tokenizer: one id per character"""
+
+    class _Encoding:
+        def __init__(self, ids):
+            self.ids = ids
+
+    def encode(self, text):
+        return self._Encoding([1 + ord(c) % 250 for c in text])
+
+
+@pytest.fixture(autouse=True)
+def tiny_flavors(monkeypatch):
+    monkeypatch.setitem(modeling_heartmula.FLAVORS, "tiny", _tiny_llama(2, 2048))
+    monkeypatch.setitem(modeling_heartmula.FLAVORS, "tiny-decoder", _tiny_llama(2, 64))
+    monkeypatch.setitem(modeling_heartmula.FLAVORS, "tiny-draft", _tiny_llama(1, 2048))
+
+
+def make_model(seed=0, backbone="tiny"):
+    torch.manual_seed(seed)
+    model = HeartMuLa(
+        HeartMuLaConfig(
+            backbone_flavor=backbone,
+            decoder_flavor="tiny-decoder",
+            text_vocab_size=300,
+            muq_dim=16,
+        )
+    )
+    with torch.no_grad():
+        for param in model.parameters():
+            if param.dim() > 1:
+                torch.nn.init.normal_(param, std=0.3)
+        model.audio_head.normal_(std=0.3)
+    return model.eval()
+
+
+def make_codec(seed=0):
+    torch.manual_seed(seed)
+    return HeartCodec(
+        HeartCodecConfig(
+            dim=32,
+            codebook_dim=8,
+            attention_head_dim=16,
+            num_attention_heads=2,
+            num_layers=1,
+            num_layers_2=1,
+            in_channels=544,
+            init_channel=4,
+        )
+    ).eval()
+
+
+def generate_codes(pipe, inputs, **kwargs):
+    """codes [num_quantizers, T] of ``pipe(inputs, **kwargs)``, the codec is skipped"""
+    return pipe(inputs, detokenize=False, **kwargs)
+
+
+def resume_codes(pipe, snapshot, **kwargs):
+    """codes of ``pipe.resume(snapshot, **kwargs)``, the codec is skipped"""
+    return pipe.resume(snapshot, detokenize=False, **kwargs)
+
+
+def song_codes(codes):
+    """the per-song list of a single (a tensor) or batched (a list) call's codes"""
+    return codes if isinstance(codes, list) else [codes]
+
+
+@pytest.fixture
+def pipe():
+    # no EOS, every song runs to max_audio_length_ms
+    config = HeartMuLaGenConfig(text_bos_id=251, text_eos_id=252, audio_eos_id=10**6)
+    return HeartMuLaGenPipeline(
+        make_model(),
+        make_codec(),
+        None,
+        _Tokenizer(),
+        config,
+        torch.device("cpu"),
+        torch.float32,
+    )
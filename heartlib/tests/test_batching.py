@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from conftest import generate_codes
+
+SONGS = [
+    {"tags": "rock", "lyrics": "la la la"},
+    {"tags": "jazz fusion", "lyrics": "hm"},
+]
+
+
+@pytest.mark.parametrize("cfg_scale", [1.0, 1.5])
+def test_batch_matches_single_songs(pipe, cfg_scale):
+    # greedy, so rows can only differ through the padded prompts
+    kwargs = dict(max_audio_length_ms=80 * 8, topk=1, cfg_scale=cfg_scale)
+    batch = generate_codes(pipe, SONGS, **kwargs)
+
+    assert len(batch) == len(SONGS)
+    for inputs, codes in zip(SONGS, batch):
+        assert torch.equal(codes, generate_codes(pipe, inputs, **kwargs))
+
+
+@pytest.mark.parametrize("eos_check_interval", [4, 16])
+def test_eos_check_interval_keeps_codes(pipe, eos_check_interval):
+    kwargs = dict(max_audio_length_ms=80 * 16, topk=1)
+    codes = generate_codes(pipe, SONGS, **kwargs)
+    # the first song now ends at the first later frame reaching its max code
+    pipe.config.audio_eos_id = int(codes[0][:, 1:].max())
+
+    expected = generate_codes(pipe, SONGS, **kwargs)
+    assert expected[0].shape[1] < codes[0].shape[1]
+    batch = generate_codes(pipe, SONGS, eos_check_interval=eos_check_interval, **kwargs)
+    for a, b in zip(expected, batch):
+        assert torch.equal(a, b)
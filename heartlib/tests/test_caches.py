@@ -0,0 +1,154 @@
+import pytest
+import torch
+from torchtune.modules import delete_kv_caches
+
+from conftest import generate_codes, make_model
+from heartlib.heartmula.kv_cache import CausalKVCache, QuantizedKVCache
+from heartlib.heartmula.modeling_heartmula import _rope_shift_back
+
+SONG = {"tags": "rock", "lyrics": "la la la"}
+
+
+def _delete_caches(model):
+    for decoder in (model.backbone, model.decoder):
+        if decoder.caches_are_setup():
+            delete_kv_caches(decoder)
+
+
+def _k_cache(model):
+    return model.backbone.layers[0].attn.kv_cache.k_cache
+
+
+def test_reused_caches_match_fresh_caches(pipe):
+    lengths = [80 * 16, 80 * 4, 80 * 32]
+    expected = []
+    for max_ms in lengths:
+        _delete_caches(pipe.model)
+        torch.manual_seed(0)
+        expected.append(generate_codes(pipe, SONG, max_audio_length_ms=max_ms))
+
+    _delete_caches(pipe.model)
+    k_caches = []
+    for max_ms, codes in zip(lengths, expected):
+        torch.manual_seed(0)
+        assert torch.equal(generate_codes(pipe, SONG, max_audio_length_ms=max_ms), codes)
+        k_caches.append(_k_cache(pipe.model))
+
+    # the short call rewinds the caches of the first one, the long one grows them
+    assert k_caches[1] is k_caches[0]
+    assert k_caches[2].size(2) > k_caches[0].size(2)
+
+
+def test_mask_free_backbone_matches_explicit_mask():
+    model = make_model()
+    dim = model.backbone.layers[0].attn.embed_dim
+    x = torch.randn(2, 16, dim)
+    pos = torch.arange(16).expand(2, -1)
+    causal = pos.view(2, -1, 1) >= pos.view(2, 1, -1)
+
+    with torch.no_grad():
+        model.setup_caches(2, 64)
+        expected = model._run_backbone(x, pos, mask=causal)
+
+        # a causal prefill, single decode tokens and an appended block
+        model.setup_caches(2, 64)
+        assert isinstance(model.backbone.layers[0].attn.kv_cache, CausalKVCache)
+        chunks = [(0, 10), (10, 11), (11, 12), (12, 13), (13, 16)]
+        h = torch.cat(
+            [model._run_backbone(x[:, a:b], pos[:, a:b]) for a, b in chunks], dim=1
+        )
+    assert torch.allclose(h, expected, atol=1e-5)
+
+
+def test_int8_cache_update_is_within_half_a_step():
+    cache = QuantizedKVCache(2, 16, 4, 8, torch.float32)
+    k, v = torch.randn(2, 4, 5, 8), torch.randn(2, 4, 5, 8)
+    k_out, v_out = cache.update(k, v)
+
+    for x, out in ((k, k_out), (v, v_out)):
+        step = x.abs().amax(dim=-1, keepdim=True) / 127
+        assert out.shape == x.shape
+        assert bool(((out - x).abs() <= step / 2 + 1e-6).all())
+
+
+def test_int8_backbone_stays_close_to_float():
+    model = make_model()
+    dim = model.backbone.layers[0].attn.embed_dim
+    x = torch.randn(2, 16, dim)
+    pos = torch.arange(16).expand(2, -1)
+
+    outputs = []
+    with torch.no_grad():
+        for quantized in (False, True):
+            model.quantize_kv_cache = quantized
+            model.setup_caches(2, 64)
+            h = [model._run_backbone(x[:, i : i + 1], pos[:, i : i + 1]) for i in range(16)]
+            outputs.append(torch.cat(h, dim=1))
+    assert isinstance(model.backbone.layers[0].attn.kv_cache, QuantizedKVCache)
+    expected, h = outputs
+    assert (h - expected).norm() / expected.norm() < 0.05
+
+
+def test_rope_shift_back_matches_rotation_at_the_earlier_position():
+    rope = make_model().backbone.layers[0].attn.pos_embeddings
+    x = torch.randn(2, 6, 4, rope.dim)
+    pos = torch.arange(3, 9).expand(2, -1)
+
+    shifted = _rope_shift_back(rope, rope(x, input_pos=pos + 5).transpose(1, 2), 5)
+    assert torch.allclose(shifted, rope(x, input_pos=pos).transpose(1, 2), atol=1e-5)
+
+
+def test_evicted_window_matches_recompute():
+    # one layer: the cached keys and values of a token do not depend on the others
+    model = make_model(backbone="tiny-draft")
+    dim = model.backbone.layers[0].attn.embed_dim
+    x = torch.randn(2, 13, dim)
+    pos = torch.arange(13).expand(2, -1)
+
+    with torch.no_grad():
+        model.setup_caches(2, 64)
+        model._run_backbone(x[:, :12], pos[:, :12])
+        model.evict_backbone_entries(4, 3, 12)
+        h = model._run_backbone(x[:, 12:], pos[:, 9:10])
+
+        kept = torch.cat([x[:, :4], x[:, 7:]], dim=1)
+        model.setup_caches(2, 64)
+        expected = model._run_backbone(kept, pos[:, :10])[:, -1:]
+    assert torch.allclose(h, expected, atol=1e-5)
+
+
+def _allocated_kv_bytes(decoder):
+    return sum(
+        buffer.nbytes
+        for layer in decoder.layers
+        for name, buffer in layer.attn.kv_cache.named_buffers()
+        if name != "cache_pos"
+    )
+
+
+@pytest.mark.parametrize("quantized", [False, True])
+@pytest.mark.parametrize("cfg_scale", [1.0, 1.5])
+@pytest.mark.parametrize("kv_window", [None, 4])
+def test_estimate_memory_matches_allocated_caches(
+    pipe, quantized, cfg_scale, kv_window
+):
+    songs = [SONG, {"tags": "jazz fusion", "lyrics": "hm"}]
+    kwargs = dict(
+        max_audio_length_ms=80 * 16, cfg_scale=cfg_scale, kv_window=kv_window
+    )
+    pipe.enable_kv_cache_quantization(quantized)
+    estimate = pipe.estimate_memory(songs, **kwargs)
+
+    _delete_caches(pipe.model)
+    generate_codes(pipe, songs, **kwargs)
+    backbone = _allocated_kv_bytes(pipe.model.backbone)
+    decoder = _allocated_kv_bytes(pipe.model.decoder)
+    cache = pipe.model.backbone.layers[0].attn.kv_cache
+    assert isinstance(cache, QuantizedKVCache) == quantized
+    assert estimate["backbone_kv"] == backbone
+    assert estimate["decoder_kv"] == decoder
+    assert estimate["total"] == backbone + decoder
+    if kv_window is not None:
+        # the window keeps 4 of the 16 frames
+        unwindowed = pipe.estimate_memory(songs, **dict(kwargs, kv_window=None))
+        assert backbone < unwindowed["backbone_kv"]
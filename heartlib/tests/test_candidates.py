@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+from conftest import generate_codes
+from heartlib.pipelines.music_generation import _spawn
+
+SONG = {"tags": "rock", "lyrics": "la la la"}
+
+
+@pytest.mark.parametrize("cfg_scale", [1.0, 1.5])
+def test_candidates_match_independent_runs(pipe, cfg_scale):
+    kwargs = dict(max_audio_length_ms=80 * 8, cfg_scale=cfg_scale)
+    candidates = generate_codes(
+        pipe, SONG, num_candidates=3, generator=torch.Generator().manual_seed(7), **kwargs
+    )
+
+    # every candidate samples from a generator spawned off the song's one
+    generator = torch.Generator().manual_seed(7)
+    assert len(candidates) == 3
+    for codes in candidates:
+        expected = generate_codes(pipe, SONG, generator=_spawn(generator), **kwargs)
+        assert torch.equal(codes, expected)
+    assert not torch.equal(candidates[0], candidates[1])
@@ -0,0 +1,204 @@
+from unittest import mock
+
+import pytest
+import soundfile as sf
+import torch
+
+from conftest import generate_codes, make_codec
+from heartlib.heartcodec.modeling_heartcodec import (
+    DetokenizeStream,
+    DetokenizeWorker,
+    HeartCodec,
+)
+
+# the shortest window with a hop, 93 code frames
+DURATION = 7.44
+
+
+def _codes(num_frames, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(8192, (8, num_frames), generator=generator)
+
+
+@pytest.mark.parametrize("num_frames", [40, 250])
+def test_stream_matches_detokenize(num_frames):
+    codec = make_codec()
+    codes = _codes(num_frames)
+    kwargs = dict(duration=DURATION, num_steps=2, device="cpu", disable_progress=True)
+    torch.manual_seed(1)
+    expected = codec.detokenize(codes, **kwargs)
+
+    torch.manual_seed(1)
+    stream = codec.detokenize_stream(**kwargs)
+    chunks = [stream.push(codes[:, i : i + 37]) for i in range(0, num_frames, 37)]
+    chunks.append(stream.flush())
+    wav = torch.cat([chunk for chunk in chunks if chunk.numel() > 0], dim=-1)
+
+    assert expected.numel() > 0 and wav.shape == expected.shape
+    assert torch.equal(wav, expected)
+
+
+def _render_chunks(push, finish, songs):
+    for song, codes in enumerate(songs):
+        for i in range(0, codes.shape[1], 37):
+            push(song, codes[:, i : i + 37])
+        finish(song)
+
+
+@pytest.mark.parametrize("num_songs", [1, 2])
+def test_worker_matches_detokenize(num_songs):
+    codec = make_codec()
+    songs = [_codes(250), _codes(40, seed=1)][:num_songs]
+    kwargs = dict(duration=DURATION, num_steps=2, device="cpu", disable_progress=True)
+    torch.manual_seed(1)
+    if num_songs == 1:
+        expected = [codec.detokenize(songs[0], **kwargs)]
+    else:
+        # the worker opens every song's stream up front, so the first noise
+        # draws of all songs come before the first window of any song
+        streams = [codec.detokenize_stream(**kwargs) for _ in songs]
+        chunks = [[] for _ in songs]
+        _render_chunks(
+            lambda song, codes: chunks[song].append(streams[song].push(codes)),
+            lambda song: chunks[song].append(streams[song].flush()),
+            songs,
+        )
+        expected = [DetokenizeStream._cat(song_chunks) for song_chunks in chunks]
+
+    torch.manual_seed(1)
+    worker = DetokenizeWorker(codec, num_songs, max_queue=2, **kwargs)
+    _render_chunks(worker.push, worker.finish, songs)
+    wavs = worker.join()
+    assert len(wavs) == num_songs
+    for wav, reference in zip(wavs, expected):
+        assert reference.numel() > 0 and torch.equal(wav, reference)
+
+
+def test_worker_generators_match_detokenize():
+    codec = make_codec()
+    songs = [_codes(250), _codes(40, seed=1)]
+    kwargs = dict(duration=DURATION, num_steps=2, device="cpu", disable_progress=True)
+    expected = [
+        codec.detokenize(codes, generator=torch.Generator().manual_seed(j), **kwargs)
+        for j, codes in enumerate(songs)
+    ]
+
+    generators = [torch.Generator().manual_seed(j) for j in range(len(songs))]
+    worker = DetokenizeWorker(codec, len(songs), generators=generators, **kwargs)
+
+    def push(song, codes):
+        # the caller keeps sampling from the global RNG meanwhile
+        torch.randn(1000)
+        worker.push(song, codes)
+
+    _render_chunks(push, worker.finish, songs)
+    for wav, reference in zip(worker.join(), expected):
+        assert reference.numel() > 0 and torch.equal(wav, reference)
+
+
+def test_saved_codes_render_like_detokenize(pipe, tmp_path):
+    songs = [{"tags": "rock", "lyrics": "la la la"}, {"tags": "jazz", "lyrics": "hm"}]
+    codes = generate_codes(
+        pipe, songs, max_audio_length_ms=80 * 8, codes_path=str(tmp_path / "song.pt")
+    )
+    # one file per song, <root>_<i><ext> like the wavs
+    paths = [str(tmp_path / f"song_{i}.pt") for i in range(len(songs))]
+    for path, song in zip(paths, codes):
+        assert torch.equal(HeartCodec.load_codes(path), song)
+
+    kwargs = dict(duration=DURATION, num_steps=2, device="cpu", disable_progress=True)
+    torch.manual_seed(1)
+    expected = pipe.audio_codec.detokenize(codes[0], **kwargs)
+    torch.manual_seed(1)
+    assert torch.equal(pipe.audio_codec.render(paths[0], **kwargs), expected)
+
+
+def test_overlapped_pipeline_matches_serial(pipe, tmp_path):
+    song = {"tags": "rock", "lyrics": "la la la"}
+    kwargs = dict(max_audio_length_ms=80 * 8, topk=1)
+    paths = [str(tmp_path / "serial.wav"), str(tmp_path / "overlap.wav")]
+    torch.manual_seed(0)
+    serial = pipe(song, save_path=paths[0], **kwargs)
+    torch.manual_seed(0)
+    overlapped = pipe(song, save_path=paths[1], overlap_codec=True, **kwargs)
+
+    assert torch.equal(overlapped, serial)
+    serial_wav, overlap_wav = (sf.read(path)[0] for path in paths)
+    assert serial_wav.size > 0 and (serial_wav == overlap_wav).all()
+
+
+def test_sampled_overlapped_pipeline_matches_serial(pipe, tmp_path):
+    song = {"tags": "rock", "lyrics": "la la la"}
+    kwargs = dict(max_audio_length_ms=80 * 16, temperature=1.0, topk=50)
+    # the LM and the codec both draw from the global seed, no generator
+    torch.manual_seed(0)
+    codes, expected = _pipeline_wav(pipe, song, tmp_path, **kwargs)
+    torch.manual_seed(0)
+    overlapped, wav = _pipeline_wav(
+        pipe, song, tmp_path, overlap_codec=True, **kwargs
+    )
+
+    assert torch.equal(overlapped, codes)
+    assert expected.numel() > 0 and torch.equal(wav, expected)
+
+
+@pytest.mark.parametrize("max_batch_size", [None, 2])
+def test_batch_matches_per_song_detokenize(max_batch_size):
+    codec = make_codec()
+    songs = [_codes(250), _codes(40, seed=1), _codes(120, seed=2)]
+    kwargs = dict(duration=DURATION, num_steps=2, device="cpu", disable_progress=True)
+    expected = [
+        codec.detokenize(codes, generator=torch.Generator().manual_seed(j), **kwargs)
+        for j, codes in enumerate(songs)
+    ]
+
+    generators = [torch.Generator().manual_seed(j) for j in range(len(songs))]
+    wavs = codec.detokenize_batch(
+        songs, max_batch_size=max_batch_size, generators=generators, **kwargs
+    )
+    assert len(wavs) == len(songs)
+    for wav, reference in zip(wavs, expected):
+        assert reference.numel() > 0 and wav.shape == reference.shape
+        torch.testing.assert_close(wav, reference, rtol=1e-4, atol=1e-5)
+
+
+def _pipeline_wav(pipe, song, tmp_path, **kwargs):
+    """(codes, wav) of ``pipe(song, **kwargs)``, the wav before it is written"""
+    outputs = []
+    postprocess = pipe.postprocess
+
+    def recording(model_outputs, *args, **kw):
+        outputs.append(model_outputs["wav"])
+        return postprocess(model_outputs, *args, **kw)
+
+    with mock.patch.object(pipe, "postprocess", recording):
+        codes = pipe(song, save_path=str(tmp_path / "song.wav"), **kwargs)
+    return codes, outputs[0]
+
+
+@pytest.mark.parametrize("stop_early", [False, True])
+def test_pipeline_stream_matches_call(pipe, tmp_path, stop_early):
+    song = {"tags": "rock", "lyrics": "la la la"}
+    kwargs = dict(max_audio_length_ms=80 * 16, eos_check_interval=8)
+    num_frames = 17
+    if stop_early:
+        # EOS at the first frame with a new largest code; the loop still
+        # yields frames after it until the next check, stream has to drop them
+        generator = torch.Generator().manual_seed(3)
+        codes = generate_codes(pipe, song, generator=generator, **kwargs)
+        running_max = codes.max(dim=0).values.cummax(dim=0).values
+        num_frames = int(torch.nonzero(running_max[2:] > running_max[1:-1])[0]) + 2
+        assert num_frames % 8 != 0
+        pipe.config.audio_eos_id = int(codes[:, num_frames].max())
+
+    torch.manual_seed(1)
+    generator = torch.Generator().manual_seed(3)
+    codes, expected = _pipeline_wav(pipe, song, tmp_path, generator=generator, **kwargs)
+    assert codes.shape[-1] == num_frames
+
+    torch.manual_seed(1)
+    generator = torch.Generator().manual_seed(3)
+    chunks = list(pipe.stream(song, generator=generator, **kwargs))
+    wav = torch.cat(chunks, dim=-1)
+    assert expected.numel() > 0 and wav.shape == expected.shape
+    assert torch.equal(wav, expected)
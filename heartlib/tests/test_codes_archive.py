@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from heartlib import CodesArchive, CodesArchiveWriter
+
+
+def _codes(seed, num_frames):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, 8192, (8, num_frames), generator=generator)
+
+
+@pytest.mark.parametrize("encoding", ["raw", "zlib", "delta-zlib"])
+def test_archive_round_trip(tmp_path, encoding):
+    path = str(tmp_path / "songs.hlc")
+    songs = [_codes(0, 12), _codes(1, 1), _codes(2, 0)]
+    with CodesArchiveWriter(path, {"seed": 0}, {"topk": 1}, encoding) as writer:
+        for i, codes in enumerate(songs):
+            assert writer.add(codes, take=i) == i
+
+    archive = CodesArchive(path)
+    assert len(archive) == len(songs)
+    assert archive.config == {"seed": 0} and archive.params == {"topk": 1}
+    assert archive.meta == [{"take": i} for i in range(len(songs))]
+    for codes, stored in zip(songs, archive):
+        assert stored.dtype == torch.int16
+        assert torch.equal(stored.long(), codes)
+
+
+def test_append_extends_the_index(tmp_path):
+    path = str(tmp_path / "songs.hlc")
+    first, second = _codes(0, 12), _codes(1, 7)
+    with CodesArchiveWriter(path, {"seed": 0}, {"topk": 1}) as writer:
+        writer.add(first, take=0)
+    with CodesArchiveWriter(path, append=True, encoding="zlib") as writer:
+        assert writer.add(second, take=1) == 1
+
+    archive = CodesArchive(path)
+    assert len(archive) == 2
+    assert archive.config == {"seed": 0} and archive.params == {"topk": 1}
+    assert archive.meta == [{"take": 0}, {"take": 1}]
+    assert torch.equal(archive[0].long(), first)
+    assert torch.equal(archive[1].long(), second)
+
+
+def test_append_creates_a_missing_archive(tmp_path):
+    path = str(tmp_path / "songs.hlc")
+    with CodesArchiveWriter(path, append=True) as writer:
+        writer.add(_codes(0, 3))
+    assert torch.equal(CodesArchive(path)[0].long(), _codes(0, 3))
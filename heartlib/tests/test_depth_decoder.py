@@ -0,0 +1,30 @@
+from unittest import mock
+
+import pytest
+import torch
+
+from conftest import generate_codes
+from heartlib.heartmula.modeling_heartmula import DepthDecoderEngine, HeartMuLa
+
+SONG = {"tags": "rock", "lyrics": "la la la"}
+
+
+@pytest.mark.parametrize("cfg_scale", [1.0, 1.5])
+def test_engine_matches_generic_loop(pipe, cfg_scale):
+    kwargs = dict(max_audio_length_ms=80 * 8, cfg_scale=cfg_scale)
+    torch.manual_seed(0)
+    expected = generate_codes(pipe, SONG, **kwargs)
+
+    # every frame, not just the first, has to take the generic loop
+    pipe.model.depth_engine = None
+    sample_frame = mock.patch.object(
+        HeartMuLa, "sample_frame", autospec=True, side_effect=HeartMuLa.sample_frame
+    )
+    engine = mock.patch.object(
+        DepthDecoderEngine, "_sample_codebooks", side_effect=AssertionError
+    )
+    torch.manual_seed(0)
+    with sample_frame as calls, engine:
+        codes = generate_codes(pipe, SONG, **kwargs)
+    assert calls.call_count == codes.shape[-1]
+    assert torch.equal(codes, expected)
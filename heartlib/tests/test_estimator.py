@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+from conftest import make_codec
+from heartlib.heartcodec.models.flow_matching import _Guidance, _InferencePlan
+from heartlib.heartcodec.models.transformer import FeatureCache
+
+
+def _inputs(batch_size=2, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    # [x, incontext_x, mu] of the tiny codec
+    hidden_states = torch.randn(batch_size, 24, 544, generator=generator)
+    timestep = torch.rand(batch_size, generator=generator)
+    return hidden_states, timestep
+
+
+@pytest.mark.parametrize("depth", [0, 1])
+def test_feature_cache_every_call_matches_no_cache(depth):
+    estimator = make_codec().flow_matching.estimator
+    cache = FeatureCache(interval=1, depth=depth)
+    with torch.no_grad():
+        for seed in range(3):
+            hidden_states, timestep = _inputs(seed=seed)
+            expected = estimator(hidden_states, timestep=timestep)
+            cached = estimator(hidden_states, timestep=timestep, feature_cache=cache)
+            assert torch.equal(cached, expected)
+
+
+def test_feature_cache_reuses_the_deep_residual():
+    estimator = make_codec().flow_matching.estimator
+    cache = FeatureCache(interval=2, depth=0)
+    hidden_states, timestep = _inputs()
+    with torch.no_grad():
+        expected = estimator(hidden_states, timestep=timestep)
+        estimator(hidden_states, timestep=timestep, feature_cache=cache)
+        # the same input again: the cached residual stands in for the blocks
+        reused = estimator(hidden_states, timestep=timestep, feature_cache=cache)
+        # another batch size has no residual yet and runs every block
+        single = estimator(
+            hidden_states[:1], timestep=timestep[:1], feature_cache=cache
+        )
+    assert cache.calls == {2: 2, 1: 1}
+    torch.testing.assert_close(reused, expected)
+    torch.testing.assert_close(single, expected[:1])
+
+
+def test_cache_interval_one_detokenizes_like_no_cache():
+    codec = make_codec()
+    codes = torch.randint(8192, (8, 120), generator=torch.Generator().manual_seed(0))
+    kwargs = dict(duration=7.44, num_steps=4, device="cpu", disable_progress=True)
+    torch.manual_seed(1)
+    expected = codec.detokenize(codes, **kwargs)
+    torch.manual_seed(1)
+    wav = codec.detokenize(codes, cache_interval=1, cache_depth=1, **kwargs)
+    assert torch.equal(wav, expected)
+
+
+def test_modulation_and_split_projections_match_the_plain_call():
+    estimator = make_codec().flow_matching.estimator
+    hidden_states, _ = _inputs()
+    t_span = torch.tensor([0.0, 0.3, 0.7])
+    with torch.no_grad():
+        modulation = estimator.modulation(t_span, hidden_states.dtype)
+        projections = estimator.split_projections(hidden_states[..., 256:], 256)
+        for i, t in enumerate(t_span):
+            expected = estimator(hidden_states, timestep=t.expand(2))
+            planned = estimator(
+                hidden_states[..., :256],
+                modulation=tuple(m[i : i + 1] for m in modulation),
+                projections=projections,
+            )
+            torch.testing.assert_close(planned, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("guidance_scale", [1.0, 1.5])
+def test_inference_plan_matches_unplanned_velocity(guidance_scale):
+    estimator = make_codec().flow_matching.estimator
+    hidden_states, _ = _inputs(batch_size=1)
+    x, incontext_x, mu = hidden_states.split([256, 256, 32], dim=2)
+    t_span = torch.linspace(0, 1, 5)
+    plan = _InferencePlan(
+        estimator, x, incontext_x, 0, mu, t_span, _Guidance(guidance_scale)
+    )
+    with torch.no_grad():
+        # on and off the schedule
+        for t in [0.25, 0.6]:
+            timestep = torch.tensor([t])
+            cond = estimator(hidden_states, timestep=timestep)
+            uncond = estimator(
+                torch.cat([x, incontext_x, torch.zeros_like(mu)], 2),
+                timestep=timestep,
+            )
+            expected = cond
+            if guidance_scale > 1.0:
+                expected = uncond + guidance_scale * (cond - uncond)
+            velocity = plan.velocity(x, t)
+            torch.testing.assert_close(velocity, expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from conftest import make_codec
+
+# the shortest window with a hop, 93 code frames
+DURATION = 7.44
+KWARGS = dict(duration=DURATION, num_steps=4, device="cpu", disable_progress=True)
+
+
+def _codes(num_frames=120):
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(8192, (8, num_frames), generator=generator)
+
+
+def _render(codec, **kwargs):
+    """(wav, estimator rows) of one detokenize from a fixed seed"""
+    rows = []
+    hook = codec.flow_matching.estimator.register_forward_hook(
+        lambda module, inputs, output: rows.append(inputs[0].shape[0])
+    )
+    torch.manual_seed(1)
+    try:
+        wav = codec.detokenize(_codes(), **KWARGS, **kwargs)
+    finally:
+        hook.remove()
+    return wav, sum(rows)
+
+
+@pytest.mark.parametrize("uncond_extrapolate", [False, True])
+def test_full_interval_matches_plain_cfg(uncond_extrapolate):
+    codec = make_codec()
+    expected, passes = _render(codec)
+    wav, interval_passes = _render(
+        codec, guidance_interval=(0.0, 1.0), uncond_extrapolate=uncond_extrapolate
+    )
+    assert torch.equal(wav, expected) and interval_passes == passes
+
+
+def test_empty_interval_matches_no_guidance():
+    codec = make_codec()
+    expected, passes = _render(codec, guidance_scale=1.0)
+    wav, interval_passes = _render(codec, guidance_interval=(2.0, 3.0))
+    assert torch.equal(wav, expected) and interval_passes == passes
+
+
+def test_guidance_interval_and_uncond_cache_save_passes():
+    codec = make_codec()
+    expected, passes = _render(codec)
+    for kwargs in [
+        dict(guidance_interval=(0.0, 0.5)),
+        dict(uncond_every=2),
+        dict(uncond_every=2, uncond_extrapolate=True),
+    ]:
+        wav, fewer_passes = _render(codec, **kwargs)
+        assert fewer_passes < passes
+        assert wav.shape == expected.shape
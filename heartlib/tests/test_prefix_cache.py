@@ -0,0 +1,60 @@
+from unittest import mock
+
+import pytest
+import torch
+
+from conftest import generate_codes
+
+SONGS = [
+    {"tags": "rock", "lyrics": "la la la"},
+    {"tags": "jazz fusion", "lyrics": "hm"},
+]
+KWARGS = dict(max_audio_length_ms=80 * 8, topk=1)
+
+
+def _count_prefills(pipe):
+    forward_backbone = pipe.model.forward_backbone
+    calls = []
+
+    def counting(tokens, *args, **kwargs):
+        if tokens.shape[1] > 1:
+            calls.append(tokens.shape)
+        return forward_backbone(tokens, *args, **kwargs)
+
+    return calls, mock.patch.object(pipe.model, "forward_backbone", counting)
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_prefix_cache_hit_matches_fresh_prefill(pipe, tmp_path, spill):
+    expected = generate_codes(pipe, SONGS, **KWARGS)
+
+    if spill:
+        # every entry is evicted right away and read back from disk
+        cache = pipe.enable_prefix_cache(max_bytes=0, spill_dir=str(tmp_path))
+    else:
+        cache = pipe.enable_prefix_cache()
+    calls, patch = _count_prefills(pipe)
+    with patch:
+        miss = generate_codes(pipe, SONGS, **KWARGS)
+        hit = generate_codes(pipe, SONGS, **KWARGS)
+
+    assert len(calls) == 1
+    if spill:
+        assert len(list(tmp_path.iterdir())) == 1
+    else:
+        assert len(cache.entries) == 1
+    for a, b, c in zip(expected, miss, hit):
+        assert torch.equal(a, b) and torch.equal(a, c)
+
+
+def test_unconditional_prefix_matches_joint_prefill(pipe):
+    # the second call has a longer prompt, the cached prefix has to grow
+    calls = [SONGS, [{"tags": "ambient", "lyrics": "la " * 20}, SONGS[1]]]
+    kwargs = dict(KWARGS, cfg_scale=1.5)
+    assert pipe.uncond_prefix is not None
+    cached = [generate_codes(pipe, songs, **kwargs) for songs in calls]
+
+    pipe.uncond_prefix = None
+    for songs, codes in zip(calls, cached):
+        for a, b in zip(generate_codes(pipe, songs, **kwargs), codes):
+            assert torch.equal(a, b)
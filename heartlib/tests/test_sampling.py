@@ -0,0 +1,17 @@
+import pytest
+import torch
+
+from heartlib.heartmula.modeling_heartmula import sample_topk
+from heartlib.heartmula.sampling import SamplingParams, sample
+
+
+def test_sample_topk_is_a_deprecated_alias_of_sample():
+    logits = torch.randn(3, 50, generator=torch.Generator().manual_seed(0))
+    torch.manual_seed(1)
+    expected = sample(logits, SamplingParams(temperature=0.9, topk=5))
+
+    torch.manual_seed(1)
+    with pytest.deprecated_call():
+        tokens = sample_topk(logits, 5, 0.9)
+    assert tokens.shape == (3, 1) and tokens.dtype == torch.int
+    assert torch.equal(tokens, expected)
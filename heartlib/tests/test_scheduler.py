@@ -0,0 +1,53 @@
+import torch
+
+from conftest import generate_codes
+from heartlib.pipelines.scheduler import ContinuousBatchingScheduler
+
+SONG = {"tags": "rock", "lyrics": "la la la"}
+MAX_MS = 80 * 8
+
+
+def test_scheduler_matches_pipeline(pipe):
+    scheduler = ContinuousBatchingScheduler(pipe, num_slots=4, max_seq_len=256, topk=1)
+    ids = [scheduler.submit(SONG, MAX_MS) for _ in range(2)]
+    finished = scheduler.run()
+
+    expected = generate_codes(pipe, SONG, max_audio_length_ms=MAX_MS, topk=1)
+    for request_id in ids:
+        assert torch.equal(finished[request_id], expected)
+
+
+def test_pool_stays_installed_between_steps(pipe):
+    # one CFG request takes 2 of the 8 slots
+    with ContinuousBatchingScheduler(pipe, num_slots=8, max_seq_len=256) as scheduler:
+        scheduler.submit(SONG, MAX_MS)
+        for _ in range(3):
+            scheduler.step()
+            for layer, cache in zip(
+                pipe.model.decoder.layers, scheduler.pool.decoder_caches
+            ):
+                assert layer.attn.kv_cache is cache
+            for layer, cache in zip(
+                pipe.model.backbone.layers, scheduler.pool.backbone_caches
+            ):
+                assert layer.attn.kv_cache is cache
+
+    for layer, cache in zip(pipe.model.decoder.layers, scheduler.pool.decoder_caches):
+        assert layer.attn.kv_cache is not cache
+
+
+def test_pipeline_after_scheduler_on_one_model(pipe):
+    scheduler = ContinuousBatchingScheduler(pipe, num_slots=2, max_seq_len=256, topk=1)
+    request_id = scheduler.submit(SONG, MAX_MS)
+    scheduled = scheduler.run()[request_id]
+
+    # same batch size as the scheduler's slots: the model's buffers are reused
+    codes = generate_codes(pipe, SONG, max_audio_length_ms=MAX_MS, topk=1)
+    assert torch.equal(codes, scheduled)
+
+
+def test_pipeline_after_inference_mode_call(pipe):
+    kwargs = dict(max_audio_length_ms=MAX_MS, topk=1)
+    with torch.inference_mode():
+        expected = generate_codes(pipe, SONG, **kwargs)
+    assert torch.equal(generate_codes(pipe, SONG, **kwargs), expected)
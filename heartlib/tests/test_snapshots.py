@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from conftest import generate_codes, resume_codes, song_codes
+
+SONGS = [
+    {"tags": "rock", "lyrics": "la la la"},
+    {"tags": "jazz fusion", "lyrics": "hm"},
+]
+
+
+@pytest.mark.parametrize("inputs", [SONGS[0], SONGS], ids=["one_song", "two_songs"])
+def test_resume_matches_uninterrupted_take(pipe, inputs):
+    kwargs = dict(max_audio_length_ms=80 * 16, topk=1)
+    pipe.enable_snapshots(interval=4)
+    expected = generate_codes(pipe, inputs, **kwargs)
+    assert sorted(pipe.snapshots) == [4, 8, 12, 16]
+
+    for frames in (4, 8, 12):
+        resumed = song_codes(resume_codes(pipe, frames, **kwargs))
+        assert len(resumed) == len(song_codes(expected))
+        for song, reference in zip(resumed, song_codes(expected)):
+            assert torch.equal(song, reference)
+
+
+@pytest.mark.parametrize("inputs", [SONGS[0], SONGS], ids=["one_song", "two_songs"])
+def test_resume_after_cfg_frames(pipe, inputs):
+    kwargs = dict(max_audio_length_ms=80 * 24, topk=1)
+    pipe.enable_snapshots(interval=4)
+    expected = generate_codes(pipe, inputs, cfg_scale=1.5, cfg_frames=8, **kwargs)
+    # frames 0..7 are guided, the snapshots at 12 and 16 have half the rows
+    snapshot = pipe.snapshots[12]
+    assert snapshot.cfg_scale == 1.5 and snapshot.cfg_dropped
+    assert not pipe.snapshots[8].cfg_dropped
+
+    for frames in (8, 12, 16):
+        resumed = song_codes(resume_codes(pipe, frames, **kwargs))
+        assert len(resumed) == len(song_codes(expected))
+        for song, reference in zip(resumed, song_codes(expected)):
+            assert torch.equal(song, reference)
+
+
+def test_resume_keeps_the_shared_snapshots(pipe):
+    kwargs = dict(max_audio_length_ms=80 * 24, topk=1)
+    pipe.enable_snapshots(interval=4)
+    generate_codes(pipe, SONGS, cfg_scale=1.5, cfg_frames=8, **kwargs)
+    take = dict(pipe.snapshots)
+    # cond and uncond rows up to frame 8, the conditional ones after it
+    assert [take[n].token.shape[0] for n in (8, 12)] == [4, 2]
+
+    resume_codes(pipe, 12, **kwargs)
+    assert sorted(pipe.snapshots) == [4, 8, 12, 16, 20, 24]
+    for n in (4, 8, 12):
+        assert pipe.snapshots[n] is take[n]
+    for n in (16, 20, 24):
+        snapshot = pipe.snapshots[n]
+        assert snapshot is not take[n] and snapshot.cfg_dropped
+        assert snapshot.token.shape[0] == 2
+        assert all(state[0].shape[0] == 2 for state in snapshot.kv)
+
+    # a snapshot of an earlier take shares nothing with the latest one
+    resume_codes(pipe, take[16], **kwargs)
+    assert sorted(pipe.snapshots) == [20, 24]
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from conftest import make_codec
+from heartlib.heartcodec.models.flow_matching import time_schedule
+
+
+def _solve(solver, num_steps, schedule="uniform", velocity=None):
+    """x(1) from x(0) = 0 under dx/dt = ``velocity(t)``, t for default"""
+    flow_matching = make_codec().flow_matching
+    velocity = velocity or (lambda t: t)
+    plan = SimpleNamespace(
+        times=time_schedule(num_steps, schedule).tolist(),
+        pin_incontext=lambda x, t: None,
+        velocity=lambda x, t: torch.full_like(x, float(velocity(t))),
+    )
+    return getattr(flow_matching, f"solve_{solver}")(torch.zeros(1, 4, 2), plan)
+
+
+@pytest.mark.parametrize("solver", ["heun", "midpoint"])
+@pytest.mark.parametrize("schedule", ["uniform", "cosine"])
+def test_second_order_solvers_integrate_linear_velocity(solver, schedule):
+    x = _solve(solver, 3, schedule)
+    torch.testing.assert_close(x, torch.full_like(x, 0.5))
+
+
+def test_euler_lags_on_linear_velocity():
+    # left Riemann sum of t over 4 steps
+    x = _solve("euler", 4)
+    torch.testing.assert_close(x, torch.full_like(x, 0.375))
+
+
+def test_ab2_starts_with_an_euler_step():
+    torch.testing.assert_close(_solve("ab2", 1), _solve("euler", 1))
+    # and is exact on a linear velocity from there on
+    x = _solve("ab2", 4, velocity=lambda t: 1.0)
+    torch.testing.assert_close(x, torch.ones_like(x))
+
+
+def test_ab2_beats_euler_on_quadratic_velocity():
+    def velocity(t):
+        return 3 * t**2
+
+    euler, ab2 = (_solve(s, 8, velocity=velocity) for s in ("euler", "ab2"))
+    assert (ab2 - 1).abs().max() < (euler - 1).abs().max()
+
+
+def test_time_schedules():
+    torch.testing.assert_close(time_schedule(10), torch.linspace(0, 1, 11))
+    for schedule, shift in [("cosine", 1.0), ("uniform", 3.0), ("cosine", 0.5)]:
+        t_span = time_schedule(10, schedule, shift)
+        assert t_span[0] == 0 and t_span[-1] == 1
+        assert torch.all(t_span[1:] > t_span[:-1])
+    # a shift > 1 spends more steps near the noise end
+    assert time_schedule(10, shift=3.0)[5] < 0.5
@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from conftest import generate_codes, make_model
+
+SONG = {"tags": "rock", "lyrics": "la la la"}
+SONGS = [SONG, {"tags": "jazz fusion", "lyrics": "hm"}]
+MAX_MS = 80 * 12
+
+
+@pytest.mark.parametrize("cfg_scale", [1.0, 1.5])
+def test_greedy_matches_target_only(pipe, cfg_scale):
+    kwargs = dict(max_audio_length_ms=MAX_MS, topk=1, cfg_scale=cfg_scale)
+    reference = generate_codes(pipe, SONG, **kwargs)
+
+    pipe.enable_speculative_decoding(make_model(seed=5, backbone="tiny-draft"), 3)
+    codes = generate_codes(pipe, SONG, **kwargs)
+
+    assert pipe.speculative_stats.num_rounds > 0
+    assert torch.equal(codes, reference)
+
+
+def test_identical_draft_is_accepted(pipe):
+    # p == q for every code, so every draft frame passes the acceptance test
+    pipe.enable_speculative_decoding(make_model(), 3)
+    runs = []
+    for _ in range(2):
+        torch.manual_seed(0)
+        runs.append(generate_codes(pipe, SONG, max_audio_length_ms=MAX_MS))
+
+    stats = pipe.speculative_stats
+    assert stats.num_drafted > 0 and stats.acceptance_rate == 1.0
+    assert runs[0].shape[1] == MAX_MS // 80 + 1
+    assert torch.equal(runs[0], runs[1])
+
+
+def test_batch_with_draft_model_falls_back(pipe):
+    kwargs = dict(max_audio_length_ms=MAX_MS, topk=1)
+    reference = generate_codes(pipe, SONGS, **kwargs)
+
+    pipe.enable_speculative_decoding(make_model(seed=5, backbone="tiny-draft"), 3)
+    codes = generate_codes(pipe, SONGS, **kwargs)
+
+    assert len(codes) == len(reference) == 2
+    for song, expected in zip(codes, reference):
+        assert torch.equal(song, expected)
+
+
+def _near_draft(scale=0.02):
+    """the target with slightly perturbed weights: p / q lands inside (0, 1)"""
+    draft = make_model()
+    generator = torch.Generator().manual_seed(9)
+    with torch.no_grad():
+        for param in draft.parameters():
+            param.add_(torch.randn(param.shape, generator=generator) * scale)
+    return draft
+
+
+def test_generator_decouples_from_global_rng(pipe):
+    pipe.enable_speculative_decoding(_near_draft(), 3)
+    runs = []
+    for global_seed in (1, 2):
+        torch.manual_seed(global_seed)
+        generator = torch.Generator().manual_seed(0)
+        runs.append(
+            generate_codes(pipe, SONG, max_audio_length_ms=MAX_MS, generator=generator)
+        )
+    assert torch.equal(runs[0], runs[1])